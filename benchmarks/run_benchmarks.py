@@ -0,0 +1,318 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from functools import cached_property
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.synthetic import (concept_matches, random_embeddings, source_dataframe, stand_in_model_handler,
+                                  target_dataframe)
+from src.data_utils import SourceConceptTable, TargetConceptTable, generate_source_key, generate_source_keys, sort_concepts
+from src.match_utils import top_k_candidates
+from src.omop_utils import assign_concept_ids, export_session, generate_concept_table, generate_relationship_table, save_tables
+from src.session_utils import ProjectSession, list_saved_sessions, load_session
+
+## Micro-benchmarks for OMAP's hot paths on synthetic data at real scales.
+## Each benchmark is timed `repeat` times after its inputs are built, and results are written as JSON,
+## so runs on two commits can be compared with --compare.
+##
+##   python benchmarks/run_benchmarks.py --scale small --output bench.json
+##   python benchmarks/run_benchmarks.py --scale small --compare bench.json
+
+# sources x targets of real mapping jobs
+SCALES = {
+    'small': {'sources': 1000, 'targets': 50000},
+    'medium': {'sources': 20000, 'targets': 50000},
+    'large': {'sources': 200000, 'targets': 500000},
+}
+
+SORT_OPTIONS = ["Alphabetical (A-Z)", "Alphabetical (Z-A)", "Highest Confidence", "Lowest Confidence",
+                "Highest Re-rank Score", "Lowest Re-rank Score"]
+
+
+class SyntheticData:
+    """
+    Benchmark inputs, built on first use so that building them is never timed
+    Similarity benchmarks use the first `matrix_rows` sources, so the dense matrix stays under max_matrix_bytes
+    """
+    def __init__(self, sources, targets, dim=768, max_matrix_bytes=2**30, embed_texts=None, seed=0):
+        self.sources = sources
+        self.targets = targets
+        self.dim = dim
+        self.seed = seed
+        self.matrix_rows = max(1, min(sources, max_matrix_bytes // ((targets + 1) * 4)))
+        self.embed_texts = min(sources, embed_texts) if embed_texts else sources
+
+    @cached_property
+    def source_df(self):
+        return source_dataframe(self.sources, self.seed)
+
+    @cached_property
+    def target_df(self):
+        return target_dataframe(self.targets, self.seed + 1)
+
+    @cached_property
+    def source_table(self):
+        return SourceConceptTable.from_dataframe(self.source_df)[1]
+
+    @cached_property
+    def target_table(self):
+        return TargetConceptTable.from_dataframe(self.target_df)[1]
+
+    @cached_property
+    def matches(self):
+        return concept_matches(self.source_table, self.target_table, confirmed_fraction=0.5, seed=self.seed)
+
+    @cached_property
+    def confirmed_session(self):
+        return ProjectSession(
+            project_name="benchmark",
+            timestamp=datetime.now().strftime("%Y%m%d_%H%M%S"),
+            source_table=self.source_table,
+            target_table=self.target_table,
+            similarity_matrix=None,
+            concept_matches=concept_matches(self.source_table, self.target_table, confirmed_fraction=1.0, seed=self.seed)
+        )
+
+    @cached_property
+    def matrix_sources(self):
+        return SourceConceptTable(self.source_table.concepts[:self.matrix_rows])
+
+    @cached_property
+    def source_embeddings(self):
+        return random_embeddings(self.matrix_rows, self.dim, self.seed)
+
+    @cached_property
+    def target_embeddings(self):
+        return random_embeddings(self.targets + 1, self.dim, self.seed + 1)
+
+    @cached_property
+    def similarities(self):
+        return self.source_embeddings @ self.target_embeddings.T
+
+    @cached_property
+    def candidates(self):
+        rng = np.random.default_rng(self.seed)
+        return (rng.integers(1, self.targets + 1, size=(self.sources, 10)),
+                np.sort(rng.uniform(0, 1, size=(self.sources, 10)).astype(np.float32), axis=1)[:, ::-1])
+
+    @cached_property
+    def model_handler(self):
+        return stand_in_model_handler()
+
+
+def bench_source_from_dataframe(data):
+    return lambda: SourceConceptTable.from_dataframe(data.source_df), data.sources, {}
+
+
+def bench_target_from_dataframe(data):
+    return lambda: TargetConceptTable.from_dataframe(data.target_df), data.targets, {}
+
+
+def bench_generate_source_key(data):
+    columns = [data.source_df[column].astype(str).tolist()
+               for column in ['source_concept_code', 'source_concept_name', 'source_vocabulary_id']]
+    return lambda: [generate_source_key(*row) for row in zip(*columns)], data.sources, {}
+
+
+def bench_generate_source_keys(data):
+    columns = [data.source_df[column].astype(str).tolist()
+               for column in ['source_concept_code', 'source_concept_name', 'source_vocabulary_id']]
+    return lambda: generate_source_keys(*columns), data.sources, {}
+
+
+def bench_embedding_batching(data):
+    handler = data.model_handler
+    texts = data.source_df['source_concept_name'].tolist()[:data.embed_texts]
+    return lambda: handler.batch_generate_embeddings(texts), len(texts), {'model': "stand-in"}
+
+
+def bench_similarity(data):
+    run = lambda: data.source_embeddings @ data.target_embeddings.T
+    return run, data.matrix_rows * (data.targets + 1), {'rows': data.matrix_rows, 'dim': data.dim}
+
+
+def bench_top_k(data):
+    run = lambda: top_k_candidates(data.similarities, data.target_table, k=10)
+    return run, data.matrix_rows, {'rows': data.matrix_rows}
+
+
+def bench_generate_initial_matches(data):
+    run = lambda: data.model_handler.generate_initial_matches(data.matrix_sources, data.target_table, data.similarities)
+    return run, data.matrix_rows, {'rows': data.matrix_rows}
+
+
+def bench_sort_concepts(data):
+    lookup = {concept.source_key: (concept.concept_name, concept.concept_count) for concept in data.source_table.concepts}
+    run = lambda: [sort_concepts(data.matches, lookup, option) for option in SORT_OPTIONS]
+    return run, data.sources * len(SORT_OPTIONS), {}
+
+
+def bench_session_save(data):
+    def run():
+        # a fresh directory each time, as session directories are named to the second
+        with tempfile.TemporaryDirectory() as sessions_dir:
+            success, result = ProjectSession.create_and_save_session(
+                "benchmark", data.source_table, data.target_table, None, data.matches,
+                candidates=data.candidates, sessions_dir=sessions_dir, reuse_mappings=False
+            )
+            if not success:
+                raise RuntimeError(result)
+    return run, data.sources, {}
+
+
+def bench_session_load(data):
+    sessions_dir = tempfile.mkdtemp()
+    ProjectSession.create_and_save_session(
+        "benchmark", data.source_table, data.target_table, None, data.matches,
+        candidates=data.candidates, sessions_dir=sessions_dir, reuse_mappings=False
+    )
+    _, sessions = list_saved_sessions(sessions_dir)
+
+    def run():
+        success, result = load_session(sessions[0]['session_name'], sessions_dir)
+        if not success:
+            raise RuntimeError(result)
+    return run, data.sources, {'sessions_dir': sessions_dir}
+
+
+def bench_omop_conversion(data):
+    sessions = [data.confirmed_session]
+
+    def run():
+        # as the OMOP Conversion page does: export each session once, then merge
+        exports = [export_session(session) for session in sessions]
+        source_key_to_id = assign_concept_ids(exports)
+        concept_rows = generate_concept_table(exports, source_key_to_id)
+        relationship_rows = generate_relationship_table(exports, source_key_to_id)
+        with tempfile.TemporaryDirectory() as output_dir:
+            save_tables(concept_rows, relationship_rows, output_dir)
+    return run, data.sources, {}
+
+
+BENCHMARKS = {
+    'source_from_dataframe': bench_source_from_dataframe,
+    'target_from_dataframe': bench_target_from_dataframe,
+    'generate_source_key': bench_generate_source_key,
+    'generate_source_keys': bench_generate_source_keys,
+    'embedding_batching': bench_embedding_batching,
+    'similarity': bench_similarity,
+    'top_k': bench_top_k,
+    'generate_initial_matches': bench_generate_initial_matches,
+    'sort_concepts': bench_sort_concepts,
+    'session_save': bench_session_save,
+    'session_load': bench_session_load,
+    'omop_conversion': bench_omop_conversion,
+}
+
+
+def time_benchmark(run, items, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    best = min(seconds)
+    return {
+        'items': items,
+        'repeat': repeat,
+        'seconds': seconds,
+        'min_seconds': best,
+        'median_seconds': float(np.median(seconds)),
+        'items_per_second': items / best if best > 0 else None
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_suite(sources, targets, repeat=3, only=None, dim=768, max_matrix_bytes=2**30, embed_texts=None, seed=0):
+    """
+    Run the selected benchmarks (all by default) and return the results as a JSON-ready dict
+    A benchmark that fails is recorded with its error, and the others still run
+    """
+    data = SyntheticData(sources, targets, dim, max_matrix_bytes, embed_texts, seed)
+    results = {}
+    for name in only or BENCHMARKS:
+        try:
+            run, items, details = BENCHMARKS[name](data)
+            results[name] = dict(time_benchmark(run, items, repeat), **details)
+            print(f"[INFO] {name}: {results[name]['min_seconds']:.4f}s for {items} items")
+        except Exception as e:
+            results[name] = {'error': str(e)}
+            print(f"[INFO] {name} failed: {e}")
+
+    return {
+        'version': 1,
+        'commit': git_commit(),
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'sources': sources,
+        'targets': targets,
+        'dim': dim,
+        'matrix_rows': data.matrix_rows,
+        'results': results
+    }
+
+
+def compare_results(baseline, current):
+    """
+    {benchmark: current / baseline min time}, for benchmarks timed in both runs at the same sizes
+    """
+    ratios = {}
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base or 'error' in base or 'error' in result or base['items'] != result['items']:
+            continue
+        ratios[name] = result['min_seconds'] / base['min_seconds'] if base['min_seconds'] > 0 else None
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark OMAP hot paths on synthetic data")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--sources", type=int, help="overrides the scale's source count")
+    parser.add_argument("--targets", type=int, help="overrides the scale's target count")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="benchmarks to run (default: all)")
+    parser.add_argument("--dim", type=int, default=768, help="embedding size for similarity benchmarks")
+    parser.add_argument("--max-matrix-bytes", type=int, default=2**30,
+                        help="cap on the dense similarity block; fewer source rows are scored above it")
+    parser.add_argument("--embed-texts", type=int, help="cap on texts embedded by the stand-in model")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    args = parser.parse_args(argv)
+
+    scale = SCALES[args.scale]
+    report = run_suite(args.sources or scale['sources'], args.targets or scale['targets'], args.repeat, args.only,
+                       args.dim, args.max_matrix_bytes, args.embed_texts)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"[INFO] Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        for name, ratio in compare_results(baseline, report).items():
+            print(f"{name:28s} {ratio:6.2f}x baseline time" if ratio is not None else f"{name:28s} n/a")
+
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.run_benchmarks import SCALES, git_commit
+from benchmarks.synthetic import source_dataframe, stand_in_model_handler, target_dataframe
+from src.data_utils import SourceConceptTable, TargetConceptTable, read_and_validate_csv
+from src.match_utils import top_k_candidates
+from src.omop_utils import assign_concept_ids, export_session, generate_concept_table, generate_relationship_table, save_tables
+from src.session_utils import ProjectSession, commit_match_updates, list_saved_sessions, load_session
+from src.trace_utils import RssSampler, current_rss, path_bytes, run_report, start_run
+
+## End-to-end scale run: drives the auto-match -> review -> OMOP conversion flow headlessly on synthetic data,
+## the way pages 0-2 do, recording wall time and peak RSS per stage and the size of everything written to disk.
+## Budgets make it usable as a pass/fail check before promising a job size to a team:
+##
+##   python benchmarks/scale_harness.py --sources 20000 --targets 500000 --max-peak-rss-mb 16000 --output run.json
+
+STAGES = ["ingest", "embed_and_score", "match", "save_session", "bulk_confirm", "export_omop"]
+
+
+def directory_sizes(path):
+    """
+    {relative file path: bytes} for every file under path
+    """
+    sizes = {}
+    for root, _, files in os.walk(path):
+        for name in files:
+            full_path = os.path.join(root, name)
+            sizes[os.path.relpath(full_path, path)] = os.path.getsize(full_path)
+    return sizes
+
+
+def run_pipeline(sources, targets, work_dir, checkpoint=False, seed=0):
+    """
+    The pipeline's stages in order, as (stage name, stage function returning its details)
+    State is passed from stage to stage as the pages pass it through st.session_state
+    """
+    state = {}
+
+    def ingest():
+        # write the synthetic tables out, and read them back as an upload would be
+        source_path, target_path = f"{work_dir}/source.csv", f"{work_dir}/target.csv"
+        source_dataframe(sources, seed).to_csv(source_path, index=False)
+        target_dataframe(targets, seed + 1).to_csv(target_path, index=False)
+        for key, path, table_class in [('source_table', source_path, SourceConceptTable),
+                                       ('target_table', target_path, TargetConceptTable)]:
+            success, result = read_and_validate_csv(path, table_class)
+            if not success:
+                raise RuntimeError(result)
+            state[key] = result
+        return {'sources': len(state['source_table'].concepts), 'targets': len(state['target_table'].concepts)}
+
+    def embed_and_score():
+        handler = stand_in_model_handler()
+        if checkpoint:
+            handler.checkpoint_dir = f"{work_dir}/checkpoints"
+        success, result = handler.get_concept_similarities(state['source_table'], state['target_table'])
+        if not success:
+            raise RuntimeError(result)
+        state['handler'], state['similarities'] = handler, result
+        return {'similarity_bytes': int(result.nbytes), 'dedup': handler.dedup_stats}
+
+    def match():
+        state['matches'] = state['handler'].generate_initial_matches(
+            state['source_table'], state['target_table'], state['similarities']
+        )
+        state['candidates'] = top_k_candidates(state['similarities'], state['target_table'])
+        return {'matches': len(state['matches'])}
+
+    def save_session():
+        success, result = ProjectSession.create_and_save_session(
+            "scale", state['source_table'], state['target_table'], state['similarities'], state['matches'],
+            source_embeddings=state['handler'].embeddings.get('source'),
+            target_embeddings=state['handler'].embeddings.get('target'),
+            source_inverse=state['handler'].embeddings.get('source_inverse'),
+            target_inverse=state['handler'].embeddings.get('target_inverse'),
+            candidates=state['candidates'], sessions_dir=f"{work_dir}/sessions", reuse_mappings=False
+        )
+        if not success:
+            raise RuntimeError(result)
+        # as the Auto-Match job does once its result is saved
+        checkpoint_bytes = path_bytes(*state['handler'].checkpoint_runs)
+        state['handler'].discard_checkpoints()
+        _, sessions = list_saved_sessions(f"{work_dir}/sessions")
+        state['session_name'] = sessions[0]['session_name']
+        # the review pages start from the saved session, not the in-memory one
+        for key in ['similarities', 'matches', 'candidates', 'handler']:
+            del state[key]
+        return {'discarded_checkpoint_bytes': checkpoint_bytes}
+
+    def bulk_confirm():
+        success, session = load_session(state['session_name'], f"{work_dir}/sessions")
+        if not success:
+            raise RuntimeError(session)
+        now = datetime.now()
+        for match in session.concept_matches:
+            match.confirmation_status = "True"
+            match.first_confirmation_timestamp = now
+            match.last_update_timestamp = now
+        success, result = commit_match_updates(session, session.concept_matches, f"{work_dir}/sessions")
+        if not success:
+            raise RuntimeError(result)
+        state['session'] = session
+        return {'confirmed': result['written']}
+
+    def export_omop():
+        sessions = [export_session(state.pop('session'))]
+        source_key_to_id = assign_concept_ids(sessions)
+        concept_rows = generate_concept_table(sessions, source_key_to_id)
+        relationship_rows = generate_relationship_table(sessions, source_key_to_id)
+        save_tables(concept_rows, relationship_rows, f"{work_dir}/omop")
+        return {'concept_rows': len(concept_rows), 'relationship_rows': len(relationship_rows)}
+
+    for stage in [ingest, embed_and_score, match, save_session, bulk_confirm, export_omop]:
+        yield stage.__name__, stage
+
+
+def check_budgets(report, max_peak_rss_mb=None, max_total_seconds=None, stage_seconds=None):
+    """
+    Budget violations of a run report, as messages; an empty list means the run is within budget
+    """
+    violations = []
+    if report.get('error'):
+        violations.append(f"Run failed at {report['failed_stage']}: {report['error']}")
+    peak_mb = report['peak_rss_bytes'] / 2**20
+    if max_peak_rss_mb is not None and peak_mb > max_peak_rss_mb:
+        violations.append(f"Peak RSS {peak_mb:.0f} MB is over the {max_peak_rss_mb} MB budget")
+    if max_total_seconds is not None and report['total_seconds'] > max_total_seconds:
+        violations.append(f"Total time {report['total_seconds']:.1f}s is over the {max_total_seconds}s budget")
+    for stage, budget in (stage_seconds or {}).items():
+        seconds = report['stages'].get(stage, {}).get('seconds')
+        if seconds is not None and seconds > budget:
+            violations.append(f"Stage {stage} took {seconds:.1f}s, over its {budget}s budget")
+    return violations
+
+
+def run_harness(sources, targets, work_dir=None, checkpoint=False, keep=False, seed=0):
+    """
+    Run the pipeline once and return the run report (stages, peak RSS, artifact sizes) as a JSON-ready dict
+    A failing stage (including running out of memory in numpy) ends the run and is recorded in the report
+    """
+    work_dir = work_dir or tempfile.mkdtemp(prefix="omap_scale_")
+    os.makedirs(work_dir, exist_ok=True)
+    report = {
+        'version': 1,
+        'commit': git_commit(),
+        'created': datetime.now().isoformat(),
+        'sources': sources,
+        'targets': targets,
+        'dense_similarity_bytes': sources * (targets + 1) * 4,
+        'checkpoint': checkpoint,
+        'stages': {},
+        'error': None,
+        'failed_stage': None
+    }
+    print(f"[INFO] Scale run: {sources} sources x {targets} targets, "
+          f"dense similarity matrix {report['dense_similarity_bytes'] / 2**30:.2f} GB, in {work_dir}")
+
+    # the library's own spans break each stage down further (tokenize, inference, journal writes...)
+    run_id = start_run("scale")
+    start = time.perf_counter()
+    try:
+        for name, stage in run_pipeline(sources, targets, work_dir, checkpoint, seed):
+            stage_start = time.perf_counter()
+            try:
+                with RssSampler() as sampler:
+                    details = stage()
+            except Exception as e:
+                report['error'], report['failed_stage'] = f"{type(e).__name__}: {e}", name
+                print(f"[INFO] Stage {name} failed: {report['error']}")
+                break
+            report['stages'][name] = dict(details, seconds=time.perf_counter() - stage_start,
+                                          peak_rss_bytes=sampler.peak)
+            print(f"[INFO] {name}: {report['stages'][name]['seconds']:.2f}s, "
+                  f"peak RSS {sampler.peak / 2**20:.0f} MB")
+
+        report['total_seconds'] = time.perf_counter() - start
+        report['spans'] = run_report(run_id)['stages']
+        report['peak_rss_bytes'] = max([stage['peak_rss_bytes'] for stage in report['stages'].values()] + [current_rss()])
+        report['artifacts'] = {
+            directory: directory_sizes(f"{work_dir}/{directory}")
+            for directory in ["sessions", "omop", "checkpoints"] if os.path.exists(f"{work_dir}/{directory}")
+        }
+        report['artifact_bytes'] = {directory: sum(sizes.values()) for directory, sizes in report['artifacts'].items()}
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return report
+
+
+def parse_stage_budgets(values):
+    budgets = {}
+    for value in values or []:
+        stage, _, seconds = value.partition("=")
+        if stage not in STAGES or not seconds:
+            raise argparse.ArgumentTypeError(f"Expected STAGE=SECONDS with STAGE one of {STAGES}, got {value}")
+        budgets[stage] = float(seconds)
+    return budgets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the OMAP pipeline end to end at a synthetic scale")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--sources", type=int, help="overrides the scale's source count")
+    parser.add_argument("--targets", type=int, help="overrides the scale's target count")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="use checkpointed, memory-mapped similarities as for large Auto-Match runs")
+    parser.add_argument("--work-dir", help="where sessions and OMOP tables are written (default: a temp dir)")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory afterwards")
+    parser.add_argument("--max-peak-rss-mb", type=float)
+    parser.add_argument("--max-total-seconds", type=float)
+    parser.add_argument("--stage-seconds", nargs="+", metavar="STAGE=SECONDS", help="per-stage time budgets")
+    parser.add_argument("--output", help="write the run report to this JSON file")
+    args = parser.parse_args(argv)
+
+    stage_seconds = parse_stage_budgets(args.stage_seconds)
+    scale = SCALES[args.scale]
+    report = run_harness(args.sources or scale['sources'], args.targets or scale['targets'], args.work_dir,
+                         args.checkpoint, args.keep)
+    report['violations'] = check_budgets(report, args.max_peak_rss_mb, args.max_total_seconds, stage_seconds)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4, default=str)
+        print(f"[INFO] Run report written to {args.output}")
+
+    for violation in report['violations']:
+        print(f"[BUDGET] {violation}")
+    if report['violations']:
+        raise SystemExit(1)
+    return report
+
+
+if __name__ == "__main__":
+    main()
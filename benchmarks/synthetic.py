@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+import torch
+from datetime import datetime, timedelta
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import BertConfig, BertModel, PreTrainedTokenizerFast
+from src.data_utils import ConceptMatch
+from src.match_utils import ModelHandler
+
+## Synthetic drug-chart style concepts at real OMAP scales, and a small randomly initialised stand-in model,
+## so benchmarks and scale runs need no patient data and no model download.
+
+INGREDIENTS = (
+    "paracetamol ibuprofen ondansetron dalteparin enoxaparin heparin morphine oxycodone codeine tramadol "
+    "amoxicillin flucloxacillin clarithromycin doxycycline metronidazole gentamicin vancomycin cefalexin "
+    "omeprazole lansoprazole metformin gliclazide insulin atorvastatin simvastatin amlodipine ramipril "
+    "bisoprolol furosemide bendroflumethiazide levothyroxine prednisolone dexamethasone salbutamol "
+    "sertraline citalopram haloperidol lorazepam diazepam levetiracetam"
+).split()
+STRENGTHS = "1 2 2.5 4 5 10 20 25 40 50 100 250 500 1000".split()
+UNITS = "mg microgram ml unit".split()
+FORMS = (
+    "tablet capsule oral solution suspension injection infusion cream ointment inhaler patch "
+    "suppository drops modified release dispersible"
+).split()
+SOURCE_VOCABULARIES = ["medchart", "pharmacy", "theatres"]
+TARGET_VOCABULARIES = ["dm+d", "RxNorm"]
+
+
+def concept_names(n, seed=0):
+    """
+    n drug-chart style names; a pack size suffix keeps most names distinct at large n
+    """
+    rng = np.random.default_rng(seed)
+    ingredients = np.array(INGREDIENTS)[rng.integers(len(INGREDIENTS), size=n)]
+    strengths = np.array(STRENGTHS)[rng.integers(len(STRENGTHS), size=n)]
+    units = np.array(UNITS)[rng.integers(len(UNITS), size=n)]
+    forms = np.array(FORMS)[rng.integers(len(FORMS), size=n)]
+    packs = rng.integers(1, 1000, size=n)
+    return [f"{i} {s} {u} {f} {p}" for i, s, u, f, p in zip(ingredients, strengths, units, forms, packs)]
+
+
+def source_dataframe(n, seed=0):
+    """
+    Source concepts with the columns of SourceConceptTable, and skewed (Zipf) usage counts
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'source_concept_code': [f"SRC{i:08d}" for i in range(n)],
+        'source_concept_name': concept_names(n, seed),
+        'source_vocabulary_id': np.array(SOURCE_VOCABULARIES)[rng.integers(len(SOURCE_VOCABULARIES), size=n)],
+        'source_concept_count': np.minimum(rng.zipf(1.5, size=n), 10**6)
+    })
+
+
+def target_dataframe(n, seed=1):
+    """
+    Target concepts with the columns of TargetConceptTable; concept_ids start at 1, 0 is 'No matching concept'
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'concept_id': np.arange(1, n + 1),
+        'concept_code': [f"{10**8 + i}" for i in range(n)],
+        'concept_name': concept_names(n, seed),
+        'vocabulary_id': np.array(TARGET_VOCABULARIES)[rng.integers(len(TARGET_VOCABULARIES), size=n)]
+    })
+
+
+def random_embeddings(n, dim=768, seed=0):
+    """
+    Unit-norm float32 embeddings, for scoring benchmarks that should not depend on model speed
+    """
+    embeddings = np.random.default_rng(seed).standard_normal((n, dim), dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def concept_matches(source_table, target_table, confirmed_fraction=0.0, seed=0):
+    """
+    One match per source to a pseudo-random target; confirmed_fraction of them confirmed, with distinct timestamps
+    The target is derived from the source_key, so sources whose keys collide agree on their target
+    """
+    rng = np.random.default_rng(seed)
+    target_ids = np.array([concept.concept_id for concept in target_table.concepts])
+    keys = np.array([concept.source_key for concept in source_table.concepts], dtype=np.int64)
+    targets = target_ids[(keys * 2654435761 + seed) % len(target_ids)]
+    scores = rng.uniform(0, 1, size=len(source_table.concepts))
+    confirmed = rng.uniform(0, 1, size=len(source_table.concepts)) < confirmed_fraction
+    start = datetime(2025, 1, 1)
+
+    matches = []
+    for row, concept in enumerate(source_table.concepts):
+        timestamp = start + timedelta(seconds=row) if confirmed[row] else None
+        matches.append(ConceptMatch(
+            source_key=concept.source_key,
+            target_concept_id=int(targets[row]),
+            similarity_score=float(scores[row]),
+            confirmation_status="True" if confirmed[row] else "False",
+            first_confirmation_timestamp=timestamp,
+            last_update_timestamp=timestamp
+        ))
+    return matches
+
+
+def build_stand_in_model(hidden_size=32, num_hidden_layers=1):
+    """
+    A randomly initialised small BERT with a word-level tokenizer over the synthetic vocabulary
+    """
+    torch.manual_seed(0)
+    vocab = {"[PAD]": 0, "[UNK]": 1}
+    for word in INGREDIENTS + STRENGTHS + UNITS + FORMS + "no matching concept".split():
+        vocab.setdefault(word, len(vocab))
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]", unk_token="[UNK]")
+    model = BertModel(BertConfig(
+        vocab_size=len(vocab), hidden_size=hidden_size, num_hidden_layers=num_hidden_layers,
+        num_attention_heads=2, intermediate_size=hidden_size * 2
+    )).eval()
+    return tokenizer, model
+
+
+def stand_in_model_handler(**model_kwargs):
+    """
+    A ModelHandler already holding the stand-in model
+    """
+    handler = ModelHandler()
+    handler.tokenizer, handler.model = build_stand_in_model(**model_kwargs)
+    return handler
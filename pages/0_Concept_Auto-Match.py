@@ -7,14 +7,29 @@ print("WARNING: Excessive directory traversal happening. Lawrence, avert your ey
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from src.data_utils import SourceConceptTable, TargetConceptTable, read_and_validate_csv
 from src.match_utils import ModelHandler
-from src.session_utils import ProjectSession
+from src.session_utils import ProjectSession, list_saved_sessions, load_session, source_key_registry
+from src.update_utils import rematch_for_release, update_sources
+from src.vocab_utils import list_vocabulary_packs, load_concept_replacements
+from src.pack_utils import VocabPack, list_vocab_packs
+from src.quant_utils import STORAGE_DTYPES
+from src.rerank_utils import CrossEncoderReranker, FeatureReranker
+from src.multi_vocab_utils import combine_target_tables
+from src.job_utils import MATCH_JOB_KINDS, auto_match_job, get_job_runner, hierarchical_job, multi_vocab_job
+from src.trace_utils import configure_tracing, run_report, run_report_rows, set_current_run, start_run
 print("It's OK you can look now.")
 
 ### Streamlit page: Concept Auto-Match
 ### 1) Upload source concept CSV file
 ### 2) Upload target concept CSV file
-### 3) NLP + cosine similarity (presently hard-coded to BioLord)
+### 3) NLP + cosine similarity (presently hard-coded to BioLord), optionally re-ranking the top-k candidates
+###    or constrained to an OMOP hierarchy (coarse concepts first, then only their descendants)
+###    or against several target vocabularies at once, embedding the sources only once
 ### 4) Save session
+### 5) Per-stage timings, memory and throughput of the last run, saved with the session as run_report.json
+### 6) Matching runs as a background job with progress, ETA and cancellation; any tab can reattach to a job
+
+# stage spans of every run are appended here as JSON lines
+SPAN_LOG = "logs/spans.jsonl"
 
 def initialize_session_state():
     """
@@ -28,14 +43,35 @@ def initialize_session_state():
             session_saved (bool): indicates if session has been saved
             similarities (numpy.ndarray): similarity score matrix
             concept_matches (List[ConceptMatch]): highest scoring matches
+            candidates (tuple): top-k candidate target concept_ids and scores per source concept
+            embeddings (dict): normalised source / target embeddings per distinct name, and the inverse indices mapping
+                concept rows to them; saved with the session for incremental updates
+            vocab_pack_path (str): prebuilt vocab pack the target table was loaded from, if any
+            target_tables (dict): label -> TargetConceptTable when matching against several target vocabularies
+            partitions (tuple): (partitions, partition_candidates) of the last multi-vocabulary run
+            run_id (str): instrumentation run of the last matching, so its report is saved with the session
+            match_job_id (str): background matching job this tab is following
+            loaded_job_id (str): job whose result has been loaded into the session states
+            source_upload (tuple): (file_id, SourceConceptTable, collisions) of the uploaded source file, keys resolved
+            embedding_model (tuple): (model_path, backend) the loaded job's embeddings were made with
     """
     session_states = {
         'source_table': None,
         'target_table': None,
+        'vocab_pack_path': None,
         'project_name': None,
         'session_saved': False,
         'similarities': None,
-        'concept_matches': None
+        'concept_matches': None,
+        'candidates': None,
+        'embeddings': None,
+        'target_tables': None,
+        'partitions': None,
+        'run_id': None,
+        'match_job_id': None,
+        'loaded_job_id': None,
+        'source_upload': None,
+        'embedding_model': None
     }
 
     for key, default_value in session_states.items():
@@ -109,9 +145,10 @@ def handle_file_upload(file_type='source'):
         bool:
             Success state
         Session states:
-            Updates source_table (SourceConceptTable) or target_table (TargetConceptTable) with uploaded concepts
+            Updates source_table (SourceConceptTable) or target_table (TargetConceptTable) with uploaded concepts,
+            and source_upload (tuple) once per uploaded source file
         Streamlit UI:
-            Expander panel to preview top 5 rows of concept dataframe
+            Expander panel to preview top 5 rows of concept dataframe, and a warning per source key collision resolved
     """
 
     label = "Source" if file_type == 'source' else "Target"
@@ -120,10 +157,26 @@ def handle_file_upload(file_type='source'):
     uploaded_file = st.file_uploader(f"Upload {label} Concepts CSV", type=['csv'])
 
     if uploaded_file is not None:
-        read_success, result = read_and_validate_csv(uploaded_file, table_class)
+        # a source file is read and its keys resolved against the registry once per upload, not on every rerun
+        if file_type == 'source' and st.session_state.source_upload is not None \
+                and st.session_state.source_upload[0] == uploaded_file.file_id:
+            read_success, result = True, st.session_state.source_upload[1]
+        else:
+            read_success, result = read_and_validate_csv(uploaded_file, table_class)
+            if read_success and file_type == 'source':
+                # known concepts keep their keys; a new concept whose key is taken is given another one here
+                collisions = source_key_registry().resolve(result)
+                st.session_state.source_upload = (uploaded_file.file_id, result, collisions)
         if read_success:
+            if file_type == 'source':
+                for collision in st.session_state.source_upload[2]:
+                    st.warning(f"Source key of '{collision['concept_name']}' ({collision['concept_code']}) collided with "
+                               f"'{collision['collided_with'][1]}'; it was given key {collision['source_key']}")
             state_key = f"{file_type}_table"
             st.session_state[state_key] = result
+            if file_type == 'target':
+                st.session_state.vocab_pack_path = None
+                st.session_state.target_tables = None
             st.success(f"{label} CSV loaded successfully!")
 
             with st.expander(f"Preview {file_type} concepts:"):
@@ -137,46 +190,334 @@ def handle_file_upload(file_type='source'):
 
     return False
 
-def perform_concept_matching():
+def handle_multi_target_upload():
     """
-    Generate concept similarities using BioLord model
+    Upload several target concept CSVs to match against in one run, e.g. dm+d VTM, dm+d VMP and RxNorm clinical drug.
+    Each file becomes a partition of one combined target table, labelled by its file name.
 
     Returns:
         bool:
             Success state
         Session states:
-            Updates similarities (numpy.ndarray) and concept_matches (List[ConceptMatch]) with outputs of NLP embedding and similarity matching
+            Updates target_tables (dict) and target_table (TargetConceptTable) with the combined table
+        Streamlit UI:
+            Multi-file uploader, and the number of concepts per vocabulary
     """
-    with st.spinner("Loading BioLORD model and calculating similarities..."):
-        model_handler = ModelHandler()
-        load_success, message = model_handler.load_model()
-
-        if not load_success:
-            st.error(f"Failed to load model: {message}")
+    uploaded_files = st.file_uploader("...or upload several Target Concepts CSVs to match against all of them",
+                                      type=['csv'], accept_multiple_files=True)
+    if len(uploaded_files) < 2:
+        return False
+
+    target_tables = {}
+    for uploaded_file in uploaded_files:
+        read_success, result = read_and_validate_csv(uploaded_file, TargetConceptTable)
+        if not read_success:
+            st.error(f"{uploaded_file.name}: {result}")
             return False
+        target_tables[os.path.splitext(uploaded_file.name)[0]] = result
 
-        similarity_success, result = model_handler.get_concept_similarities(
-            st.session_state.source_table,
-            st.session_state.target_table
-        )
+    combined_table, _ = combine_target_tables(target_tables)
+    st.session_state.target_tables = target_tables
+    st.session_state.target_table = combined_table
+    st.session_state.vocab_pack_path = None
+    st.success(", ".join(f"{label}: {len(table.concepts) - 1}" for label, table in target_tables.items()))
+    return True
+
+def perform_multi_vocabulary_matching(backend):
+    """
+    Submit a background job that matches against every uploaded target vocabulary, embedding the sources once.
+    Each vocabulary keeps its own top-k candidates; initial matches take the best candidate over all of them.
+
+    Args:
+        backend (str):
+            Inference backend for ModelHandler
+
+    Returns:
+        bool:
+            Success state
+        Session states:
+            Sets match_job_id (str); the job's outputs, including the partitions, are loaded by display_match_job
+    """
+    label = (f"{len(st.session_state.source_table.concepts)} sources x "
+             f"{len(st.session_state.target_tables)} vocabularies")
+    st.session_state.match_job_id = get_job_runner().submit(
+        "multi-vocab-match", multi_vocab_job, st.session_state.source_table, st.session_state.target_tables,
+        backend=backend, label=label
+    )
+    return True
 
-        if similarity_success:
-            st.session_state.similarities = result
+def handle_pack_selection(pack_dir="concepts/packs"):
+    """
+    Alternative to uploading a target CSV: load a prebuilt vocabulary pack.
+    Parquet packs (src/vocab_utils.py) hold concepts only, .vpack packs (src/pack_utils.py) also hold embeddings,
+    so target embedding is skipped during matching.
+
+    Args:
+        pack_dir (str):
+            Directory containing vocabulary packs. Default is concepts/packs.
+
+    Returns:
+        bool:
+            Success state
+        Session states:
+            Updates target_table (TargetConceptTable) with the pack's concepts, and vocab_pack_path (str) for .vpack packs
+    """
+    packs = list_vocab_packs(pack_dir) + list_vocabulary_packs(pack_dir)
+    if not packs:
+        return False
+
+    selected_pack = st.selectbox("...or select a prebuilt target vocabulary pack", [""] + packs)
+    if selected_pack and st.button("Load Vocabulary Pack"):
+        pack_path = os.path.join(pack_dir, selected_pack)
+        if pack_path.endswith(".vpack"):
             try:
-                matches = model_handler.generate_initial_matches(
-                    st.session_state.source_table,
-                    st.session_state.target_table,
-                    result
-                )
-                st.session_state.concept_matches = matches
-                st.success("Similarity matrix and matches generated")
-                return True
+                load_success, result = True, VocabPack.open(pack_path).to_target_table()
             except Exception as e:
-                st.error(f"Failed to generate matches: {e}")
-                return False
+                load_success, result = False, f"Error opening vocab pack: {e}"
         else:
-            st.error(f"Failed to calculate similarities: {result}")
-            return False
+            load_success, result = TargetConceptTable.from_pack(pack_path)
+
+        if load_success:
+            st.session_state.target_table = result
+            st.session_state.target_tables = None
+            st.session_state.vocab_pack_path = pack_path if pack_path.endswith(".vpack") else None
+            st.success(f"Vocabulary pack loaded: {len(result.concepts)} target concepts")
+            return True
+        st.error(result)
+
+    return False
+
+def perform_concept_matching(backend="torch", reranker=None, rerank_budget=None):
+    """
+    Submit a background job that generates concept similarities using BioLord model
+
+    Args:
+        backend (str):
+            Inference backend for ModelHandler: 'torch', 'int8' or 'onnx'. Default is torch.
+        reranker (FeatureReranker | CrossEncoderReranker):
+            Optional second stage that re-scores each source concept's top-k candidates. Default is None.
+        rerank_budget (float):
+            Seconds the re-ranker may run for; the least ambiguous rows are left unscored if it runs out. Default is None.
+
+    Returns:
+        bool:
+            Success state
+        Session states:
+            Sets match_job_id (str); the job's outputs are loaded by display_match_job once it has finished
+    """
+    label = f"{len(st.session_state.source_table.concepts)} sources x {len(st.session_state.target_table.concepts)} targets"
+    st.session_state.match_job_id = get_job_runner().submit(
+        "auto-match", auto_match_job, st.session_state.source_table, st.session_state.target_table,
+        backend=backend, vocab_pack_path=st.session_state.vocab_pack_path, reranker=reranker,
+        rerank_budget=rerank_budget, label=label
+    )
+    return True
+
+def load_job_result(job):
+    """
+    Load a finished matching job's outputs, as the synchronous matching used to set them
+
+    Args:
+        job (Job):
+            Succeeded auto-match, multi-vocab-match or hierarchical-match job
+
+    Returns:
+        Session states:
+            Updates source_table, target_table, vocab_pack_path, similarities, concept_matches, candidates, embeddings,
+            embedding_model, partitions (multi-vocabulary jobs only), run_id and loaded_job_id
+    """
+    result = get_job_runner().load_result(job.job_id)
+    st.session_state.source_table = result['source_table']
+    st.session_state.target_table = result['target_table']
+    st.session_state.vocab_pack_path = result['vocab_pack_path']
+    st.session_state.similarities = result['similarities']
+    st.session_state.concept_matches = result['concept_matches']
+    st.session_state.candidates = (result['candidate_ids'], result['candidate_scores'])
+    st.session_state.embeddings = {'source': result['source_embeddings'], 'source_inverse': result.get('source_inverse'),
+                                   'target': result['target_embeddings'], 'target_inverse': result.get('target_inverse')}
+    st.session_state.embedding_model = (result['model_path'], result['backend'])
+    st.session_state.partitions = ((result['partitions'], result['partition_candidates'])
+                                   if 'partitions' in result else None)
+    st.session_state.session_saved = False
+    st.session_state.run_id = job.run_id
+    st.session_state.loaded_job_id = job.job_id
+    for note in result['notes']:
+        st.info(note)
+
+@st.fragment(run_every=1)
+def display_match_job():
+    """
+    Follow the current matching job: progress, ETA and a cancel button while it runs, its outputs once it is done
+
+    Returns:
+        Streamlit UI:
+            Progress bar and status, refreshed every second without rerunning the whole page
+        Session states:
+            Loads the job's outputs (see load_job_result) once it has succeeded
+    """
+    job_id = st.session_state.match_job_id
+    if job_id is None or job_id == st.session_state.loaded_job_id:
+        return
+    runner = get_job_runner()
+    job = runner.get(job_id)
+    if job is None:
+        st.session_state.match_job_id = None
+        return
+
+    if job.status == "queued":
+        st.info(f"Matching job {job.label} is queued behind other jobs")
+    elif job.status == "running":
+        eta = job.eta()
+        st.progress(job.fraction(), text=f"{job.message or 'Running'}: {job.stage or ''} {job.done}/{job.total}"
+                                         + (f", about {eta:.0f}s left in this stage" if eta is not None else ""))
+    elif job.status == "succeeded":
+        load_job_result(job)
+        # the rest of the page needs the new outputs
+        st.rerun(scope="app")
+    else:
+        st.error(f"Matching job {job.status}" + (f": {job.error}" if job.error else ""))
+        if st.button("Dismiss", key="dismiss_job"):
+            st.session_state.match_job_id = None
+            st.rerun(scope="app")
+        return
+
+    if st.button("Cancel matching", key="cancel_job"):
+        runner.cancel(job_id)
+
+def display_job_list():
+    """
+    Recent matching jobs of every user, so a job started in a closed tab can be picked up again
+
+    Returns:
+        Streamlit UI:
+            Table of jobs, and a selectbox and button to follow one of them
+        Session states:
+            Sets match_job_id (str) to the selected job
+    """
+    jobs = get_job_runner().list_jobs(MATCH_JOB_KINDS)[:20]
+    if not jobs:
+        st.write("No matching jobs yet.")
+        return
+
+    st.dataframe([
+        {'job': job.job_id, 'sources x targets': job.label, 'status': job.status,
+         'progress': f"{job.stage or ''} {job.done}/{job.total}", 'created': job.created}
+        for job in jobs
+    ])
+    selectable = [job.job_id for job in jobs
+                  if job.status in ("queued", "running") or (job.status == "succeeded" and not job.result_discarded)]
+    selected = st.selectbox("Job to follow", selectable, key="job_to_follow")
+    if selected and st.button("Follow job", key="follow_job"):
+        st.session_state.match_job_id = selected
+        st.session_state.loaded_job_id = None
+        st.rerun()
+
+def select_backend(key=None):
+    """
+    Inference backend for matching and session updates
+
+    Args:
+        key (str):
+            Widget key, for a second selector on the same page. Default is None.
+
+    Returns:
+        str:
+            One of ModelHandler.backends
+        Streamlit UI:
+            Backend selectbox
+    """
+    return st.selectbox(
+        "Inference backend",
+        ModelHandler.backends,
+        key=key,
+        help="int8 and onnx are optimised for CPU-only machines, and are converted once then cached on disk"
+    )
+
+def select_hierarchy():
+    """
+    Options for hierarchy-constrained matching, from local Athena CONCEPT_ANCESTOR / CONCEPT_RELATIONSHIP files
+
+    Returns:
+        dict | None:
+            ancestor_path, relationship_path, relationship_ids and coarse_k, or None for flat matching
+        Streamlit UI:
+            Checkbox to enable, text inputs for file paths and relationship_ids, number input for coarse candidates
+    """
+    if not st.checkbox("Hierarchy-constrained matching",
+                       help="Match coarse concepts (e.g. VTMs) first, then search only their descendants (e.g. VMPs)"):
+        return None
+
+    source = st.radio("Hierarchy source", ["CONCEPT_ANCESTOR", "CONCEPT_RELATIONSHIP"], horizontal=True)
+    path = st.text_input(f"Path to Athena {source}.csv")
+    relationship_ids = ["Subsumes"]
+    if source == "CONCEPT_RELATIONSHIP":
+        relationship_ids = [r.strip() for r in st.text_input("Parent to child relationship_ids", value="Subsumes").split(",")]
+    coarse_k = st.number_input("Coarse candidates searched per source", min_value=1, value=3)
+
+    return {
+        'ancestor_path': path if source == "CONCEPT_ANCESTOR" else None,
+        'relationship_path': path if source == "CONCEPT_RELATIONSHIP" else None,
+        'relationship_ids': relationship_ids,
+        'coarse_k': coarse_k
+    }
+
+def perform_hierarchical_matching(backend, hierarchy):
+    """
+    Submit a background job that generates matches by searching only the descendants of each source's top coarse
+    target concepts. No full similarity matrix is built, so the Mapping page's alternatives come from the top-k candidates.
+
+    Args:
+        backend (str):
+            Inference backend for ModelHandler
+        hierarchy (dict):
+            Options from select_hierarchy
+
+    Returns:
+        bool:
+            Success state
+        Session states:
+            Sets match_job_id (str); the job's outputs are loaded by display_match_job once it has finished
+    """
+    if not hierarchy['ancestor_path'] and not hierarchy['relationship_path']:
+        st.error("Enter the path to a CONCEPT_ANCESTOR or CONCEPT_RELATIONSHIP file")
+        return False
+
+    label = (f"{len(st.session_state.source_table.concepts)} sources x "
+             f"{len(st.session_state.target_table.concepts)} targets, hierarchical")
+    st.session_state.match_job_id = get_job_runner().submit(
+        "hierarchical-match", hierarchical_job, st.session_state.source_table, st.session_state.target_table,
+        relationship_path=hierarchy['relationship_path'], ancestor_path=hierarchy['ancestor_path'],
+        relationship_ids=hierarchy['relationship_ids'], coarse_k=hierarchy['coarse_k'], backend=backend, label=label
+    )
+    return True
+
+def select_reranker():
+    """
+    Re-ranking options for the second matching stage
+
+    Returns:
+        tuple:
+            reranker (FeatureReranker | CrossEncoderReranker | None): selected re-ranker, None to keep bi-encoder top-1
+            rerank_budget (float | None): time budget in seconds, None for no limit
+        Streamlit UI:
+            Selectbox for re-ranker, text input for cross-encoder model, number input for time budget
+    """
+    choice = st.selectbox(
+        "Re-rank top-k candidates",
+        ["None", "Lexical features", "Cross-encoder"],
+        help="Re-scores only each source concept's top 10 candidates, e.g. to separate products differing by strength"
+    )
+    if choice == "None":
+        return None, None
+
+    if choice == "Cross-encoder":
+        model_path = st.text_input("Cross-encoder model", value="cross-encoder/ms-marco-MiniLM-L-6-v2")
+        reranker = CrossEncoderReranker(model_path)
+    else:
+        reranker = FeatureReranker()
+
+    rerank_budget = st.number_input("Re-ranking time budget (seconds, 0 for no limit)", min_value=0, value=120)
+    return reranker, (rerank_budget or None)
 
 def handle_session_save():
     """
@@ -186,9 +527,9 @@ def handle_session_save():
         bool:
             Success state
         Session states:
-            Updates session_saved (bool) and project_name (str) states
+            Updates session_saved (bool) and project_name (str) states; the loaded job's result is deleted once saved
         Streamlit UI:
-            Creates text input box for project name
+            Creates text input box for project name, and selectboxes for similarity matrix and embedding precision
 
     """
     project_name = st.text_input(
@@ -197,6 +538,19 @@ def handle_session_save():
         help="Enter a nice, descriptive name to identify this mapping project"
     )
 
+    similarity_dtype = st.selectbox(
+        "Similarity matrix storage",
+        ["float32", "float16"],
+        help="float16 halves the size of the saved similarity matrix, at about 3 decimal places of precision"
+    )
+
+    embedding_dtype = st.selectbox(
+        "Embedding storage",
+        STORAGE_DTYPES,
+        help="float16 halves and int8 quarters the size of the saved embeddings; "
+             "the session records how often search over them agrees with float32"
+    )
+
     # not currently allowing overwriting
     save_button = st.button("Save Session", disabled=not project_name or st.session_state.session_saved)
 
@@ -212,12 +566,26 @@ def handle_session_save():
                     source_table=st.session_state.source_table,
                     target_table=st.session_state.target_table,
                     similarity_matrix=st.session_state.similarities,
-                    concept_matches=st.session_state.concept_matches
+                    concept_matches=st.session_state.concept_matches,
+                    source_embeddings=st.session_state.embeddings.get('source'),
+                    target_embeddings=st.session_state.embeddings.get('target'),
+                    source_inverse=st.session_state.embeddings.get('source_inverse'),
+                    target_inverse=st.session_state.embeddings.get('target_inverse'),
+                    model_path=st.session_state.embedding_model[0],
+                    backend=st.session_state.embedding_model[1],
+                    candidates=st.session_state.candidates,
+                    similarity_dtype=similarity_dtype,
+                    embedding_dtype=embedding_dtype,
+                    target_partitions=st.session_state.partitions[0] if st.session_state.partitions else None,
+                    partition_candidates=st.session_state.partitions[1] if st.session_state.partitions else None
                 )
 
                 if success:
                     st.session_state.session_saved = True
                     st.session_state.project_name = project_name
+                    # the session has its own copy of the matching job's arrays now
+                    if st.session_state.loaded_job_id is not None:
+                        get_job_runner().discard_result(st.session_state.loaded_job_id)
                     st.success(message)
                     st.info("Concept matches saved for HITL confirmation")
                     return True
@@ -227,30 +595,147 @@ def handle_session_save():
             except Exception as e:
                 st.error(f"Error while saving session: {e}")
                 return False
+def handle_session_update(backend="torch"):
+    """
+    Update an existing session in place rather than starting a new one, re-embedding and re-matching only what changed:
+    either move it onto a new release of its target vocabulary, or apply a re-pulled source extract
+
+    Args:
+        backend (str):
+            Inference backend for ModelHandler. Default is torch.
+
+    Returns:
+        bool:
+            Success state
+        Streamlit UI:
+            Session selector, uploader for the new target release or source extract, and an update report
+    """
+    success, sessions = list_saved_sessions()
+    if not success or not sessions:
+        st.info("No saved sessions to update.")
+        return False
+
+    selected_session = st.selectbox("Session to update", [s['session_name'] for s in sessions], key="update_session")
+    update_type = st.radio("Update with", ["New source extract", "New target release"], key="update_type", horizontal=True)
+    is_source = update_type == "New source extract"
+
+    label = "Source" if is_source else "Target"
+    uploaded_file = st.file_uploader(f"Upload new {label} Concepts CSV", type=['csv'], key="update_upload")
+    relationship_path = None
+    if not is_source:
+        relationship_path = st.text_input(
+            "Optional: path to Athena CONCEPT_RELATIONSHIP.csv, to follow 'Concept replaced by' for superseded targets",
+            key="update_relationship_path"
+        )
+
+    if uploaded_file is None or not st.button("Update Session"):
+        return False
+
+    read_success, new_table = read_and_validate_csv(uploaded_file, SourceConceptTable if is_source else TargetConceptTable)
+    if not read_success:
+        st.error(new_table)
+        return False
+
+    with st.spinner("Matching changed concepts..."):
+        load_success, session = load_session(selected_session)
+        if not load_success:
+            st.error(session)
+            return False
+
+        model_handler = ModelHandler(backend=backend, checkpoint_dir="checkpoints")
+        load_success, message = model_handler.load_model()
+        if not load_success:
+            st.error(f"Failed to load model: {message}")
+            return False
+
+        if is_source:
+            update_success, report = update_sources(session, new_table, model_handler)
+        else:
+            replacements = load_concept_replacements(relationship_path) if relationship_path else None
+            update_success, report = rematch_for_release(session, new_table, model_handler, replacements)
+
+    if not update_success:
+        st.error(report)
+        return False
+
+    if is_source:
+        st.success(f"Extract applied: {report['new_sources']} new source concepts matched, "
+                   f"{report['refreshed_counts']} counts refreshed, confirmations kept")
+    else:
+        st.success(f"Release applied: {report['added']} added, {report['changed']} renamed, {report['removed']} removed "
+                   f"target concepts; {report['embedded_targets']} embedded")
+        if report['flagged']:
+            st.warning(f"{len(report['flagged'])} confirmed mappings point at removed concepts and need review again")
+            st.dataframe(pd.DataFrame(report['flagged']))
+    return True
+
+def display_run_report():
+    """
+    Show how long each stage of the last matching run took, and its throughput, memory and bytes written
+
+    Returns:
+        Streamlit UI:
+            Collapsible panel with one row per stage
+    """
+    report = run_report(st.session_state.run_id)
+    if not report['stages']:
+        return
+
+    with st.expander(f"Run report ({report['total_seconds']:.1f}s, peak RSS {report['peak_rss_bytes'] / 2**20:.0f} MB)"):
+        st.dataframe(run_report_rows(report))
+
 def main():
     initialize_session_state()
+    configure_tracing(log_path=SPAN_LOG)
+    # spans from this rerun (e.g. the session save) belong to the last matching run
+    if st.session_state.run_id:
+        set_current_run(st.session_state.run_id)
     display_header()
 
     # upload source and target files
     handle_file_upload('source')
     handle_file_upload('target')
+    handle_multi_target_upload()
+    handle_pack_selection()
 
     # Generate similarities if both files are loaded
+    backend = None
     if st.session_state.source_table is not None and st.session_state.target_table is not None:
         st.divider()
         st.subheader("Generate Concept Similarities")
 
+        backend = select_backend()
+
+        hierarchy = select_hierarchy()
+        reranker, rerank_budget = select_reranker() if hierarchy is None else (None, None)
+
         if st.button("Perform Concept Matching"):
-            perform_concept_matching()
-        elif st.session_state.similarities is not None:
+            st.session_state.run_id = start_run("auto-match")
+            if st.session_state.target_tables:
+                perform_multi_vocabulary_matching(backend)
+            elif hierarchy is None:
+                perform_concept_matching(backend, reranker, rerank_budget)
+            else:
+                perform_hierarchical_matching(backend, hierarchy)
+        elif st.session_state.concept_matches is not None:
             st.success("Similarity matrix and matches generated")
 
-    # Save session if similarities are generated
-    if st.session_state.similarities is not None and st.session_state.concept_matches is not None:
+    display_match_job()
+    if st.session_state.concept_matches is not None:
+        display_run_report()
+    with st.expander("Matching jobs"):
+        display_job_list()
+
+    # Save session if matches are generated
+    if st.session_state.concept_matches is not None:
         st.divider()
         st.subheader("Save Project Session")
         handle_session_save()
 
+    st.divider()
+    with st.expander("Update an existing session"):
+        handle_session_update(backend or select_backend(key="update_backend"))
+
     # Users can move onto next page to load session and perform matching
 if __name__ == "__main__":
     main()
\ No newline at end of file
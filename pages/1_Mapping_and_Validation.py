@@ -2,12 +2,17 @@ import streamlit as st
 import sys
 import os
 from datetime import datetime
-import json
 
 print("WARNING: Excessive directory traversal happening. Lawrence, avert your eyes.")
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-from src.session_utils import list_saved_sessions, load_session, ProjectSession
+from src.session_utils import (list_saved_sessions, load_session, top_alternatives, get_session_dir,
+                               load_session_embeddings, ProjectSession, SessionWriter)
+from src.match_utils import ModelHandler
+from src.blob_utils import table_hash
+from src.service_utils import TargetSearchIndex
 from src.data_utils import sort_concepts, filter_for_unconfirmed_mappings
+from src.multi_vocab_utils import partition_alternatives
+from src.trace_utils import configure_tracing, load_run_report, run_report_rows
 print("It's OK you can look now.")
 
 ### Streamlit page: Mapping / confirmation
@@ -15,6 +20,16 @@ print("It's OK you can look now.")
 ### 2) Display paginated mapping pairs with confirmation status
 ### 3) Allow target concept updates through dropdown selection and track metadata
 ### 4) Save updated mappings to JSON on confirmation
+### 5) Keep the global mapping index up to date, flagging collisions with other sessions
+### 6) Merge other reviewers' edits to the same session, flagging rows edited by two reviewers at once
+### 7) Show a row's top-N alternative targets on demand, read from the memory-mapped similarity matrix
+### 8) Free-text semantic search over the target vocabulary, to correct a mapping without scrolling the dropdown
+### 9) Saves are queued to a background writer per session, which coalesces rapid confirmations into one write
+### 10) Run report of the auto-match that produced the session
+
+# seconds a queued edit may wait for others to be written with it
+WRITE_INTERVAL = 1.0
+SPAN_LOG = "logs/spans.jsonl"
 
 def initialize_session_state():
     """
@@ -26,12 +41,24 @@ def initialize_session_state():
             current_session (ProjectSession): currently loaded session object
             page (int): current page number to track pagination
             modified_mappings (dict): dictionary that stores modified mapping state
+            mapping_collisions (list): confirmed source concepts mapped to a different target in another session
+            edit_conflicts (list): rows another reviewer changed first, so this reviewer's edit was not saved
+            alternatives_row (int): index of the row whose alternative targets are shown, if any
+            session_writer (SessionWriter): background writer saving the current session's edits
+            target_table_hash (str): content hash of the current session's target table, keying its search index
+            search_model (tuple): (model_path, backend) the current session was embedded with, for target search
     """
     session_states = {
         'session_loaded': False,
         'current_session': None,
         'page': 0,
         'modified_mappings': {},
+        'mapping_collisions': [],
+        'edit_conflicts': [],
+        'alternatives_row': None,
+        'session_writer': None,
+        'target_table_hash': None,
+        'search_model': None,
     }
 
     for key, default_value in session_states.items():
@@ -46,7 +73,8 @@ def load_mapping_session():
         bool:
             False if session loading fails or is not yet complete
         Session states:
-            Updates current_session (ProjectSession) on load, and session_loaded (bool) flag
+            Updates current_session (ProjectSession) on load, session_loaded (bool) flag, session_writer (SessionWriter)
+            target_table_hash (str) and search_model (tuple)
         Streamlit UI:
             Selectbox for choosing saved session
     """
@@ -72,7 +100,16 @@ def load_mapping_session():
             success, result = load_session(selected_session)
 
             if success:
+                # write out anything still queued for a previously loaded session
+                if st.session_state.session_writer is not None:
+                    st.session_state.session_writer.close()
                 st.session_state.current_session = result
+                st.session_state.session_writer = SessionWriter(result, interval=WRITE_INTERVAL)
+                st.session_state.target_table_hash = table_hash(result.target_table)
+                # sessions saved before the model was recorded were embedded with the default model on torch
+                metadata = next(session for session in sessions if session['session_name'] == selected_session)
+                st.session_state.search_model = (metadata.get('model_path') or ModelHandler().model_path,
+                                                 metadata.get('backend') or "torch")
                 st.session_state.session_loaded = True
                 st.rerun()
             else:
@@ -93,6 +130,7 @@ def create_concept_lookups(session):
             source_lookup (dict): Maps source_key to (concept_name, concept_count)
             target_lookup (dict): Maps concept_id to concept_name
             target_options (list): List of (concept_id, concept_name) tuples for dropdown options
+            source_rows (dict): Maps source_key to its row in the similarity matrix / candidates
     """
     source_lookup = {
         concept.source_key: (concept.concept_name, concept.concept_count)
@@ -106,7 +144,11 @@ def create_concept_lookups(session):
         (concept.concept_id, concept.concept_name)
         for concept in session.target_table.concepts
     ]
-    return source_lookup, target_lookup, target_options
+    source_rows = {
+        concept.source_key: row
+        for row, concept in enumerate(session.source_table.concepts)
+    }
+    return source_lookup, target_lookup, target_options, source_rows
 
 def setup_pagination(total_items, items_per_page=20):
     """
@@ -169,7 +211,7 @@ def display_headings():
         with headings[6]:
             st.write(f"")
 
-def display_mapping_row(idx, match, source_lookup, target_lookup, target_options):
+def display_mapping_row(idx, match, source_lookup, target_lookup, target_options, source_rows):
     """
     Creates and displays a single concept mapping row which includes source, target, score, confirmation status and dropdown selector for update.
 
@@ -184,12 +226,14 @@ def display_mapping_row(idx, match, source_lookup, target_lookup, target_options
             Dictionary mapping concept_id to target concept_name
         target_options (list):
             List of (concept_id, concept_name) tuples for target selection dropdown
+        source_rows (dict):
+            Dictionary mapping source_key to its row in the similarity matrix
 
     Returns:
         Session states:
-            Updates modified_mappings (dict) of modified target mappings
+            Updates modified_mappings (dict) of modified target mappings, and alternatives_row (int)
         Streamlit UI:
-            Container with 5 columns per mapping row
+            Container with 5 columns per mapping row, and the row's alternatives when requested
     """
     with st.container():
         cols = st.columns([1, 3, 3, 1, 1, 3, 1])
@@ -203,7 +247,10 @@ def display_mapping_row(idx, match, source_lookup, target_lookup, target_options
         with cols[2]:
             st.write(f"{target_lookup[match.target_concept_id]}")
         with cols[3]:
-            st.write(f"{match.similarity_score:.2f}")
+            # reviewer-chosen and carried-over targets have no model score
+            st.write(f"{match.similarity_score:.2f}" if match.similarity_score is not None else "—")
+            if match.rerank_score is not None:
+                st.caption(f"re-rank {match.rerank_score:.2f}")
         with cols[4]:
             st.write(f"{match.confirmation_status}")
         with cols[5]:
@@ -234,6 +281,150 @@ def display_mapping_row(idx, match, source_lookup, target_lookup, target_options
                     st.rerun()
                 else:
                     st.error(message)
+            if st.button("Top N", key=f"alternatives_{idx}"):
+                st.session_state.alternatives_row = None if st.session_state.alternatives_row == idx else idx
+                st.rerun()
+
+    if st.session_state.alternatives_row == idx:
+        display_alternatives(idx, match, source_rows, target_lookup)
+
+@st.cache_resource(max_entries=2, show_spinner="Loading model for target search...")
+def get_search_model(model_path, backend):
+    """
+    Resident model for free-text target search, loaded once per model and backend and shared by every session
+    embedded with them
+
+    Args:
+        model_path (str):
+            Model the session's embeddings were made with
+        backend (str):
+            Inference backend they were made with; query embeddings must come from the same one to compare
+
+    Returns:
+        ModelHandler:
+            Loaded model handler
+    """
+    model_handler = ModelHandler(model_path, backend=backend)
+    load_success, message = model_handler.load_model()
+    if not load_success:
+        # raised rather than returned, so a failed load is not cached
+        raise RuntimeError(message)
+    return model_handler
+
+@st.cache_resource(max_entries=4, show_spinner="Building target search index...")
+def get_target_search_index(target_hash, search_model, _target_table, _session_dir):
+    """
+    Target embedding index for free-text search, built once per distinct target table and model
+
+    Args:
+        target_hash (str):
+            Content hash of the target table (see src/blob_utils.py), so sessions on the same release share an index
+        search_model (tuple):
+            (model_path, backend) of get_search_model
+        _target_table (TargetConceptTable):
+            Target table to search, not hashed by the cache
+        _session_dir (str):
+            Directory of the loaded session, used to find its saved target embeddings
+
+    Returns:
+        TargetSearchIndex:
+            Search index; raises RuntimeError if the model could not be loaded
+    """
+    model_handler = get_search_model(*search_model)
+
+    # reuse the session's saved target embeddings when they line up with its target table
+    _, target_embeddings = load_session_embeddings(_session_dir)
+    if target_embeddings is not None and len(target_embeddings) != len(_target_table.concepts):
+        target_embeddings = None
+    return TargetSearchIndex(model_handler, _target_table, target_embeddings)
+
+def display_target_search(idx, match):
+    """
+    Search box for finding a target concept by meaning rather than by scrolling the dropdown
+
+    Args:
+        idx (int):
+            Index of the mapping row
+        match (ConceptMatch):
+            Concept match being corrected
+
+    Returns:
+        Streamlit UI:
+            Text input for the query, then one line per hit with its score and a button to select it
+    """
+    query = st.text_input("Search targets", key=f"search_{idx}", placeholder="e.g. dalteparin 5000 unit injection")
+    if not query:
+        return
+
+    session = st.session_state.current_session
+    try:
+        search_index = get_target_search_index(st.session_state.target_table_hash, st.session_state.search_model,
+                                               session.target_table, get_session_dir(session))
+    except RuntimeError as e:
+        st.error(f"Failed to load model: {e}")
+        return
+
+    for rank, (concept_id, concept_name, score) in enumerate(search_index.search(query)):
+        cols = st.columns([1, 3, 3, 1, 1, 3, 1])
+        with cols[2]:
+            st.write(f"{concept_name}")
+        with cols[3]:
+            st.write(f"{score:.2f}")
+        with cols[5]:
+            st.button("Use", key=f"use_search_{idx}_{rank}", disabled=concept_id == match.target_concept_id,
+                      on_click=select_alternative, args=(idx, (concept_id, concept_name)))
+
+def select_alternative(idx, option):
+    # widget state can only be set before the widget is drawn, hence a button callback
+    st.session_state[f"select_{idx}"] = option
+    st.session_state.modified_mappings[idx] = option[0]
+
+def display_alternatives(idx, match, source_rows, target_lookup, n=10):
+    """
+    Show the best n target concepts for a single mapping row. Only that row of the similarity matrix is read from disk.
+
+    Args:
+        idx (int):
+            Index of the mapping row
+        match (ConceptMatch):
+            Concept match the alternatives are for
+        source_rows (dict):
+            Dictionary mapping source_key to its row in the similarity matrix
+        target_lookup (dict):
+            Dictionary mapping concept_id to target concept_name
+        n (int):
+            Number of alternatives to show. Default as 10
+
+    Returns:
+        Streamlit UI:
+            One line per alternative with its score, and a button to select it as the new target.
+            Multi-vocabulary sessions also get a selectbox to pick the target vocabulary.
+            Followed by a free-text target search box.
+    """
+    session = st.session_state.current_session
+    if session.partition_candidates:
+        # multi-vocabulary sessions: alternatives within one target vocabulary at a time
+        label = st.selectbox("Target vocabulary", ["All"] + list(session.partition_candidates), key=f"vocabulary_{idx}")
+        if label != "All":
+            alternatives = partition_alternatives(session, source_rows[match.source_key], label, n)
+        else:
+            alternatives = top_alternatives(session, source_rows[match.source_key], n)
+    else:
+        alternatives = top_alternatives(session, source_rows[match.source_key], n)
+    if not alternatives:
+        st.info("No similarity scores saved with this session.")
+
+    for rank, (concept_id, score) in enumerate(alternatives):
+        cols = st.columns([1, 3, 3, 1, 1, 3, 1])
+        with cols[2]:
+            st.write(f"{target_lookup.get(concept_id, concept_id)}")
+        with cols[3]:
+            st.write(f"{score:.2f}")
+        with cols[5]:
+            st.button("Use", key=f"use_{idx}_{rank}", disabled=concept_id == match.target_concept_id,
+                      on_click=select_alternative, args=(idx, (concept_id, target_lookup.get(concept_id, ""))))
+
+    display_target_search(idx, match)
 
 def handle_navigation(total_pages):
     """
@@ -311,6 +502,7 @@ def save_confirmed_mappings(session, start_idx, end_idx):
             confirmation_status is set to True, and timestamp added.
     """
     try:
+        updated = []
         for idx, match in enumerate(session.concept_matches):
 
             # If idx has been updated it is in modified_mappings state -> update the target_concept_id in project session to match
@@ -319,13 +511,14 @@ def save_confirmed_mappings(session, start_idx, end_idx):
                     match.confirmation_status = "True"
                 else:
                     match.target_concept_id = st.session_state.modified_mappings[idx] # align to whichever new concept
-                    match.similarity_score = -1.0
+                    match.similarity_score = None
                     match.confirmation_status = "Rejected" if match.target_concept_id == 0 else "True" # handle where user selects 'no match''
 
                 # logic to separate timestamps
                 if match.first_confirmation_timestamp is None:
                     match.first_confirmation_timestamp = datetime.now()
                 match.last_update_timestamp = datetime.now()
+                updated.append(match)
 
             # if there are unconfirmed matches on current page that are NOT modified (i.e. No Change by default), these can be confirmed
             elif start_idx <= idx < end_idx and match.confirmation_status != "Rejected":
@@ -333,32 +526,15 @@ def save_confirmed_mappings(session, start_idx, end_idx):
                 if match.first_confirmation_timestamp is None:
                     match.first_confirmation_timestamp = datetime.now()
                 match.last_update_timestamp = datetime.now()
+                updated.append(match)
 
-        # Prepare and save JSON
-        session_dir = f"sessions/{session.project_name}_{session.timestamp}"
-        matches_path = f"{session_dir}/concept_matches.json"
-
-        matches_json = [
-            {
-                "source_key": match.source_key,
-                "target_concept_id": match.target_concept_id,
-                "similarity_score": (f"{float(match.similarity_score):.2f}"),
-                "confirmation_status": match.confirmation_status,
-                "first_confirmation_timestamp": (match.first_confirmation_timestamp.isoformat()
-                                            if match.first_confirmation_timestamp else None),
-                "last_update_timestamp": (match.last_update_timestamp.isoformat()
-                                      if match.last_update_timestamp else None)
-            }
-            for match in session.concept_matches
-        ]
-
-        with open(matches_path, 'w') as f:
-            json.dump(matches_json, f, indent=2)
+        # Save changed rows only
+        success, message = commit_updates(session, updated)
 
         # clean up all modified mappings
         st.session_state.modified_mappings = {}
 
-        return True, "Mappings saved successfully"
+        return success, message
 
     except Exception as e:
         return False, f"Failed to save matches: {e}"
@@ -386,7 +562,7 @@ def save_single_mapping(session, row_idx):
         # for particular row id only, swap in from modified_mappings, and clear entry
         if row_idx in st.session_state.modified_mappings:
             single_match.target_concept_id = st.session_state.modified_mappings[row_idx]
-            single_match.similarity_score = -1.0
+            single_match.similarity_score = None
             del st.session_state.modified_mappings[row_idx]
             # if the target concept is 'no matching' then confirmation status should be "Rejected"
             single_match.confirmation_status = "Rejected" if single_match.target_concept_id == 0 else "True"
@@ -397,28 +573,7 @@ def save_single_mapping(session, row_idx):
             single_match.first_confirmation_timestamp = datetime.now()
         single_match.last_update_timestamp = datetime.now()
 
-        session_dir = f"sessions/{session.project_name}_{session.timestamp}"
-        matches_path = f"{session_dir}/concept_matches.json"
-
-        # even though we have updated only a single mapping, we still dump the entire object as json
-        matches_json = [
-            {
-                "source_key": match.source_key,
-                "target_concept_id": match.target_concept_id,
-                "similarity_score": (f"{float(match.similarity_score):.2f}"),
-                "confirmation_status": match.confirmation_status,
-                "first_confirmation_timestamp": (match.first_confirmation_timestamp.isoformat()
-                                            if match.first_confirmation_timestamp else None),
-                "last_update_timestamp": (match.last_update_timestamp.isoformat()
-                                      if match.last_update_timestamp else None)
-            }
-            for match in session.concept_matches
-        ]
-
-        with open(matches_path, 'w') as f:
-            json.dump(matches_json, f, indent=2)
-
-        return True, "Row confirmed successfully"
+        return commit_updates(session, [single_match])
 
     except Exception as e:
         return False, f"Failed to save match: {e}"
@@ -443,46 +598,152 @@ def reject_unconfirmed_mappings(session, start_idx, end_idx):
             confirmation_status is set to Rejected, and timestamp added.
     """
     try:
+        updated = []
         for idx in range(start_idx, end_idx):
             match = session.concept_matches[idx]
             # reject any unconfirmed mappings
             if match.confirmation_status != "True":
                 match.target_concept_id = 0
-                match.similarity_score = -1.0
+                match.similarity_score = None
                 match.confirmation_status = "Rejected"
                 if match.first_confirmation_timestamp is None:
                     match.first_confirmation_timestamp = datetime.now()
                 match.last_update_timestamp = datetime.now()
+                updated.append(match)
 
-        # Prepare and save JSON
-        session_dir = f"sessions/{session.project_name}_{session.timestamp}"
-        matches_path = f"{session_dir}/concept_matches.json"
-
-        matches_json = [
-            {
-                "source_key": match.source_key,
-                "target_concept_id": match.target_concept_id,
-                "similarity_score": (f"{float(match.similarity_score):.2f}"),
-                "confirmation_status": match.confirmation_status,
-                "first_confirmation_timestamp": (match.first_confirmation_timestamp.isoformat()
-                                            if match.first_confirmation_timestamp else None),
-                "last_update_timestamp": (match.last_update_timestamp.isoformat()
-                                      if match.last_update_timestamp else None)
-            }
-            for match in session.concept_matches
-        ]
-
-        with open(matches_path, 'w') as f:
-            json.dump(matches_json, f, indent=2)
+        # Save changed rows only
+        success, message = commit_updates(session, updated)
 
         # clean up all modified mappings
         st.session_state.modified_mappings = {}
 
-        return True, "Mappings saved successfully"
+        return success, message
 
     except Exception as e:
         return False, f"Failed to save matches: {e}"
 
+def commit_updates(session, matches):
+    """
+    Queue edited rows for the session's background writer, which saves them to the session journal, merges in other
+    reviewers' edits and records them in the mapping index
+
+    Args:
+        session (ProjectSession):
+            Project session the matches belong to
+        matches (list):
+            ConceptMatch objects edited by this reviewer
+
+    Returns:
+        tuple:
+            success (bool), message (str)
+    """
+    writer = st.session_state.session_writer
+    if writer is None or writer.session is not session:
+        return False, "No background writer for this session. Please reload the session."
+
+    writer.submit(matches)
+    return True, f"Queued {len(matches)} mappings for saving"
+
+def collect_writer_messages(writer):
+    """
+    Pick up what the background writer reported since the last rerun
+
+    Args:
+        writer (SessionWriter):
+            Background writer of the current session
+
+    Returns:
+        Session states:
+            edit_conflicts (list) is extended with rows another reviewer changed first
+            mapping_collisions (list) is extended with source concepts another session maps to a different target
+        Streamlit UI:
+            Error for each failed write
+    """
+    conflicts, collisions, errors = writer.drain_messages()
+    st.session_state.edit_conflicts.extend(conflicts)
+    st.session_state.mapping_collisions.extend(collisions)
+    for error in errors:
+        st.error(error)
+
+def display_write_status(writer):
+    """
+    Show whether every edit is on disk, and how far behind the background writer is
+
+    Args:
+        writer (SessionWriter):
+            Background writer of the current session
+
+    Returns:
+        Streamlit UI:
+            Caption with pending edits and write lag, and a button to save immediately
+    """
+    status = writer.status()
+    if status['pending']:
+        col1, col2 = st.columns([6, 1])
+        col1.caption(f"Saving {status['pending']} edits... (waiting {status['lag']:.1f}s)")
+        if col2.button("Save now", key="flush_writer"):
+            writer.flush(timeout=30)
+            st.rerun()
+    elif status['writes']:
+        st.caption(f"All edits saved. Last write took {status['last_write_seconds']:.2f}s, "
+                   f"{status['last_write_lag']:.1f}s after the first edit it included.")
+
+def display_collisions():
+    """
+    Warn about confirmed mappings that collide with another session, which would otherwise only surface at OMOP conversion
+
+    Returns:
+        Streamlit UI:
+            Warning with a table of collisions, and a button to dismiss it
+    """
+    if not st.session_state.mapping_collisions:
+        return
+
+    st.warning(f"{len(st.session_state.mapping_collisions)} confirmed mappings conflict with other sessions. "
+               "Each source concept can only map to one target concept at OMOP conversion.")
+    st.dataframe(st.session_state.mapping_collisions)
+    if st.button("Dismiss", key="dismiss_collisions"):
+        st.session_state.mapping_collisions = []
+        st.rerun()
+
+def display_conflicts():
+    """
+    Show rows whose edit was not saved because another reviewer changed them first. Their version is now displayed.
+
+    Returns:
+        Streamlit UI:
+            Warning with a table of conflicting rows, and a button to dismiss it
+    """
+    if not st.session_state.edit_conflicts:
+        return
+
+    st.warning(f"{len(st.session_state.edit_conflicts)} of your edits were not saved, as another reviewer changed "
+               "the same rows first. Their versions are shown below; confirm again to override.")
+    st.dataframe(st.session_state.edit_conflicts)
+    if st.button("Dismiss", key="dismiss_conflicts"):
+        st.session_state.edit_conflicts = []
+        st.rerun()
+
+def display_run_report(session):
+    """
+    Show the saved timings of the auto-match run that produced this session, if it was saved with one
+
+    Args:
+        session (ProjectSession):
+            Currently loaded session
+
+    Returns:
+        Streamlit UI:
+            Collapsible panel with one row per stage
+    """
+    report = load_run_report(f"{get_session_dir(session)}/run_report.json")
+    if not report or not report['stages']:
+        return
+
+    with st.expander(f"Auto-match run report ({report['total_seconds']:.1f}s, "
+                     f"peak RSS {report['peak_rss_bytes'] / 2**20:.0f} MB)"):
+        st.dataframe(run_report_rows(report))
+
 def display_sort_options(concept_matches, source_lookup):
     """
     Display sorting and filtering options, returning the sorted and (optionally) filtered list of concept matches.
@@ -493,7 +754,8 @@ def display_sort_options(concept_matches, source_lookup):
     # Sorting dropdown
     sort_option = st.selectbox(
         "Sort mappings by",
-        ["None", "Alphabetical (A-Z)", "Alphabetical (Z-A)", "Highest Confidence", "Lowest Confidence"],
+        ["None", "Alphabetical (A-Z)", "Alphabetical (Z-A)", "Highest Confidence", "Lowest Confidence",
+         "Highest Re-rank Score", "Lowest Re-rank Score"],
         key="sort_option"
     )
 
@@ -515,12 +777,27 @@ def main():
 
     st.title("Validate Mappings")
     initialize_session_state()
+    configure_tracing(log_path=SPAN_LOG)
 
     if not st.session_state.session_loaded:
         return load_mapping_session()
 
     session = st.session_state.current_session
-    source_lookup, target_lookup, target_options = create_concept_lookups(session)
+    writer = st.session_state.session_writer
+    if writer is None or writer.session is not session:
+        # write out and stop the writer of the copy this one replaces
+        if writer is not None:
+            writer.close()
+        writer = st.session_state.session_writer = SessionWriter(session, interval=WRITE_INTERVAL)
+    # pick up other reviewers' edits, and the writer's results, on every rerun
+    writer.sync()
+    collect_writer_messages(writer)
+    source_lookup, target_lookup, target_options, source_rows = create_concept_lookups(session)
+
+    display_write_status(writer)
+    display_run_report(session)
+    display_conflicts()
+    display_collisions()
     
     # Apply filtering & sorting BEFORE pagination
     filtered_and_sorted_concept_matches = display_sort_options(session.concept_matches, source_lookup)
@@ -533,7 +810,7 @@ def main():
 
     for idx, match in enumerate(filtered_and_sorted_concept_matches[start_idx:end_idx]):
         global_idx = start_idx + idx
-        display_mapping_row(global_idx, match, source_lookup, target_lookup, target_options)
+        display_mapping_row(global_idx, match, source_lookup, target_lookup, target_options, source_rows)
 
     # Handle navigation and saving
     confirm_clicked, reject_clicked = handle_navigation(total_pages)
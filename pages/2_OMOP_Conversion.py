@@ -4,10 +4,14 @@ import os
 
 print("WARNING: Excessive directory traversal happening. Lawrence, avert your eyes.")
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-from src.session_utils import list_saved_sessions, load_session
-from src.omop_utils import (is_fully_mapped, assign_concept_ids, generate_concept_table, generate_relationship_table, save_tables)
+from src.session_utils import list_saved_sessions
+from src.omop_utils import (load_session_exports, assign_concept_ids, generate_concept_table, generate_relationship_table, save_tables)
+from src.trace_utils import configure_tracing, run_report_rows, save_run_report, start_run
 print("It's OK you can look now.")
 
+# stage spans of every run are appended here as JSON lines
+SPAN_LOG = "logs/spans.jsonl"
+
 def display_header():
     """
     Display page title and usage guide in expander panel
@@ -24,22 +28,38 @@ def display_header():
                  1) Review list of sessions that are completely mapped
                  2) Turn all sessions into OMOP CONCEPT and CONCEPT_RELATIONSHIP tables
                  3) Uses timestamp ordering of first mapping to ensure incremental source concept_ids that remain consistent across generations
+                 4) Sessions that share a source or target table load it once, from the shared table store
+                 5) Sessions are loaded in parallel; IDs and row order are the same as converting them one by one
                  ''')
     st.divider()
 
+def display_run_report(report):
+    """
+    Show how long each conversion stage took
+
+    Args:
+        report (dict):
+            Run report of the conversion, from src.trace_utils
+
+    Returns:
+        Streamlit UI:
+            Collapsible panel with one row per stage
+    """
+    with st.expander(f"Run report ({report['total_seconds']:.1f}s, peak RSS {report['peak_rss_bytes'] / 2**20:.0f} MB)"):
+        st.dataframe(run_report_rows(report))
+
 def main():
     display_header()
+    configure_tracing(log_path=SPAN_LOG)
 
     success, sessions = list_saved_sessions()
     if not success:
         st.error("Failed to list sessions")
         return
 
-    mapped_sessions = []
-    for session_info in sessions:
-        success, session = load_session(session_info['session_name'])
-        if success and is_fully_mapped(session.concept_matches):
-            mapped_sessions.append(session)
+    # sessions are loaded in parallel worker processes, and come back in listing order
+    exports = load_session_exports([session_info['session_name'] for session_info in sessions])
+    mapped_sessions = [export for success, export in exports if success and export.fully_mapped]
 
     if not mapped_sessions:
         st.warning("No fully mapped sessions found. Please complete concept mapping first.")
@@ -48,14 +68,15 @@ def main():
     st.subheader("Completed Sessions")
     st.write("All concepts in these sessions are either mapped or rejected:")
     for session in mapped_sessions:
-        confirmed_count = sum(1 for match in session.concept_matches if match.confirmation_status == "True")
-        total_count = len(session.concept_matches)
+        confirmed_count = session.confirmed
+        total_count = len(session.matches)
         diff = int(total_count - confirmed_count)
         st.write(f"- {session.project_name} ({session.timestamp}), Mapped: {confirmed_count}, Rejected: {diff}")
 
     st.divider()
 
     if st.button("Generate OMOP Vocab Tables"):
+        start_run("omop-conversion")
         try:
             # generate concept ids
             source_key_to_id = assign_concept_ids(mapped_sessions)
@@ -67,10 +88,12 @@ def main():
 
             # save files
             save_tables(concept_rows, relationship_rows, output_dir)
+            report = save_run_report(f"{output_dir}/run_report.json")
 
             st.success("OMOP tables generatedL")
             st.write(f"{output_dir}/CONCEPT.csv")
             st.write(f"{output_dir}/CONCEPT_RELATIONSHIP.csv")
+            display_run_report(report)
 
         except Exception as e:
             st.error(f"Error during OMOP conversion: {e}")
@@ -0,0 +1,24 @@
+import numpy as np
+
+## numpy-only array helpers shared by matching, quantized storage, packs and updates. Kept apart from
+## match_utils so modules that only score stored embeddings (e.g. session_utils via quant_utils) don't import torch.
+
+
+def normalize_rows(embeddings):
+    """
+    L2 normalise embeddings, so that cosine similarity is a dot product
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def top_k_indices(scores, k):
+    """
+    Column indices and values of the k highest scores in each row, best first
+    """
+    k = min(k, scores.shape[1])
+    top_k = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top_k, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(top_k, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+from dataclasses import astuple
+import hashlib
+import os
+import pickle
+import threading
+import weakref
+
+## Shared table store: sessions reference their source and target concept tables by content hash, and each
+## distinct table is pickled once, as <sessions_dir>/blobs/<hash>.pkl, however many sessions use it.
+## Loaded tables are cached in-process by hash, so sessions built on the same vocabulary share one copy in memory
+## and page reruns do not unpickle it again: the most recently used tables are kept, and older ones for as long
+## as any session still holds them. Tables from the store are shared: copy one before changing it.
+
+BLOB_DIRNAME = "blobs"
+CACHE_SIZE = 8
+
+_cache = weakref.WeakValueDictionary()
+_recent = OrderedDict()
+_cache_lock = threading.Lock()
+_load_locks = {}
+
+
+def table_hash(table):
+    """
+    Stable content hash of a concept table (its class and every concept's fields, in order)
+    """
+    hash_obj = hashlib.sha256(type(table).__name__.encode())
+    for concept in table.concepts:
+        hash_obj.update(b"\x1e")
+        hash_obj.update("\x1f".join(str(value) for value in astuple(concept)).encode())
+    return hash_obj.hexdigest()
+
+
+def blob_path(content_hash, sessions_dir="sessions"):
+    return f"{sessions_dir}/{BLOB_DIRNAME}/{content_hash}.pkl"
+
+
+def store_table(table, sessions_dir="sessions"):
+    """
+    Pickle a table into the store unless an identical one is already there; returns its content hash
+    """
+    content_hash = table_hash(table)
+    path = blob_path(content_hash, sessions_dir)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a unique name and renamed, so concurrent writers of the same table never clash
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    return content_hash
+
+
+def load_table(content_hash, sessions_dir="sessions"):
+    """
+    The table stored under a content hash, unpickled at most once while it stays in use in this process
+    """
+    with _cache_lock:
+        table = _cache.get(content_hash)
+        if table is not None:
+            _keep_recent(content_hash, table)
+            return table
+        load_lock = _load_locks.setdefault(content_hash, threading.Lock())
+
+    # sessions loading the same table at once wait for the first load instead of repeating it
+    with load_lock:
+        table = _cache.get(content_hash)
+        if table is None:
+            with open(blob_path(content_hash, sessions_dir), 'rb') as f:
+                table = pickle.load(f)
+            with _cache_lock:
+                _cache[content_hash] = table
+                _keep_recent(content_hash, table)
+    return table
+
+
+def _keep_recent(content_hash, table):
+    _recent[content_hash] = table
+    _recent.move_to_end(content_hash)
+    while len(_recent) > CACHE_SIZE:
+        _recent.popitem(last=False)
+
+
+def cached_tables():
+    """
+    Content hashes of the tables currently held in the in-process cache
+    """
+    with _cache_lock:
+        return list(_cache.keys())
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+        _recent.clear()
@@ -0,0 +1,206 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import numpy as np
+
+## Resumable runs: each run writes completed work units (embedding shards, similarity blocks)
+## into a directory named by a hash of its inputs, and records them in manifest.json.
+## A re-run with the same inputs finds the same directory and skips completed units.
+## Only the KEEP_RUNS most recently active runs of each kind are kept, and a run whose output has been consumed
+## (e.g. saved with a session) is discarded straight away, so full similarity matrices do not pile up.
+## A run in use holds a shared lock on its run.lock (released when its RunCheckpoint is released or collected),
+## and older runs are only deleted when finished or untouched for STALE_SECONDS, and nobody holds them.
+
+KEEP_RUNS = 2
+STALE_SECONDS = 24 * 3600
+RUN_LOCK = "run.lock"
+
+
+def hash_texts(texts):
+    """
+    Stable content hash of an ordered list of texts
+    """
+    hash_obj = hashlib.sha256()
+    for text in texts:
+        hash_obj.update(str(text).encode())
+        hash_obj.update(b"\x1f")
+    return hash_obj.hexdigest()
+
+
+def hash_arrays(*arrays):
+    """
+    Stable content hash of numpy arrays (shape, dtype and data)
+    """
+    hash_obj = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        hash_obj.update(f"{array.shape}{array.dtype}".encode())
+        hash_obj.update(array.tobytes())
+    return hash_obj.hexdigest()
+
+
+def list_runs(checkpoint_dir, kind):
+    """
+    Run directories of one kind, most recently active (manifest last written) first
+    """
+    kind_dir = os.path.join(checkpoint_dir, kind)
+    if not os.path.isdir(kind_dir):
+        return []
+    runs = [os.path.join(kind_dir, name) for name in os.listdir(kind_dir)
+            if os.path.exists(os.path.join(kind_dir, name, "manifest.json"))]
+    return sorted(runs, key=lambda run_dir: os.path.getmtime(os.path.join(run_dir, "manifest.json")), reverse=True)
+
+
+def hold_run(run_dir):
+    """
+    Open a run directory for use: returns its run.lock, held with a shared lock until closed
+    """
+    while True:
+        os.makedirs(run_dir, exist_ok=True)
+        try:
+            lock_file = open(os.path.join(run_dir, RUN_LOCK), 'a')
+        except FileNotFoundError:
+            continue
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        try:
+            if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_file.name).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        # the run was deleted while we waited for the lock: start it afresh
+        lock_file.close()
+
+
+def discard_run(run_dir, stale_seconds=None):
+    """
+    Delete a run's directory unless someone holds it (see hold_run); with stale_seconds, only if it is also
+    finished or untouched for that long. Arrays already memory-mapped from it stay readable until released
+    Returns whether it was deleted
+    """
+    try:
+        lock_file = open(os.path.join(run_dir, RUN_LOCK), 'a')
+    except FileNotFoundError:
+        return False
+    with lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        if stale_seconds is not None:
+            manifest_path = os.path.join(run_dir, "manifest.json")
+            try:
+                with open(manifest_path, 'r') as f:
+                    finished = json.load(f).get('finished', False)
+                idle = time.time() - os.path.getmtime(manifest_path)
+            except FileNotFoundError:
+                finished, idle = True, 0.0
+            if not finished and idle < stale_seconds:
+                return False
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return True
+
+
+def prune_runs(checkpoint_dir, kind, keep=KEEP_RUNS, current=None, stale_seconds=STALE_SECONDS):
+    """
+    Delete runs of a kind beyond the keep most recently active (counting current, which is never deleted),
+    skipping runs still in use: held by a running handler, or unfinished and touched within stale_seconds
+    Returns the deleted run directories
+    """
+    others = [run_dir for run_dir in list_runs(checkpoint_dir, kind) if run_dir != current]
+    removed = []
+    for run_dir in others[max(keep - (current is not None), 0):]:
+        if discard_run(run_dir, stale_seconds):
+            removed.append(run_dir)
+            print(f"[INFO] Removed old checkpoint run {run_dir}")
+    return removed
+
+
+def write_json_atomic(path, data, indent=2):
+    """
+    Write JSON via a temporary file and rename, so readers and crashes never see a half-written file
+    """
+    # unique per writer, so concurrent writers of the same file never write into one temporary file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=indent)
+    os.replace(tmp_path, path)
+
+
+class RunCheckpoint:
+    def __init__(self, run_dir, manifest, lock_file=None):
+        self.run_dir = run_dir
+        self.manifest = manifest
+        self.completed = set(manifest['completed'])
+        self.lock_file = lock_file
+
+    @classmethod
+    def for_run(cls, checkpoint_dir, kind, params, keep=KEEP_RUNS):
+        """
+        Open the checkpoint for a run, resuming it if a run with identical params was started before
+        The run is held (see hold_run) until release(); older finished runs beyond the keep most recent are deleted
+        """
+        run_key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+        run_dir = os.path.join(checkpoint_dir, kind, run_key)
+        manifest_path = os.path.join(run_dir, "manifest.json")
+        lock_file = hold_run(run_dir)
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            print(f"[INFO] Resuming {kind} run {run_key}: {len(manifest['completed'])} units already complete")
+        else:
+            manifest = {
+                'kind': kind,
+                'run_key': run_key,
+                'params': params,
+                'completed': []
+            }
+            write_json_atomic(manifest_path, manifest)
+
+        prune_runs(checkpoint_dir, kind, keep, current=run_dir)
+        return cls(run_dir, manifest, lock_file)
+
+    def finish(self):
+        """
+        Record that every unit is done, so the run may be pruned once nobody holds it
+        """
+        self.manifest['finished'] = True
+        write_json_atomic(self.path("manifest.json"), self.manifest)
+
+    def release(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def discard(self):
+        """
+        Release the run and delete it, unless another handler still holds it
+        """
+        self.release()
+        return discard_run(self.run_dir)
+
+    def path(self, filename):
+        return os.path.join(self.run_dir, filename)
+
+    def is_complete(self, unit):
+        return unit in self.completed
+
+    def mark_complete(self, unit):
+        """
+        Record a unit as done; only call once its output is fully on disk
+        """
+        self.completed.add(unit)
+        self.manifest['completed'] = sorted(self.completed)
+        write_json_atomic(self.path("manifest.json"), self.manifest)
+
+    def save_array(self, filename, array):
+        """
+        Save an array via a temporary file and rename, so a shard on disk is always complete
+        """
+        tmp_path = self.path(f"{filename}.tmp.npy")
+        np.save(tmp_path, array)
+        os.replace(tmp_path, self.path(filename))
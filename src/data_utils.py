@@ -1,21 +1,44 @@
 from dataclasses import dataclass
 import hashlib
+import numpy as np
 import pandas as pd
 from datetime import datetime
 
 ## TO DO
 ## Add docstrings
 
-def generate_source_key(concept_code, concept_name, vocabulary_id):
+# Source keys are 63 bit (they fit an int64): key % LEGACY_KEY_SPACE is the 9 digit key earlier versions gave the
+# same concept, from the first 8 bytes of its hash, and the next 8 bytes widen it
+LEGACY_KEY_SPACE = 10**9
+KEY_HIGH_SPACE = (2**63 - 1) // LEGACY_KEY_SPACE
+
+def source_key_string(concept_code, concept_name, vocabulary_id, salt=0):
+    concat_string = f"{concept_code}_{concept_name}_{vocabulary_id}"
+    return f"{concat_string}\x1f{salt}" if salt else concat_string
+
+def generate_source_key(concept_code, concept_name, vocabulary_id, salt=0):
     """
     Each distinct source concept is given a 'source_key' as a unique identifier
     This is used to track concepts during mapping
+    A non-zero salt gives an alternative key, for concepts whose key is already taken (see SourceKeyRegistry)
     """
-    concat_string = f"{concept_code}_{concept_name}_{vocabulary_id}"
-    hash_obj = hashlib.sha256(concat_string.encode())
-    # Get first 8 bytes of hash, modulo to 9 digit key
-    hash_int = int.from_bytes(hash_obj.digest()[:8], 'big')
-    return hash_int % 1000000000
+    digest = hashlib.sha256(source_key_string(concept_code, concept_name, vocabulary_id, salt).encode()).digest()
+    low = int.from_bytes(digest[:8], 'big')
+    high = int.from_bytes(digest[8:16], 'big')
+    return (high % KEY_HIGH_SPACE) * LEGACY_KEY_SPACE + low % LEGACY_KEY_SPACE
+
+def generate_source_keys(concept_codes, concept_names, vocabulary_ids):
+    """
+    generate_source_key over whole columns, as an int64 array
+    """
+    digests = b"".join(
+        hashlib.sha256(source_key_string(code, name, vocabulary_id).encode()).digest()
+        for code, name, vocabulary_id in zip(concept_codes, concept_names, vocabulary_ids)
+    )
+    words = np.frombuffer(digests, dtype=">u8").reshape(-1, 4)
+    high = (words[:, 1] % np.uint64(KEY_HIGH_SPACE)).astype(np.int64)
+    low = (words[:, 0] % np.uint64(LEGACY_KEY_SPACE)).astype(np.int64)
+    return high * LEGACY_KEY_SPACE + low
 
 @dataclass
 class SourceConcept:
@@ -54,19 +77,28 @@ class SourceConceptTable:
             return False, f"Missing required columns. Expected: {SourceConceptTable.source_columns}"
 
         try:
-            valid_concepts = []
+            # column at a time rather than row at a time, with source keys hashed in one batch
+            codes = [str(value) for value in df['source_concept_code']]
+            names = [str(value) for value in df['source_concept_name']]
+            vocabularies = [str(value) for value in df['source_vocabulary_id']]
+            counts = []
             errors = []
 
-            for idx, row in df.iterrows():
+            for idx, value in df['source_concept_count'].items():
                 try:
-                    concept = SourceConcept.from_row(row)
-                    valid_concepts.append(concept)
+                    counts.append(int(value))
                 except ValueError as e:
-                    errors.append(f"Row {idx}: {e}")
+                    errors.append(f"Row {idx}: Type conversion failed: {e}")
 
             if errors:
                 return False, f"confirmation errors: " + "\n".join(errors)
 
+            keys = generate_source_keys(codes, names, vocabularies).tolist()
+            valid_concepts = [
+                SourceConcept(source_key=key, concept_code=code, concept_name=name, vocabulary_id=vocabulary_id,
+                              concept_count=count)
+                for key, code, name, vocabulary_id, count in zip(keys, codes, names, vocabularies, counts)
+            ]
             return True, SourceConceptTable(valid_concepts)
 
         except Exception as e:
@@ -130,6 +162,35 @@ class TargetConceptTable:
         except Exception as e:
             return False, f"Error processing target concepts: {e}"
 
+    def from_pack(pack_path):
+        """
+        Load a parquet vocabulary pack built by src.vocab_utils
+        Column types are already enforced by the pack, so rows are not re-validated one by one
+        """
+        try:
+            df = pd.read_parquet(pack_path, columns=TargetConceptTable.target_columns)
+
+            valid_concepts = [
+                TargetConcept(
+                    concept_id=0,
+                    concept_code='No matching concept',
+                    concept_name='No matching concept',
+                    vocabulary_id='None'
+                )
+            ]
+            valid_concepts.extend(
+                TargetConcept(concept_id=int(concept_id), concept_code=concept_code,
+                              concept_name=concept_name, vocabulary_id=vocabulary_id)
+                for concept_id, concept_code, concept_name, vocabulary_id in zip(
+                    df['concept_id'], df['concept_code'], df['concept_name'], df['vocabulary_id']
+                )
+            )
+
+            return True, TargetConceptTable(valid_concepts)
+
+        except Exception as e:
+            return False, f"Error loading vocabulary pack: {e}"
+
 
 def get_source_concept_name(match, source_lookup):
     """Fetches the source concept name for a given match from the source lookup dictionary."""
@@ -142,9 +203,15 @@ def sort_concepts(concept_matches, source_lookup, sort_option="None"):
     elif sort_option == "Alphabetical (Z-A)":
         return sorted(concept_matches, key=lambda match: get_source_concept_name(match, source_lookup).lower(), reverse=True)
     elif sort_option == "Highest Confidence":
-        return sorted(concept_matches, key=lambda match: match.similarity_score, reverse=True)
+        # matches without a model score (reviewer-chosen targets) go last
+        return sorted(concept_matches, key=lambda match: (match.similarity_score is None, -(match.similarity_score or 0)))
     elif sort_option == "Lowest Confidence":
-        return sorted(concept_matches, key=lambda match: match.similarity_score)
+        return sorted(concept_matches, key=lambda match: (match.similarity_score is None, match.similarity_score or 0))
+    elif sort_option == "Highest Re-rank Score":
+        # matches that were not re-ranked go last
+        return sorted(concept_matches, key=lambda match: (match.rerank_score is None, -(match.rerank_score or 0)))
+    elif sort_option == "Lowest Re-rank Score":
+        return sorted(concept_matches, key=lambda match: (match.rerank_score is None, match.rerank_score or 0))
     return concept_matches  # Default: return unsorted list
 
 
@@ -160,10 +227,11 @@ def filter_for_unconfirmed_mappings(concept_matches):
 class ConceptMatch:
     source_key: int
     target_concept_id: int
-    similarity_score: float
+    similarity_score: float | None  # None where the target was not chosen by the model
     confirmation_status: str #"True", "False", "Rejected" -> to define w/ enum
     first_confirmation_timestamp: datetime | None
     last_update_timestamp: datetime | None
+    rerank_score: float | None = None # second stage score, see src/rerank_utils.py
 
 def read_and_validate_csv(file, tableclass):
     try:
@@ -0,0 +1,122 @@
+import numpy as np
+from src.array_utils import top_k_indices
+from src.data_utils import ConceptMatch
+from src.update_utils import embed_concepts
+from src.vocab_utils import stream_concept_ancestors, stream_concept_relationships
+
+## Hierarchy-constrained matching: match each source against coarse concepts (e.g. dm+d VTMs / ingredients) first,
+## then score only the descendants (e.g. VMPs) of its top coarse candidates, instead of every fine concept.
+## Parent -> child links come from a local Athena CONCEPT_ANCESTOR.csv or CONCEPT_RELATIONSHIP.csv.
+
+
+def load_children(target_table, relationship_path=None, ancestor_path=None, relationship_ids=("Subsumes",),
+                  max_levels=None):
+    """
+    Parent concept_id -> array of descendant concept_ids, both restricted to concepts in the target table
+    CONCEPT_ANCESTOR gives all descendants (up to max_levels); CONCEPT_RELATIONSHIP only direct parent -> child
+    links with the given relationship_ids (e.g. 'Subsumes', or dm+d 'VTM has VMP' style links)
+    """
+    if ancestor_path is None and relationship_path is None:
+        raise ValueError("A CONCEPT_ANCESTOR or CONCEPT_RELATIONSHIP file is needed")
+
+    target_ids = np.array([concept.concept_id for concept in target_table.concepts], dtype=np.int64)
+    if ancestor_path is not None:
+        batches = ((batch.column('ancestor_concept_id'), batch.column('descendant_concept_id'))
+                   for batch in stream_concept_ancestors(ancestor_path, max_levels))
+    else:
+        batches = ((batch.column('concept_id_1'), batch.column('concept_id_2'))
+                   for batch in stream_concept_relationships(relationship_path, list(relationship_ids)))
+
+    parents, descendants = [], []
+    for parent_column, child_column in batches:
+        parent_ids = parent_column.to_numpy()
+        child_ids = child_column.to_numpy()
+        keep = np.isin(parent_ids, target_ids) & np.isin(child_ids, target_ids)
+        parents.append(parent_ids[keep])
+        descendants.append(child_ids[keep])
+
+    if not parents:
+        return {}
+    parents, descendants = np.concatenate(parents), np.concatenate(descendants)
+    order = np.argsort(parents, kind="stable")
+    parents, descendants = parents[order], descendants[order]
+    unique_parents, starts = np.unique(parents, return_index=True)
+    return {
+        int(parent): np.unique(group)
+        for parent, group in zip(unique_parents, np.split(descendants, starts[1:]))
+    }
+
+
+def hierarchical_candidates(model_handler, source_table, target_table, children, coarse_k=3, k=10):
+    """
+    Top-k target candidates per source, searching only the top coarse_k coarse concepts and their descendants
+    Coarse concepts are the target concepts with children; only the descendants some source needs are embedded
+    Returns (candidate_ids [n, k], candidate_scores [n, k], source_embeddings, stats); short rows are padded with
+    concept_id 0 ('No matching concept') at score -1
+    """
+    target_rows = {concept.concept_id: row for row, concept in enumerate(target_table.concepts)}
+    coarse_rows = np.array([target_rows[parent] for parent in children if parent in target_rows], dtype=np.int64)
+    if len(coarse_rows) == 0:
+        raise ValueError("None of the target concepts have children in the hierarchy")
+    coarse_k = min(coarse_k, len(coarse_rows))
+
+    source_embeddings = embed_concepts(model_handler, source_table.concepts, "source")
+    coarse_embeddings = embed_concepts(model_handler, [target_table.concepts[row] for row in coarse_rows], "coarse targets")
+    coarse_top, _ = top_k_indices(source_embeddings @ coarse_embeddings.T, coarse_k)
+
+    # pool of rows searched for each selected coarse concept: itself plus its descendants
+    pools = {}
+    for position in np.unique(coarse_top):
+        row = coarse_rows[position]
+        descendant_rows = [target_rows[child] for child in children[target_table.concepts[row].concept_id].tolist()]
+        pools[position] = np.array([row] + descendant_rows, dtype=np.int64)
+
+    # embed each needed fine concept once, reusing the coarse embeddings
+    embedded = dict(zip(coarse_rows.tolist(), coarse_embeddings))
+    to_embed = sorted({int(row) for pool in pools.values() for row in pool} - embedded.keys())
+    if to_embed:
+        fine_embeddings = embed_concepts(model_handler, [target_table.concepts[row] for row in to_embed], "fine targets")
+        embedded.update(zip(to_embed, fine_embeddings))
+
+    candidate_ids = np.zeros((len(source_embeddings), k), dtype=np.int64)
+    candidate_scores = np.full((len(source_embeddings), k), -1.0, dtype=np.float32)
+    target_ids = np.array([concept.concept_id for concept in target_table.concepts], dtype=np.int64)
+    pool_sizes = np.empty(len(source_embeddings), dtype=np.int64)
+
+    for i, coarse_positions in enumerate(coarse_top):
+        pool = np.unique(np.concatenate([pools[position] for position in coarse_positions]))
+        scores = np.stack([embedded[int(row)] for row in pool]) @ source_embeddings[i]
+        order, top_scores = top_k_indices(scores[None, :], min(k, len(pool)))
+        candidate_ids[i, :order.shape[1]] = target_ids[pool[order[0]]]
+        candidate_scores[i, :order.shape[1]] = top_scores[0]
+        pool_sizes[i] = len(pool)
+
+    stats = {
+        'coarse_concepts': len(coarse_rows),
+        'embedded_targets': len(embedded),
+        'mean_search_space': float(pool_sizes.mean()) if len(pool_sizes) else 0.0,
+        'flat_search_space': len(target_table.concepts)
+    }
+    print(f"[INFO] Hierarchical matching searched {stats['mean_search_space']:.1f} targets per source "
+          f"(flat search: {stats['flat_search_space']}), embedding {stats['embedded_targets']} targets")
+    return candidate_ids, candidate_scores, source_embeddings, stats
+
+
+def matches_from_candidates(source_table, candidate_ids, candidate_scores):
+    """
+    Initial matches from the best candidate of each source, sorted by source concept count
+    """
+    matches = [
+        ConceptMatch(
+            source_key=concept.source_key,
+            target_concept_id=int(candidate_ids[row, 0]),
+            similarity_score=float(candidate_scores[row, 0]),
+            confirmation_status="False",
+            first_confirmation_timestamp=None,
+            last_update_timestamp=None
+        )
+        for row, concept in enumerate(source_table.concepts)
+    ]
+    counts = {concept.source_key: concept.concept_count for concept in source_table.concepts}
+    matches.sort(key=lambda match: counts[match.source_key], reverse=True)
+    return matches
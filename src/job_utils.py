@@ -0,0 +1,421 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+import json
+import os
+import pickle
+import threading
+import time
+import uuid
+import numpy as np
+from src.checkpoint_utils import write_json_atomic
+from src.hierarchy_utils import hierarchical_candidates, load_children, matches_from_candidates
+from src.match_utils import ModelHandler, top_k_candidates
+from src.multi_vocab_utils import match_multiple_vocabularies
+from src.pack_utils import VocabPack
+from src.rerank_utils import apply_reranking, rerank_candidates
+from src.trace_utils import start_run
+
+## Background jobs: long runs (e.g. auto-match) are submitted to a process-wide queue and executed by a small
+## worker pool, outside any Streamlit script run, so closing a tab or rerunning neither kills nor duplicates them.
+## Each job's state and progress is persisted as jobs/<job_id>/job.json and its result next to it, so any page
+## (or a new tab) can reattach to it. Jobs are cancelled cooperatively at their next progress report.
+
+FINISHED_STATES = ("succeeded", "failed", "cancelled", "interrupted")
+# kinds of the Auto-Match page's jobs, whose results load_job_result on that page reads
+MATCH_JOB_KINDS = ("auto-match", "multi-vocab-match", "hierarchical-match")
+
+
+class JobCancelled(BaseException):
+    """
+    Raised at a cancelled job's next progress report; a BaseException, like KeyboardInterrupt, so the
+    `except Exception` error handling of the code being run does not turn it into an ordinary failure
+    """
+
+
+@dataclass
+class Job:
+    job_id: str
+    kind: str
+    label: str
+    status: str = "queued"  # queued, running, succeeded, failed, cancelled or interrupted (server restarted)
+    created: str = field(default_factory=lambda: datetime.now().isoformat())
+    started: str | None = None
+    finished: str | None = None
+    stage: str | None = None
+    done: int = 0
+    total: int = 0
+    stage_started: float | None = None
+    message: str | None = None
+    error: str | None = None
+    run_id: str | None = None
+    cancel_requested: bool = False
+    result_discarded: bool = False  # result deleted once it was saved elsewhere, e.g. as a session
+
+    @property
+    def finished_state(self):
+        return self.status in FINISHED_STATES
+
+    def fraction(self):
+        return self.done / self.total if self.total else 0.0
+
+    def eta(self):
+        """
+        Seconds left in the current stage, from its rate so far; None until there is a rate
+        """
+        if not self.done or not self.total or self.stage_started is None:
+            return None
+        elapsed = time.time() - self.stage_started
+        return elapsed / self.done * (self.total - self.done)
+
+
+class JobContext:
+    """
+    Handed to a running job, to report progress and to find out whether it was cancelled
+    """
+    def __init__(self, runner, job):
+        self.runner = runner
+        self.job = job
+        self.saved_callbacks = []
+
+    def progress(self, done, total, stage=None):
+        if stage is not None and stage != self.job.stage:
+            self.job.stage = stage
+            self.job.stage_started = time.time()
+        self.job.done, self.job.total = done, total
+        self.runner.save_job(self.job, throttle=True)
+        self.check_cancelled()
+
+    def note(self, message):
+        self.job.message = message
+        self.runner.save_job(self.job)
+
+    def check_cancelled(self):
+        if self.job.cancel_requested:
+            raise JobCancelled()
+
+    def on_saved(self, callback):
+        """
+        Call callback() once the job's result is saved, e.g. to delete intermediate files the result was read from
+        Not called if the job fails or is cancelled, so a re-run can resume from them
+        """
+        self.saved_callbacks.append(callback)
+
+
+class JobRunner:
+    """
+    Process-wide job queue; at most max_concurrent jobs run at once, the rest wait in submission order
+    """
+    def __init__(self, jobs_dir="jobs", max_concurrent=1, save_interval=1.0):
+        self.jobs_dir = jobs_dir
+        self.save_interval = save_interval
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="omap-job")
+        self.jobs = {}
+        self.futures = {}
+        self.last_saved = {}
+        self.lock = threading.Lock()
+        os.makedirs(jobs_dir, exist_ok=True)
+        self.mark_interrupted()
+
+    def job_dir(self, job_id):
+        return f"{self.jobs_dir}/{job_id}"
+
+    def save_job(self, job, throttle=False):
+        now = time.monotonic()
+        with self.lock:
+            if throttle and now - self.last_saved.get(job.job_id, 0) < self.save_interval:
+                return
+            self.last_saved[job.job_id] = now
+            write_json_atomic(f"{self.job_dir(job.job_id)}/job.json", asdict(job))
+
+    def mark_interrupted(self):
+        """
+        Jobs left queued or running by a previous server process will never finish
+        """
+        for job in self.list_jobs():
+            if not job.finished_state and job.job_id not in self.jobs:
+                job.status = "interrupted"
+                job.finished = datetime.now().isoformat()
+                self.save_job(job)
+
+    def submit(self, kind, fn, *args, label=None, **kwargs):
+        """
+        Queue fn(context, *args, **kwargs); its returned dict is saved as the job's result
+        """
+        job = Job(job_id=f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}", kind=kind,
+                  label=label or kind)
+        os.makedirs(self.job_dir(job.job_id))
+        self.jobs[job.job_id] = job
+        self.save_job(job)
+        self.futures[job.job_id] = self.executor.submit(self._run, job, fn, args, kwargs)
+        print(f"[INFO] Job {job.job_id} ({job.label}) queued")
+        return job.job_id
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancel_requested:
+            job.status, job.finished = "cancelled", datetime.now().isoformat()
+            self.save_job(job)
+            return
+        job.status = "running"
+        job.started = datetime.now().isoformat()
+        job.run_id = start_run(job.kind)
+        self.save_job(job)
+        context = JobContext(self, job)
+        try:
+            result = fn(context, *args, **kwargs)
+            save_result(self.job_dir(job.job_id), result or {})
+            job.status = "succeeded"
+            for callback in context.saved_callbacks:
+                callback()
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status, job.error = "failed", f"{type(e).__name__}: {e}"
+        job.finished = datetime.now().isoformat()
+        self.save_job(job)
+        print(f"[INFO] Job {job.job_id} {job.status}")
+
+    def get(self, job_id):
+        """
+        A job of this process (live object), or one read back from disk
+        """
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        path = f"{self.job_dir(job_id)}/job.json"
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return Job(**json.load(f))
+
+    def list_jobs(self, kind=None):
+        """
+        All jobs on disk of a kind (or a tuple of kinds), newest first
+        """
+        kinds = (kind,) if isinstance(kind, str) else kind
+        jobs = []
+        for job_id in os.listdir(self.jobs_dir):
+            job = self.get(job_id)
+            if job is not None and (kinds is None or job.kind in kinds):
+                jobs.append(job)
+        return sorted(jobs, key=lambda job: job.created, reverse=True)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.finished_state:
+            return False
+        job.cancel_requested = True
+        if job.status == "queued" and self.futures[job_id].cancel():
+            job.status = "cancelled"
+            job.finished = datetime.now().isoformat()
+        self.save_job(job)
+        return True
+
+    def wait(self, job_id, timeout=None):
+        future = self.futures.get(job_id)
+        if future is not None and not future.cancelled():
+            future.result(timeout)
+        return self.get(job_id)
+
+    def load_result(self, job_id):
+        return load_result(self.job_dir(job_id))
+
+    def discard_result(self, job_id):
+        """
+        Delete a job's saved result (e.g. once it has been saved as a session); the job itself stays listed
+        """
+        job = self.get(job_id)
+        if job is None or job.status != "succeeded" or job.result_discarded:
+            return False
+        discard_result(self.job_dir(job_id))
+        job.result_discarded = True
+        self.save_job(job)
+        print(f"[INFO] Job {job_id} result discarded")
+        return True
+
+
+def save_result(job_dir, result):
+    """
+    Arrays are saved as .npy files, so large similarity matrices can be memory-mapped back; the rest is pickled
+    """
+    arrays = {key: value for key, value in result.items() if isinstance(value, np.ndarray)}
+    for key, value in arrays.items():
+        np.save(f"{job_dir}/{key}.npy", value)
+    with open(f"{job_dir}/result.pkl", 'wb') as f:
+        pickle.dump({'values': {key: value for key, value in result.items() if key not in arrays},
+                     'arrays': list(arrays)}, f)
+
+
+def load_result(job_dir):
+    with open(f"{job_dir}/result.pkl", 'rb') as f:
+        stored = pickle.load(f)
+    result = dict(stored['values'])
+    for key in stored['arrays']:
+        result[key] = np.load(f"{job_dir}/{key}.npy", mmap_mode="r")
+    return result
+
+
+def discard_result(job_dir):
+    """
+    Remove what save_result wrote; arrays memory-mapped by load_result stay readable until they are released
+    """
+    result_path = f"{job_dir}/result.pkl"
+    if not os.path.exists(result_path):
+        return
+    with open(result_path, 'rb') as f:
+        stored = pickle.load(f)
+    for key in stored['arrays']:
+        array_path = f"{job_dir}/{key}.npy"
+        if os.path.exists(array_path):
+            os.remove(array_path)
+    os.remove(result_path)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner(jobs_dir="jobs", max_concurrent=1):
+    """
+    The process-wide runner, shared by every user and page of the app
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner(jobs_dir, max_concurrent)
+        return _runner
+
+
+def load_job_model(context, backend, checkpoint_dir, model_path, cache_dir):
+    """
+    Load the model for a matching job, reporting its progress (and so checking for cancellation) through the job
+    """
+    model_handler = ModelHandler(model_path, cache_dir, backend=backend, checkpoint_dir=checkpoint_dir)
+    model_handler.progress_callback = context.progress
+    # checkpointed embeddings and similarities are copied into the job's result, after which they only take up disk
+    context.on_saved(model_handler.discard_checkpoints)
+
+    context.note("Loading model")
+    success, message = model_handler.load_model()
+    if not success:
+        raise RuntimeError(message)
+    return model_handler
+
+
+def auto_match_job(context, source_table, target_table, backend="torch", vocab_pack_path=None, reranker=None,
+                   rerank_budget=None, checkpoint_dir="checkpoints", model_path="FremyCompany/BioLORD-2023",
+                   cache_dir="models/biolord"):
+    """
+    The Auto-Match page's matching run as a job: load the model, embed, score, pick initial matches and top-k
+    candidates, and optionally re-rank them
+    """
+    model_handler = load_job_model(context, backend, checkpoint_dir, model_path, cache_dir)
+
+    context.note("Calculating similarities")
+    if vocab_pack_path:
+        success, similarities = model_handler.get_pack_similarities(source_table, VocabPack.open(vocab_pack_path))
+    else:
+        success, similarities = model_handler.get_concept_similarities(source_table, target_table)
+    if not success:
+        raise RuntimeError(similarities)
+    context.check_cancelled()
+
+    context.note("Generating matches")
+    matches = model_handler.generate_initial_matches(source_table, target_table, similarities)
+    candidate_ids, candidate_scores = top_k_candidates(similarities, target_table)
+
+    notes = []
+    if reranker is not None:
+        context.note("Re-ranking candidates")
+        success, message = reranker.load_model()
+        if not success:
+            raise RuntimeError(message)
+        rerank_scores, scored = rerank_candidates(reranker, source_table, target_table, candidate_ids, candidate_scores,
+                                                  time_budget=rerank_budget)
+        changed = apply_reranking(matches, source_table, candidate_ids, candidate_scores, rerank_scores)
+        notes.append(f"Re-ranked {scored} of {len(matches)} source concepts; {changed} top matches changed")
+
+    return {
+        'source_table': source_table,
+        'target_table': target_table,
+        'vocab_pack_path': vocab_pack_path,
+        'model_path': model_handler.model_path,
+        'backend': model_handler.backend,
+        'concept_matches': matches,
+        'notes': notes,
+        'similarities': np.asarray(similarities),
+        'candidate_ids': candidate_ids,
+        'candidate_scores': candidate_scores,
+        'source_embeddings': model_handler.embeddings.get('source'),
+        'source_inverse': model_handler.embeddings.get('source_inverse'),
+        'target_embeddings': model_handler.embeddings.get('target'),
+        'target_inverse': model_handler.embeddings.get('target_inverse')
+    }
+
+
+def multi_vocab_job(context, source_table, target_tables, backend="torch", checkpoint_dir="checkpoints",
+                    model_path="FremyCompany/BioLORD-2023", cache_dir="models/biolord"):
+    """
+    The Auto-Match page's multi-vocabulary run as a job: embed the sources once and search every target vocabulary
+    The result has the same keys as auto_match_job's, plus the partitions and their candidates
+    """
+    model_handler = load_job_model(context, backend, checkpoint_dir, model_path, cache_dir)
+
+    context.note("Embedding sources once and searching each target vocabulary")
+    success, result = match_multiple_vocabularies(model_handler, source_table, target_tables)
+    if not success:
+        raise RuntimeError(result)
+    context.check_cancelled()
+
+    candidate_ids, candidate_scores = result['candidates']
+    return {
+        'source_table': source_table,
+        'target_table': result['target_table'],
+        'vocab_pack_path': None,
+        'model_path': model_handler.model_path,
+        'backend': model_handler.backend,
+        'concept_matches': matches_from_candidates(source_table, candidate_ids, candidate_scores),
+        'notes': [],
+        'similarities': None,
+        'candidate_ids': candidate_ids,
+        'candidate_scores': candidate_scores,
+        'source_embeddings': result['source_embeddings'],
+        'target_embeddings': None,
+        'partitions': result['partitions'],
+        'partition_candidates': result['partition_candidates']
+    }
+
+
+def hierarchical_job(context, source_table, target_table, relationship_path=None, ancestor_path=None,
+                     relationship_ids=("Subsumes",), coarse_k=3, backend="torch", checkpoint_dir="checkpoints",
+                     model_path="FremyCompany/BioLORD-2023", cache_dir="models/biolord"):
+    """
+    The Auto-Match page's hierarchy-constrained run as a job: load the hierarchy, match coarse concepts first,
+    then only their descendants. The result has the same keys as auto_match_job's, without a similarity matrix
+    """
+    context.note("Loading hierarchy")
+    children = load_children(target_table, relationship_path=relationship_path, ancestor_path=ancestor_path,
+                             relationship_ids=relationship_ids)
+    context.check_cancelled()
+
+    model_handler = load_job_model(context, backend, checkpoint_dir, model_path, cache_dir)
+
+    context.note("Matching coarse concepts first")
+    candidate_ids, candidate_scores, source_embeddings, stats = hierarchical_candidates(
+        model_handler, source_table, target_table, children, coarse_k=coarse_k
+    )
+    context.check_cancelled()
+
+    return {
+        'source_table': source_table,
+        'target_table': target_table,
+        'vocab_pack_path': None,
+        'model_path': model_handler.model_path,
+        'backend': model_handler.backend,
+        'concept_matches': matches_from_candidates(source_table, candidate_ids, candidate_scores),
+        'notes': [f"Searched {stats['mean_search_space']:.0f} targets per source instead of {stats['flat_search_space']}"],
+        'similarities': None,
+        'candidate_ids': candidate_ids,
+        'candidate_scores': candidate_scores,
+        'source_embeddings': source_embeddings,
+        'target_embeddings': None
+    }
@@ -1,105 +1,450 @@
 import pandas as pd
 import os
+import time
 import torch
 import numpy as np
 from stqdm import stqdm
 from transformers import AutoModel, AutoTokenizer
 from sklearn.metrics.pairwise import cosine_similarity
+from src.array_utils import normalize_rows, top_k_indices
 from src.data_utils import ConceptMatch
+from src.checkpoint_utils import RunCheckpoint, hash_arrays, hash_texts
+from src.trace_utils import span
 
 ## TO DO
 ## Add docstrings
 
 
+def normalize_concept_text(text):
+    """
+    Normalise a concept name before embedding
+    Case and whitespace are folded, as BioLORD's tokenizer lowercases its input anyway
+    """
+    return " ".join(str(text).split()).casefold()
+
+
+def deduplicate_texts(texts):
+    """
+    Map every text to a unique normalised string
+    Returns the unique strings and an index array, such that unique_texts[inverse[i]] is the string for texts[i]
+    """
+    unique_lookup = {}
+    inverse = np.empty(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        inverse[i] = unique_lookup.setdefault(normalize_concept_text(text), len(unique_lookup))
+    return list(unique_lookup), inverse
+
+
+def build_length_buckets(lengths, max_batch_tokens=8192):
+    """
+    Group text indices into batches of similar token length
+    Indices are sorted by length and packed greedily, so that each batch's padded size
+    (longest member x number of members) stays within max_batch_tokens
+    """
+    batches = []
+    current = []
+    for idx in np.argsort(lengths, kind="stable"):
+        # sorted ascending, so the incoming text is always the longest in the batch
+        if current and lengths[idx] * (len(current) + 1) > max_batch_tokens:
+            batches.append(current)
+            current = []
+        current.append(int(idx))
+    if current:
+        batches.append(current)
+    return batches
+
+
+def padding_efficiency(lengths, batches):
+    """
+    Fraction of the tokens run through the model that are real (non-padding) tokens
+    """
+    padded_tokens = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+    real_tokens = sum(lengths[i] for batch in batches for i in batch)
+    return real_tokens / padded_tokens if padded_tokens else 1.0
+
+
+def top_k_candidates(similarities, target_table, k=10, block_size=1024):
+    """
+    Top-k target concept_ids and scores for every source row of a similarity matrix
+    Rows are processed in blocks, so a memory-mapped matrix is never loaded whole
+    """
+    target_ids = np.array([concept.concept_id for concept in target_table.concepts], dtype=np.int64)
+    k = min(k, len(target_ids))
+    candidate_ids = np.empty((similarities.shape[0], k), dtype=np.int64)
+    candidate_scores = np.empty((similarities.shape[0], k), dtype=np.float32)
+    for start in range(0, similarities.shape[0], block_size):
+        indices, scores = top_k_indices(np.asarray(similarities[start:start + block_size]), k)
+        candidate_ids[start:start + block_size] = target_ids[indices]
+        candidate_scores[start:start + block_size] = scores
+    return candidate_ids, candidate_scores
+
+
+class HiddenStateEncoder(torch.nn.Module):
+    """
+    Wraps a transformer so it takes only input_ids / attention_mask and returns last_hidden_state, for ONNX export
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+
 class ModelHandler:
+    # torch: full precision eager PyTorch (MPS/CUDA if available)
+    # int8: dynamically quantized int8 linear layers, CPU only
+    # onnx: model exported once to ONNX and run with ONNX Runtime on CPU
+    backends = ["torch", "int8", "onnx"]
+
     def __init__(
-        self, model_path="FremyCompany/BioLORD-2023", cache_dir="models/biolord"
+        self, model_path="FremyCompany/BioLORD-2023", cache_dir="models/biolord", backend="torch",
+        checkpoint_dir=None
     ):
         self.model_path = model_path
         self.cache_dir = cache_dir
+        self.backend = backend
+        # when set, embedding and matching runs write resumable checkpoints here
+        self.checkpoint_dir = checkpoint_dir
         self.model = None
         self.tokenizer = None
+        self.dedup_stats = {}
+        self.padding_stats = {}
+        # normalised embeddings of the distinct names of the last matching run, with the inverse indices mapping
+        # each concept row to its name ('source_inverse' / 'target_inverse'); saved with sessions for incremental updates
+        self.embeddings = {}
+        # called as progress_callback(done, total, stage) after each batch / block, e.g. by a background job
+        self.progress_callback = None
+        # checkpoint runs of the last embedding / matching, held until discard_checkpoints or collection
+        self.checkpoints = []
+
+    @property
+    def device(self):
+        # ONNX Runtime sessions have no torch device, and always run on CPU here
+        return getattr(self.model, "device", "cpu")
+
+    def backend_cache_path(self):
+        """
+        On-disk location of the converted model for the selected backend
+        """
+        model_dir = self.model_path.strip("/").replace("/", "--")
+        filename = "model.onnx" if self.backend == "onnx" else "model.pt"
+        return os.path.join(self.cache_dir, self.backend, model_dir, filename)
 
     def load_model(self):
         """
-        Load and/or cache BioLORD model and tokenizer
+        Load and/or cache BioLORD model and tokenizer, converting to the selected inference backend
         """
         try:
+            if self.backend not in ModelHandler.backends:
+                return False, f"Unknown inference backend: {self.backend}. Expected one of {ModelHandler.backends}"
+
             if not os.path.exists(self.cache_dir):
                 os.makedirs(self.cache_dir)
 
-            self.tokenizer = AutoTokenizer.from_pretrained(
-                self.model_path, cache_dir=self.cache_dir
-            )
-            self.model = AutoModel.from_pretrained(
-                self.model_path, cache_dir=self.cache_dir
-            )
+            with span("model_load", backend=self.backend):
+                self.tokenizer = AutoTokenizer.from_pretrained(
+                    self.model_path, cache_dir=self.cache_dir
+                )
+
+                if self.backend == "int8":
+                    self.model = self._load_int8_model()
+                elif self.backend == "onnx":
+                    self.model = self._load_onnx_session()
+                else:
+                    self.model = self._load_torch_model()
 
-            if torch.backends.mps.is_available():
-                print("[INFO] MPS is available")
-                self.model.to("mps")
-            elif torch.cuda.is_available():
-                print("[INFO] CUDA is available")
-                self.model.to("cuda")
+                    if torch.backends.mps.is_available():
+                        print("[INFO] MPS is available")
+                        self.model.to("mps")
+                    elif torch.cuda.is_available():
+                        print("[INFO] CUDA is available")
+                        self.model.to("cuda")
 
-            print(f"[INFO] Using device: {self.model.device}")
+            print(f"[INFO] Using {self.backend} backend on device: {self.device}")
 
             return True, "Model loaded successfully"
         except Exception as e:
             return False, f"Error loading model: {e}"
 
-    def generate_embedding(self, text):
-        inputs = self.tokenizer(
-            text, return_tensors="pt", padding=True, truncation=True, max_length=512
+    def _load_torch_model(self):
+        return AutoModel.from_pretrained(
+            self.model_path, cache_dir=self.cache_dir
+        ).eval()
+
+    def _load_int8_model(self):
+        """
+        Quantize linear layers to int8 once, then reload the quantized model from the backend cache
+        """
+        cache_path = self.backend_cache_path()
+        if os.path.exists(cache_path):
+            return torch.load(cache_path, weights_only=False).eval()
+
+        print("[INFO] Quantizing model linear layers to int8...")
+        model = torch.ao.quantization.quantize_dynamic(
+            self._load_torch_model(), {torch.nn.Linear}, dtype=torch.qint8
         )
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        torch.save(model, cache_path)
+        return model
 
-        if torch.backends.mps.is_available() or torch.cuda.is_available():
-            # Move the inputs to GPU acceleration if available
-            device = self.model.device
-            inputs = {key: value.to(device) for key, value in inputs.items()}
+    def _load_onnx_session(self):
+        """
+        Export the model to ONNX once, then run the cached export with ONNX Runtime
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx backend requires onnxruntime and onnx (pip install onnxruntime onnx)")
 
-            with torch.no_grad():
-                outputs = self.model(**inputs)
+        cache_path = self.backend_cache_path()
+        if not os.path.exists(cache_path):
+            print("[INFO] Exporting model to ONNX...")
+            encoder = HiddenStateEncoder(self._load_torch_model()).eval()
+            # trace with a padded batch so the attention mask path is exported
+            example = self.tokenizer(["example concept name", "example"], padding=True, return_tensors="pt")
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            torch.onnx.export(
+                encoder,
+                (example["input_ids"], example["attention_mask"]),
+                cache_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["last_hidden_state"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "last_hidden_state": {0: "batch", 1: "sequence"}
+                },
+                opset_version=17,
+                dynamo=False
+            )
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return onnxruntime.InferenceSession(cache_path, options, providers=["CPUExecutionProvider"])
 
-            # Move the output back to CPU before converting to numpy type
-            return outputs.last_hidden_state.mean(dim=1).squeeze().cpu().numpy()
+    def _embed_features(self, features):
+        """
+        Run one batch of pre-tokenised features through the model
+        Mean pooling is taken over real tokens only, so padded and unpadded inputs give the same embedding
+        """
+        inputs = self.tokenizer.pad(features, return_tensors="pt")
 
+        if self.backend == "onnx":
+            ort_inputs = {name: inputs[name].numpy() for name in ("input_ids", "attention_mask")}
+            last_hidden_state = torch.from_numpy(self.model.run(None, ort_inputs)[0])
         else:
+            # Move the inputs to the model device (GPU acceleration if available)
+            inputs = {key: value.to(self.device) for key, value in inputs.items()}
+
             with torch.no_grad():
-                outputs = self.model(**inputs)
+                last_hidden_state = self.model(**inputs).last_hidden_state
 
-            return outputs.last_hidden_state.mean(dim=1).squeeze().numpy()
+        mask = inputs["attention_mask"].unsqueeze(-1).to(last_hidden_state.device, last_hidden_state.dtype)
+        pooled = (last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+        # Move the output back to CPU before converting to numpy type
+        return pooled.cpu().numpy()
+
+    def generate_embedding(self, text):
+        encodings = self.tokenizer([text], truncation=True, max_length=512)
+        return self._embed_features([{key: encodings[key][0] for key in encodings.keys()}])[0]
 
-    def batch_generate_embeddings(self, texts, batch_size=32):
-        embeddings = []
-        for i in stqdm(range(0, len(texts), batch_size)):
-            batch_texts = texts[i : i + batch_size]
-            batch_embeddings = [self.generate_embedding(text) for text in batch_texts]
-            embeddings.extend(batch_embeddings)
-        return np.array(embeddings)
+    def batch_generate_embeddings(self, texts, max_batch_tokens=8192):
+        """
+        Embed texts in length-bucketed batches under a padded token budget
+        Embeddings are returned in the original text order
+        """
+        if len(texts) == 0:
+            return np.array([])
+
+        with span("tokenize", items=len(texts)):
+            encodings = self.tokenizer(list(texts), truncation=True, max_length=512)
+        lengths = [len(ids) for ids in encodings["input_ids"]]
+        batches = build_length_buckets(lengths, max_batch_tokens)
+
+        # compare against the old fixed-count, input-order schedule
+        input_order = [list(range(i, min(i + 32, len(texts)))) for i in range(0, len(texts), 32)]
+        self.padding_stats = {
+            'texts': len(texts),
+            'batches': len(batches),
+            'real_tokens': sum(lengths),
+            'padding_efficiency': padding_efficiency(lengths, batches),
+            'input_order_padding_efficiency': padding_efficiency(lengths, input_order)
+        }
+        print(f"[INFO] {len(texts)} texts in {len(batches)} batches, padding efficiency "
+              f"{self.padding_stats['padding_efficiency']:.1%} "
+              f"(input order: {self.padding_stats['input_order_padding_efficiency']:.1%})")
+
+        embeddings = None
+        with span("inference", items=len(texts), batches=len(batches), backend=self.backend):
+            for batch_idx, batch in enumerate(stqdm(batches)):
+                features = [{key: encodings[key][i] for key in encodings.keys()} for i in batch]
+                batch_embeddings = self._embed_features(features)
+                if embeddings is None:
+                    embeddings = np.empty((len(texts), batch_embeddings.shape[1]), dtype=batch_embeddings.dtype)
+                embeddings[batch] = batch_embeddings
+                if self.progress_callback:
+                    self.progress_callback(batch_idx + 1, len(batches), "embedding")
+        return embeddings
+
+    def deduplicated_embeddings(self, texts, label="texts"):
+        """
+        Embed each distinct normalised text once
+        Returns the unique embeddings and the index array that fans them back out to one row per input text
+        """
+        unique_texts, inverse = deduplicate_texts(texts)
+        ratio = len(texts) / len(unique_texts) if unique_texts else 1.0
+        self.dedup_stats[label] = {
+            'rows': len(texts),
+            'unique': len(unique_texts),
+            'dedup_ratio': ratio
+        }
+        print(f"[INFO] {label}: {len(texts)} rows -> {len(unique_texts)} unique names (dedup ratio {ratio:.2f}x)")
+        with span(f"embed_{label}", items=len(unique_texts), rows=len(texts)):
+            if self.checkpoint_dir:
+                return self.checkpointed_embeddings(unique_texts), inverse
+            return self.batch_generate_embeddings(unique_texts), inverse
+
+    def checkpointed_embeddings(self, texts, shard_size=4096):
+        """
+        Embed texts shard by shard, saving each completed shard under checkpoint_dir
+        A re-run with the same texts, model and backend skips shards already on disk
+        """
+        checkpoint = RunCheckpoint.for_run(self.checkpoint_dir, "embeddings", {
+            'model_path': self.model_path,
+            'backend': self.backend,
+            'texts': hash_texts(texts),
+            'text_count': len(texts),
+            'shard_size': shard_size
+        })
+        self.checkpoints.append(checkpoint)
+
+        shards = []
+        for shard_idx, start in enumerate(range(0, len(texts), shard_size)):
+            filename = f"shard_{shard_idx:05d}.npy"
+            if not checkpoint.is_complete(shard_idx):
+                checkpoint.save_array(filename, self.batch_generate_embeddings(texts[start:start + shard_size]))
+                checkpoint.mark_complete(shard_idx)
+            shards.append(np.load(checkpoint.path(filename)))
+        checkpoint.finish()
+
+        return np.vstack(shards) if shards else np.array([])
+
+    def checkpointed_similarities(self, source_embeddings, source_inverse, target_embeddings, target_inverse,
+                                  block_size=1024):
+        """
+        Fill the fanned-out similarity matrix one block of source rows at a time, in a memory-mapped file under checkpoint_dir
+        A re-run with the same embeddings skips blocks already written
+        """
+        checkpoint = RunCheckpoint.for_run(self.checkpoint_dir, "similarities", {
+            'inputs': hash_arrays(source_embeddings, source_inverse, target_embeddings, target_inverse),
+            'block_size': block_size
+        })
+        self.checkpoints.append(checkpoint)
+
+        shape = (len(source_inverse), len(target_inverse))
+        path = checkpoint.path("similarities.npy")
+        if os.path.exists(path):
+            similarities = np.load(path, mmap_mode="r+")
+        else:
+            similarities = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=shape)
+
+        for block_idx, start in enumerate(stqdm(range(0, shape[0], block_size))):
+            if checkpoint.is_complete(block_idx):
+                continue
+            block_rows = source_inverse[start:start + block_size]
+            block = cosine_similarity(source_embeddings[block_rows], target_embeddings)
+            similarities[start:start + block_size] = block[:, target_inverse]
+            similarities.flush()
+            checkpoint.mark_complete(block_idx)
+            if self.progress_callback:
+                self.progress_callback(block_idx + 1, -(-shape[0] // block_size), "similarity")
+
+        del similarities
+        checkpoint.finish()
+        return np.load(path, mmap_mode="r")
+
+    @property
+    def checkpoint_runs(self):
+        return [checkpoint.run_dir for checkpoint in self.checkpoints]
+
+    def discard_checkpoints(self):
+        """
+        Delete the checkpoint runs behind the last results, once they are saved elsewhere (a session, a job result)
+        Runs another handler is still using are left to be pruned later
+        """
+        for checkpoint in self.checkpoints:
+            checkpoint.discard()
+        self.checkpoints = []
 
     def get_concept_similarities(self, source_table, target_table):
         try:
             source_texts = [concept.concept_name for concept in source_table.concepts]
             target_texts = [concept.concept_name for concept in target_table.concepts]
 
-            # get embeddings
+            # get embeddings for distinct names only
             print("Generating source embeddings...")
-            source_embeddings = self.batch_generate_embeddings(source_texts)
+            source_embeddings, source_inverse = self.deduplicated_embeddings(source_texts, "source")
             print("Generating target embeddings...")
-            target_embeddings = self.batch_generate_embeddings(target_texts)
+            target_embeddings, target_inverse = self.deduplicated_embeddings(target_texts, "target")
 
             # convert to tensors
-            source_tensor = torch.tensor(source_embeddings, device=self.model.device)
-            target_tensor = torch.tensor(target_embeddings, device=self.model.device)
+            source_tensor = torch.tensor(source_embeddings, device=self.device)
+            target_tensor = torch.tensor(target_embeddings, device=self.device)
 
             # numpy doesn't support gpu tensors
             source_cpu = source_tensor.cpu().numpy()
             target_cpu = target_tensor.cpu().numpy()
 
+            self.embeddings = {
+                'source': normalize_rows(source_cpu),
+                'source_inverse': source_inverse,
+                'target': normalize_rows(target_cpu),
+                'target_inverse': target_inverse
+            }
+
             # calculate similarities
             print("Calculating similarities...")
-            similarities = cosine_similarity(source_cpu, target_cpu)
+            with span("similarity", items=len(source_inverse) * len(target_inverse)) as stage:
+                if self.checkpoint_dir:
+                    similarities = self.checkpointed_similarities(source_cpu, source_inverse, target_cpu, target_inverse)
+                    stage.record(bytes_written=similarities.nbytes)
+                else:
+                    similarities = cosine_similarity(source_cpu, target_cpu)
+
+                    # fan unique similarities back out to one row/column per concept
+                    similarities = similarities[np.ix_(source_inverse, target_inverse)]
+
+            return True, similarities
+
+        except Exception as e:
+            return False, f"Error calculating similarities: {e}"
+
+    def get_pack_similarities(self, source_table, vocab_pack):
+        """
+        Similarities of source concepts against a prebuilt vocab pack (src/pack_utils.py)
+        Only the sources are embedded; target embeddings are read from the memory-mapped pack
+        """
+        try:
+            mismatch = vocab_pack.check_model(self)
+            if mismatch:
+                return False, mismatch
+
+            source_texts = [concept.concept_name for concept in source_table.concepts]
+            print("Generating source embeddings...")
+            source_embeddings, source_inverse = self.deduplicated_embeddings(source_texts, "source")
+
+            print("Calculating similarities against vocab pack...")
+            with span("similarity", items=len(source_inverse) * len(vocab_pack.concept_ids)):
+                similarities = vocab_pack.similarities(source_embeddings, inverse=source_inverse)
+
+            self.embeddings = {
+                'source': normalize_rows(source_embeddings),
+                'source_inverse': source_inverse,
+                'target': vocab_pack.float_embeddings(),
+                'target_inverse': None
+            }
 
             return True, similarities
 
@@ -114,20 +459,56 @@ class ModelHandler:
             for concept in source_table.concepts
         }
 
-        for i, row in enumerate(similarities):
-            best_match_idx = np.argmax(row)
-            matches.append(
-                ConceptMatch(
-                    source_key=source_table.concepts[i].source_key,
-                    target_concept_id=target_table.concepts[best_match_idx].concept_id,
-                    similarity_score=float(row[best_match_idx]),
-                    confirmation_status="False",
-                    first_confirmation_timestamp=None,
-                    last_update_timestamp=None,
+        with span("initial_matches", items=len(similarities)):
+            for i, row in enumerate(similarities):
+                best_match_idx = np.argmax(row)
+                matches.append(
+                    ConceptMatch(
+                        source_key=source_table.concepts[i].source_key,
+                        target_concept_id=target_table.concepts[best_match_idx].concept_id,
+                        similarity_score=float(row[best_match_idx]),
+                        confirmation_status="False",
+                        first_confirmation_timestamp=None,
+                        last_update_timestamp=None,
+                    )
                 )
-            )
 
         # sorting by desc
         matches.sort(key=lambda x: count_dict[x.source_key], reverse=True)  # in place
 
         return matches
+
+
+def compare_backends(reference_handler, candidate_handler, source_texts, target_texts):
+    """
+    Fidelity and throughput check of a candidate inference backend against a reference backend
+    Cosine agreement compares each text's candidate embedding with its reference embedding,
+    top-1 agreement is the fraction of source texts whose best target is unchanged
+    """
+    embeddings = {}
+    report = {}
+    for name, handler in [("reference", reference_handler), ("candidate", candidate_handler)]:
+        start = time.perf_counter()
+        source_embeddings = handler.batch_generate_embeddings(source_texts)
+        target_embeddings = handler.batch_generate_embeddings(target_texts)
+        elapsed = time.perf_counter() - start
+
+        embeddings[name] = (source_embeddings, target_embeddings)
+        report[f"{name}_backend"] = handler.backend
+        report[f"{name}_texts_per_sec"] = (len(source_texts) + len(target_texts)) / elapsed
+
+    reference_all = np.vstack(embeddings["reference"])
+    candidate_all = np.vstack(embeddings["candidate"])
+    pairwise_cosine = (
+        (reference_all * candidate_all).sum(axis=1)
+        / (np.linalg.norm(reference_all, axis=1) * np.linalg.norm(candidate_all, axis=1))
+    )
+
+    reference_top1 = cosine_similarity(*embeddings["reference"]).argmax(axis=1)
+    candidate_top1 = cosine_similarity(*embeddings["candidate"]).argmax(axis=1)
+
+    report["mean_cosine_agreement"] = float(pairwise_cosine.mean())
+    report["min_cosine_agreement"] = float(pairwise_cosine.min())
+    report["top1_agreement"] = float((reference_top1 == candidate_top1).mean())
+    report["speedup"] = report["candidate_texts_per_sec"] / report["reference_texts_per_sec"]
+    return report
@@ -0,0 +1,108 @@
+import numpy as np
+from src.array_utils import top_k_indices
+from src.data_utils import TargetConceptTable
+from src.pack_utils import VocabPack
+from src.update_utils import embed_concepts
+
+## Multi-vocabulary matching: one run against several target vocabularies (e.g. dm+d VTM, dm+d VMP,
+## RxNorm clinical drug), embedding the source concepts once. Each vocabulary is a named partition of a combined
+## target table, and keeps its own top-k candidates, so reviewers can see which vocabulary each source fits best.
+
+
+def combine_target_tables(target_tables):
+    """
+    One target table holding every partition's concepts once, behind a single 'No matching concept'
+    Returns (combined table, {label: [concept_ids]})
+    """
+    concepts = []
+    seen = set()
+    partitions = {}
+    for label, table in target_tables.items():
+        table = table.to_target_table() if isinstance(table, VocabPack) else table
+        partitions[label] = [concept.concept_id for concept in table.concepts if concept.concept_id != 0]
+        for concept in table.concepts:
+            if concept.concept_id not in seen:
+                seen.add(concept.concept_id)
+                concepts.append(concept)
+    # keep the no-match concept first, as in single-table sessions
+    concepts.sort(key=lambda concept: concept.concept_id != 0)
+    return TargetConceptTable(concepts), partitions
+
+
+def blocked_top_k(source_embeddings, target_embeddings, target_ids, k=10, block_size=1024):
+    """
+    Top-k target ids and scores per source row, scoring a block of sources at a time (no full similarity matrix)
+    """
+    k = min(k, len(target_ids))
+    candidate_ids = np.empty((len(source_embeddings), k), dtype=np.int64)
+    candidate_scores = np.empty((len(source_embeddings), k), dtype=np.float32)
+    for start in range(0, len(source_embeddings), block_size):
+        indices, scores = top_k_indices(source_embeddings[start:start + block_size] @ target_embeddings.T, k)
+        candidate_ids[start:start + block_size] = target_ids[indices]
+        candidate_scores[start:start + block_size] = scores
+    return candidate_ids, candidate_scores
+
+
+def merge_partition_candidates(partition_candidates, k=10):
+    """
+    Overall top-k over every partition's top-k; a concept in several partitions is counted once
+    """
+    ids = np.concatenate([ids for ids, _ in partition_candidates.values()], axis=1)
+    scores = np.concatenate([scores for _, scores in partition_candidates.values()], axis=1).astype(np.float32)
+    for row in range(len(ids)):
+        _, first = np.unique(ids[row], return_index=True)
+        duplicate = np.ones(ids.shape[1], dtype=bool)
+        duplicate[first] = False
+        scores[row, duplicate] = -np.inf
+    order, top_scores = top_k_indices(scores, min(k, ids.shape[1]))
+    return np.take_along_axis(ids, order, axis=1), top_scores
+
+
+def match_multiple_vocabularies(model_handler, source_table, target_tables, k=10):
+    """
+    Match sources against several target vocabularies in one run
+    target_tables maps a label to a TargetConceptTable, or to a VocabPack whose stored embeddings are searched directly
+    Returns (success, result) where result holds the combined target table, partitions, source embeddings,
+    per-partition candidates {label: (ids, scores)} and the top-k candidates over all partitions
+    """
+    try:
+        source_embeddings = embed_concepts(model_handler, source_table.concepts, "source")
+        partition_candidates = {}
+
+        for label, table in target_tables.items():
+            if isinstance(table, VocabPack):
+                mismatch = table.check_model(model_handler)
+                if mismatch:
+                    return False, f"{label}: {mismatch}"
+                rows, scores = table.search(source_embeddings, k, skip_no_match=True)
+                partition_candidates[label] = (table.concept_ids[rows].astype(np.int64), scores)
+                continue
+
+            concepts = [concept for concept in table.concepts if concept.concept_id != 0]
+            target_embeddings = embed_concepts(model_handler, concepts, label)
+            target_ids = np.array([concept.concept_id for concept in concepts], dtype=np.int64)
+            partition_candidates[label] = blocked_top_k(source_embeddings, target_embeddings, target_ids, k)
+
+        candidate_ids, candidate_scores = merge_partition_candidates(partition_candidates, k)
+
+        combined_table, partitions = combine_target_tables(target_tables)
+        return True, {
+            'target_table': combined_table,
+            'partitions': partitions,
+            'source_embeddings': source_embeddings,
+            'partition_candidates': partition_candidates,
+            'candidates': (candidate_ids, candidate_scores)
+        }
+
+    except Exception as e:
+        return False, f"Failed to match multiple vocabularies: {e}"
+
+
+def partition_alternatives(session, source_row, label, n=10):
+    """
+    Best n (concept_id, score) pairs for one source within a single target vocabulary of a multi-vocabulary session
+    """
+    if not session.partition_candidates or label not in session.partition_candidates:
+        return []
+    ids, scores = session.partition_candidates[label]
+    return [(int(concept_id), float(score)) for concept_id, score in zip(ids[source_row][:n], scores[source_row][:n])]
@@ -1,7 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, date
 from dataclasses import dataclass
+import multiprocessing
 import pandas as pd
 import os
+from src.session_utils import load_session
+from src.trace_utils import path_bytes, span
 
 @dataclass
 class ConceptRow:
@@ -33,80 +37,182 @@ def is_fully_mapped(concept_matches):
 
     return fully_mapped
 
+def source_lookup(session):
+    """
+    source_key -> first source concept with that key, so each match is looked up once rather than by a scan
+    """
+    sources = {}
+    for concept in session.source_table.concepts:
+        sources.setdefault(concept.source_key, concept)
+    return sources
+
+## Conversion works from a SessionExport per session: its matches joined with their source concepts, in match order.
+## Exports are small enough to pass between processes, so sessions are loaded and joined in parallel worker processes,
+## and only the merge (ID assignment in timestamp order, first-seen de-duplication in session order) runs serially.
+
+PARALLEL_MIN_SESSIONS = 4
+
+@dataclass
+class ExportedMatch:
+    source_key: int
+    target_concept_id: int
+    confirmation_status: str
+    first_confirmation_timestamp: datetime | None
+    last_update_timestamp: datetime | None
+    concept_name: str
+    concept_code: str
+    vocabulary_id: str
+
+@dataclass
+class SessionExport:
+    project_name: str
+    timestamp: str
+    fully_mapped: bool
+    confirmed: int
+    matches: list
+
+def export_session(session):
+    """
+    What OMOP conversion needs from a session (ProjectSession or SessionExport)
+    """
+    if isinstance(session, SessionExport):
+        return session
+    sources = source_lookup(session)
+    matches = []
+    for match in session.concept_matches:
+        source = sources[match.source_key]
+        matches.append(ExportedMatch(
+            source_key=match.source_key,
+            target_concept_id=match.target_concept_id,
+            confirmation_status=match.confirmation_status,
+            first_confirmation_timestamp=match.first_confirmation_timestamp,
+            last_update_timestamp=match.last_update_timestamp,
+            concept_name=source.concept_name,
+            concept_code=source.concept_code,
+            vocabulary_id=source.vocabulary_id
+        ))
+    return SessionExport(
+        project_name=session.project_name,
+        timestamp=session.timestamp,
+        fully_mapped=is_fully_mapped(session.concept_matches),
+        confirmed=sum(1 for match in session.concept_matches if match.confirmation_status == "True"),
+        matches=matches
+    )
+
+def load_session_export(session_name, sessions_dir="sessions"):
+    """
+    Load one saved session and export it; run in worker processes by load_session_exports
+    """
+    success, session = load_session(session_name, sessions_dir)
+    if not success:
+        return False, session
+    return True, export_session(session)
+
+def worker_context():
+    """
+    forkserver, as forking a process that runs threads (e.g. Streamlit) is unsafe; the server imports this module
+    once, so each worker starts with session loading already imported (numpy, pandas; not torch, which nothing
+    imported from here needs)
+    """
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["src.omop_utils"])
+    return context
+
+def load_session_exports(session_names, sessions_dir="sessions", workers=None):
+    """
+    Load and export saved sessions over a process pool; results are (success, export or message), in the order given
+    By default a few sessions are loaded in this process, where starting workers would cost more than it saves
+    Workers don't share this process's table cache (src/blob_utils.py): a table used by several sessions is
+    unpickled once by every worker that loads one of them, so sessions on one large target release cost up to
+    one read of it per worker
+    """
+    if workers is None:
+        workers = min(len(session_names), os.cpu_count() or 1) if len(session_names) >= PARALLEL_MIN_SESSIONS else 1
+    with span("omop_load_sessions", items=len(session_names)):
+        if workers <= 1 or len(session_names) <= 1:
+            return [load_session_export(name, sessions_dir) for name in session_names]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=worker_context()) as executor:
+            return list(executor.map(load_session_export, session_names, [sessions_dir] * len(session_names)))
+
 def assign_concept_ids(sessions, base_id=2000000001):
     """
     Assign incremental concept IDs to source concepts across all sessions
-    Ensures that if there is a duplicate source_key (i.e. same concept across multiple sessions) then this is flagged
+    A source_key confirmed in several sessions (e.g. reused through the mapping index) is allowed when every session
+    maps it to the same target; if the targets differ this is flagged
     """
-    source_concepts = []
+    with span("omop_assign_ids") as stage:
+        source_concepts = []
 
-    # collect all concepts
-    # there is probably a way to do this more cleanly, instead of nested loops
-    for session in sessions:
-        for match in session.concept_matches:
-            if match.confirmation_status == "True" or match.confirmation_status == "Rejected":
-                # grab source concept details
-                source = None
-                for concept in session.source_table.concepts:
-                    if concept.source_key == match.source_key:
-                        source = concept
-                        break
-                source_concepts.append({
-                    'source_key': source.source_key,
-                    'timestamp': match.first_confirmation_timestamp,
-                    'concept_name': source.concept_name,
-                    'concept_code': source.concept_code
-                })
-
-    # CHECK FOR DUPLICATES
-    source_keys = [c['source_key'] for c in source_concepts]
-    if len(source_keys) != len(set(source_keys)):
-        duplicate_keys = [k for k in set(source_keys) if source_keys.count(k) > 1]
-        duplicates = [c for c in source_concepts if c['source_key'] in duplicate_keys]
-        raise ValueError(f"Duplicate source keys found: {duplicates}")
-
-    # sort and assign incremental OMOP concept_ids per method discussed @LAdams/@drjzhn
-    sorted_concepts = sorted(source_concepts,
-                           key=lambda x: (x['timestamp'], x['concept_name'], x['concept_code']))
-
-    source_key_to_id = {}
-    current_id = base_id
-
-    for concept in sorted_concepts:
-        if concept['source_key'] not in source_key_to_id:
-            source_key_to_id[concept['source_key']] = current_id
-            current_id += 1
+        # collect all concepts
+        for session in sessions:
+            for match in export_session(session).matches:
+                if match.confirmation_status == "True" or match.confirmation_status == "Rejected":
+                    source_concepts.append({
+                        'source_key': match.source_key,
+                        'target_concept_id': match.target_concept_id,
+                        'timestamp': match.first_confirmation_timestamp,
+                        'concept_name': match.concept_name,
+                        'concept_code': match.concept_code
+                    })
+
+        # CHECK FOR CONFLICTING DUPLICATES
+        targets = {}
+        for c in source_concepts:
+            targets.setdefault(c['source_key'], set()).add(c['target_concept_id'])
+        conflicting_keys = {k for k, target_ids in targets.items() if len(target_ids) > 1}
+        if conflicting_keys:
+            duplicates = [c for c in source_concepts if c['source_key'] in conflicting_keys]
+            raise ValueError(f"Duplicate source keys found: {duplicates}")
+
+        # sort and assign incremental OMOP concept_ids per method discussed @LAdams/@drjzhn
+        sorted_concepts = sorted(source_concepts,
+                               key=lambda x: (x['timestamp'], x['concept_name'], x['concept_code']))
+
+        source_key_to_id = {}
+        current_id = base_id
+
+        for concept in sorted_concepts:
+            if concept['source_key'] not in source_key_to_id:
+                source_key_to_id[concept['source_key']] = current_id
+                current_id += 1
+
+        stage.record(items=len(source_key_to_id))
 
     return source_key_to_id
 
+def first_mapped_matches(sessions, source_key_to_id):
+    """
+    The first match of each source_key with an assigned ID, taking sessions in order
+    """
+    emitted = set()
+    for session in sessions:
+        for match in export_session(session).matches:
+            if match.source_key in source_key_to_id and match.source_key not in emitted:
+                emitted.add(match.source_key)
+                yield match
+
 def generate_concept_table(sessions, source_key_to_id):
     """
     Generate OMOP.CONCEPT table rows
     """
-    concept_rows = []
+    with span("omop_concept_table") as stage:
+        concept_rows = []
 
-    for session in sessions:
-        for match in session.concept_matches:
-            if match.source_key in source_key_to_id:
-                # grab source concept details
-                source = None
-                for concept in session.source_table.concepts:
-                    if concept.source_key == match.source_key:
-                        source = concept
-                        break
-                # append to OMOP
-                concept_rows.append(ConceptRow(
-                    concept_id=source_key_to_id[match.source_key],
-                    concept_name=source.concept_name,
-                    domain_id='',
-                    vocabulary_id=source.vocabulary_id,
-                    concept_class_id='',
-                    standard_concept='N',
-                    concept_code=source.concept_code,
-                    valid_start_date=match.last_update_timestamp.date(),
-                    valid_end_date=date(2099, 12, 31),
-                    invalid_reason=None
-                ))
+        for match in first_mapped_matches(sessions, source_key_to_id):
+            concept_rows.append(ConceptRow(
+                concept_id=source_key_to_id[match.source_key],
+                concept_name=match.concept_name,
+                domain_id='',
+                vocabulary_id=match.vocabulary_id,
+                concept_class_id='',
+                standard_concept='N',
+                concept_code=match.concept_code,
+                valid_start_date=match.last_update_timestamp.date(),
+                valid_end_date=date(2099, 12, 31),
+                invalid_reason=None
+            ))
+
+        stage.record(items=len(concept_rows))
 
     return concept_rows
 
@@ -114,27 +220,28 @@ def generate_relationship_table(sessions, source_key_to_id):
     """
     Generate OMOP.CONCEPT_RELATIONSHIP table rows
     """
-    relationship_rows = []
+    with span("omop_relationship_table") as stage:
+        relationship_rows = []
 
-    for session in sessions:
-        for match in session.concept_matches:
-            if match.source_key in source_key_to_id:
-                relationship_rows.append(ConceptRelationshipRow(
-                    concept_id_1=source_key_to_id[match.source_key],
-                    concept_id_2=match.target_concept_id,
-                    relationship_id='Maps to',
-                    valid_start_date=match.last_update_timestamp.date(),
-                    valid_end_date=date(2099, 12, 31),
-                    invalid_reason=None
-                ))
-                relationship_rows.append(ConceptRelationshipRow(
-                    concept_id_1=match.target_concept_id,
-                    concept_id_2=source_key_to_id[match.source_key],
-                    relationship_id='Maps from',
-                    valid_start_date=match.last_update_timestamp.date(),
-                    valid_end_date=date(2099, 12, 31),
-                    invalid_reason=None
-                ))
+        for match in first_mapped_matches(sessions, source_key_to_id):
+            relationship_rows.append(ConceptRelationshipRow(
+                concept_id_1=source_key_to_id[match.source_key],
+                concept_id_2=match.target_concept_id,
+                relationship_id='Maps to',
+                valid_start_date=match.last_update_timestamp.date(),
+                valid_end_date=date(2099, 12, 31),
+                invalid_reason=None
+            ))
+            relationship_rows.append(ConceptRelationshipRow(
+                concept_id_1=match.target_concept_id,
+                concept_id_2=source_key_to_id[match.source_key],
+                relationship_id='Maps from',
+                valid_start_date=match.last_update_timestamp.date(),
+                valid_end_date=date(2099, 12, 31),
+                invalid_reason=None
+            ))
+
+        stage.record(items=len(relationship_rows))
 
     return relationship_rows
 
@@ -142,10 +249,12 @@ def save_tables(concept_rows, relationship_rows, output_dir="omop"):
     """
     Save tables as CSV files
     """
-    os.makedirs(output_dir, exist_ok=True)
+    with span("omop_save", items=len(concept_rows) + len(relationship_rows)) as stage:
+        os.makedirs(output_dir, exist_ok=True)
 
-    concept_df = pd.DataFrame([vars(row) for row in concept_rows])
-    concept_df.to_csv(f"{output_dir}/CONCEPT.csv", index=False)
+        concept_df = pd.DataFrame([vars(row) for row in concept_rows])
+        concept_df.to_csv(f"{output_dir}/CONCEPT.csv", index=False)
 
-    relationship_df = pd.DataFrame([vars(row) for row in relationship_rows])
-    relationship_df.to_csv(f"{output_dir}/CONCEPT_RELATIONSHIP.csv", index=False)
\ No newline at end of file
+        relationship_df = pd.DataFrame([vars(row) for row in relationship_rows])
+        relationship_df.to_csv(f"{output_dir}/CONCEPT_RELATIONSHIP.csv", index=False)
+        stage.record(bytes_written=path_bytes(f"{output_dir}/CONCEPT.csv", f"{output_dir}/CONCEPT_RELATIONSHIP.csv"))
@@ -0,0 +1,296 @@
+import argparse
+import hashlib
+import json
+import os
+import struct
+from datetime import datetime
+import numpy as np
+from src.data_utils import TargetConcept, TargetConceptTable, read_and_validate_csv
+from src.match_utils import ModelHandler, normalize_rows
+from src.quant_utils import (STORAGE_DTYPES, dequantize, measure_fidelity, quantize, quantized_scores, quantized_top_k,
+                             sample_queries)
+
+## Vocab packs (.vpack): a target table together with its embeddings and search index, in one versioned file.
+##
+## Layout: MAGIC | uint32 format version | uint64 header length | JSON header | arrays
+## Every array starts on a 64 byte boundary, so the whole file is opened with a single read-only
+## memory map and each array is a zero-copy view into it. Sessions in several Streamlit processes
+## opening the same pack therefore share the same pages of the OS page cache.
+##
+## Arrays:
+##   concept_id                       int64 [n]
+##   <column>_data / <column>_offsets  utf-8 bytes + int64 [n + 1] offsets, for concept_code, concept_name, vocabulary_id
+##   embeddings                       float16/float32/int8 [n, dim], L2 normalised, so cosine similarity is a dot product
+##   embedding_scales                 float32 [n], int8 packs only: each vector is its int8 values * its scale
+##   id_order                         int64 [n], argsort of concept_id, the index for concept_id -> row lookups
+
+PACK_MAGIC = b"OMAPVPK\x00"
+PACK_FORMAT_VERSION = 2
+# version 1 packs are the same layout without int8 embeddings
+SUPPORTED_PACK_VERSIONS = (1, 2)
+PACK_ALIGNMENT = 64
+STRING_COLUMNS = ['concept_code', 'concept_name', 'vocabulary_id']
+
+_open_packs = {}
+
+
+def _aligned(offset):
+    return (offset + PACK_ALIGNMENT - 1) // PACK_ALIGNMENT * PACK_ALIGNMENT
+
+
+def encode_strings(values):
+    """
+    Pack a list of strings into one utf-8 byte array and an offsets array
+    """
+    encoded = [str(value).encode() for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def hash_target_table(target_table, model_path, backend):
+    """
+    Content hash of the concepts a pack embeds, and the model used to embed them
+    """
+    hash_obj = hashlib.sha256(f"{model_path}\x1f{backend}".encode())
+    for concept in target_table.concepts:
+        hash_obj.update(
+            f"\x1e{concept.concept_id}\x1f{concept.concept_code}\x1f{concept.concept_name}\x1f{concept.vocabulary_id}".encode()
+        )
+    return hash_obj.hexdigest()
+
+
+def write_vocab_pack(pack_path, target_table, embeddings, metadata, scales=None):
+    """
+    Write a target table and its (already normalised, possibly quantized) embeddings as a single pack file
+    """
+    concept_ids = np.array([concept.concept_id for concept in target_table.concepts], dtype=np.int64)
+    arrays = {
+        'concept_id': concept_ids,
+        'id_order': np.argsort(concept_ids, kind="stable").astype(np.int64),
+        'embeddings': np.ascontiguousarray(embeddings)
+    }
+    if scales is not None:
+        arrays['embedding_scales'] = np.asarray(scales, dtype=np.float32)
+    for column in STRING_COLUMNS:
+        data, offsets = encode_strings([getattr(concept, column) for concept in target_table.concepts])
+        arrays[f"{column}_data"] = data
+        arrays[f"{column}_offsets"] = offsets
+
+    # array offsets are relative to the start of the data section, which follows the header
+    layout = {}
+    position = 0
+    for name, array in arrays.items():
+        position = _aligned(position)
+        layout[name] = {'offset': position, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        position += array.nbytes
+
+    header = dict(metadata, format_version=PACK_FORMAT_VERSION, count=len(concept_ids), arrays=layout)
+    header_bytes = json.dumps(header).encode()
+    data_start = _aligned(len(PACK_MAGIC) + 12 + len(header_bytes))
+
+    os.makedirs(os.path.dirname(pack_path) or ".", exist_ok=True)
+    tmp_path = f"{pack_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(PACK_MAGIC)
+        f.write(struct.pack("<IQ", PACK_FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(array.tobytes())
+    os.replace(tmp_path, pack_path)
+
+
+def build_vocab_pack(target_table, model_handler, pack_path, dtype="float16"):
+    """
+    Embed a target table with a loaded ModelHandler and write it as a vocab pack
+    float16 and int8 packs record how closely their search agrees with float32 search, in the header's 'fidelity'
+    """
+    texts = [concept.concept_name for concept in target_table.concepts]
+    unique_embeddings, inverse = model_handler.deduplicated_embeddings(texts, "target")
+    reference = normalize_rows(np.asarray(unique_embeddings, dtype=np.float32))[inverse]
+    embeddings, scales = quantize(reference, dtype)
+
+    metadata = {
+        'model_path': model_handler.model_path,
+        'backend': model_handler.backend,
+        'dtype': np.dtype(dtype).name,
+        'dim': int(embeddings.shape[1]),
+        'content_hash': hash_target_table(target_table, model_handler.model_path, model_handler.backend),
+        'created': datetime.now().isoformat()
+    }
+    if np.dtype(dtype) != np.float32:
+        metadata['fidelity'] = measure_fidelity(sample_queries(reference, min(1000, len(reference))), reference, dtype)
+    write_vocab_pack(pack_path, target_table, embeddings, metadata, scales)
+    return metadata
+
+
+class VocabPack:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                raise ValueError(f"Not a vocab pack: {path}")
+            version, header_length = struct.unpack("<IQ", f.read(12))
+            if version not in SUPPORTED_PACK_VERSIONS:
+                raise ValueError(f"Unsupported vocab pack version {version} (expected one of {SUPPORTED_PACK_VERSIONS})")
+            self.header = json.loads(f.read(header_length))
+
+        data_start = _aligned(len(PACK_MAGIC) + 12 + header_length)
+        self._mmap = np.memmap(path, dtype=np.uint8, mode="r")
+        self.arrays = {
+            name: np.ndarray(
+                shape=tuple(spec['shape']), dtype=np.dtype(spec['dtype']),
+                buffer=self._mmap, offset=data_start + spec['offset']
+            )
+            for name, spec in self.header['arrays'].items()
+        }
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open a pack memory-mapped, reusing an already open handle in this process
+        """
+        key = (os.path.abspath(path), os.path.getmtime(path))
+        if key not in _open_packs:
+            _open_packs[key] = cls(path)
+        return _open_packs[key]
+
+    def __len__(self):
+        return self.header['count']
+
+    @property
+    def content_hash(self):
+        return self.header['content_hash']
+
+    @property
+    def concept_ids(self):
+        return self.arrays['concept_id']
+
+    @property
+    def embeddings(self):
+        return self.arrays['embeddings']
+
+    @property
+    def scales(self):
+        return self.arrays.get('embedding_scales')
+
+    def float_embeddings(self, rows=None):
+        """
+        float32 embeddings, de-quantized if the pack stores int8 (for all rows, or the given rows)
+        """
+        if rows is None:
+            return dequantize(self.embeddings, self.scales)
+        return dequantize(self.embeddings[rows], self.scales[rows] if self.scales is not None else None)
+
+    def column(self, column):
+        """
+        Decode one string column in full
+        """
+        data = self.arrays[f"{column}_data"].tobytes()
+        offsets = self.arrays[f"{column}_offsets"]
+        return [data[offsets[i]:offsets[i + 1]].decode() for i in range(len(self))]
+
+    def value(self, column, row):
+        offsets = self.arrays[f"{column}_offsets"]
+        return self.arrays[f"{column}_data"][offsets[row]:offsets[row + 1]].tobytes().decode()
+
+    def rows_for_ids(self, concept_ids):
+        """
+        Row positions for concept_ids, -1 where a concept_id is not in the pack
+        """
+        concept_ids = np.asarray(concept_ids, dtype=np.int64)
+        id_order = self.arrays['id_order']
+        sorted_ids = self.concept_ids[id_order]
+        positions = np.clip(np.searchsorted(sorted_ids, concept_ids), 0, len(self) - 1)
+        rows = id_order[positions]
+        return np.where(sorted_ids[positions] == concept_ids, rows, -1)
+
+    def to_target_table(self):
+        columns = {column: self.column(column) for column in STRING_COLUMNS}
+        return TargetConceptTable([
+            TargetConcept(
+                concept_id=int(concept_id),
+                concept_code=columns['concept_code'][i],
+                concept_name=columns['concept_name'][i],
+                vocabulary_id=columns['vocabulary_id'][i]
+            )
+            for i, concept_id in enumerate(self.concept_ids)
+        ])
+
+    def similarities(self, query_embeddings, block_size=8192, inverse=None, query_block_size=1024):
+        """
+        Cosine similarity of query embeddings against every pack concept, [n_queries, n_concepts] float32
+        The pack is read in blocks, so float16 and int8 packs are never converted in full
+        With inverse (distinct query embeddings, e.g. from deduplicated_embeddings), the result has one row per
+        entry of inverse: each distinct query is scored once and its block of scores copied straight to its rows,
+        so no separate [n_distinct, n_concepts] matrix is built
+        """
+        queries = normalize_rows(np.asarray(query_embeddings, dtype=np.float32))
+        if inverse is None:
+            return quantized_scores(queries, self.embeddings, self.scales, block_size)
+
+        inverse = np.asarray(inverse)
+        similarities = np.empty((len(inverse), len(self)), dtype=np.float32)
+        rows = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[rows], np.arange(0, len(queries) + query_block_size, query_block_size))
+        for block_idx, start in enumerate(range(0, len(queries), query_block_size)):
+            block_rows = rows[bounds[block_idx]:bounds[block_idx + 1]]
+            block = quantized_scores(queries[start:start + query_block_size], self.embeddings, self.scales, block_size)
+            similarities[block_rows] = block[inverse[block_rows] - start]
+        return similarities
+
+    def check_model(self, model_handler):
+        """
+        None if the pack was embedded with the handler's model and backend, else why its embeddings don't compare
+        Backends differ slightly (int8 and onnx approximate torch), so scores are only comparable within one backend
+        """
+        embedded_with = (self.header['model_path'], self.header.get('backend', "torch"))
+        if embedded_with != (model_handler.model_path, model_handler.backend):
+            return (f"Vocab pack was embedded with {embedded_with[0]} ({embedded_with[1]}), "
+                    f"not {model_handler.model_path} ({model_handler.backend})")
+        return None
+
+    def search(self, query_embeddings, k=10, skip_no_match=False):
+        """
+        Top-k pack rows and scores for each query embedding, best first, keeping only a running top-k per
+        block of the pack, so no [n_queries, n_concepts] matrix is built
+        With skip_no_match, the 'No matching concept' row (concept_id 0) is never one of the candidates
+        """
+        queries = normalize_rows(np.asarray(query_embeddings, dtype=np.float32))
+        return quantized_top_k(queries, self.embeddings, self.scales, k,
+                               exclude=self.concept_ids == 0 if skip_no_match else None)
+
+
+def list_vocab_packs(pack_dir="concepts/packs"):
+    if not os.path.exists(pack_dir):
+        return []
+    return sorted(f for f in os.listdir(pack_dir) if f.endswith(".vpack"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a vocab pack (concepts + embeddings + index) for a target table")
+    parser.add_argument("target_path", help="Target concepts CSV, or a parquet vocabulary pack from src.vocab_utils")
+    parser.add_argument("pack_path", help="Output .vpack file")
+    parser.add_argument("--backend", default="torch", choices=ModelHandler.backends)
+    parser.add_argument("--dtype", default="float16", choices=STORAGE_DTYPES)
+    args = parser.parse_args()
+
+    if args.target_path.endswith(".parquet"):
+        success, target_table = TargetConceptTable.from_pack(args.target_path)
+    else:
+        success, target_table = read_and_validate_csv(args.target_path, TargetConceptTable)
+    if not success:
+        raise SystemExit(target_table)
+
+    model_handler = ModelHandler(backend=args.backend)
+    load_success, message = model_handler.load_model()
+    if not load_success:
+        raise SystemExit(message)
+
+    metadata = build_vocab_pack(target_table, model_handler, args.pack_path, args.dtype)
+    print(f"[INFO] Wrote {args.pack_path}: {len(target_table.concepts)} concepts, content hash {metadata['content_hash'][:12]}")
+    if 'fidelity' in metadata:
+        fidelity = metadata['fidelity']
+        print(f"[INFO] {args.dtype} vs float32: top-1 agreement {fidelity['top1_agreement']:.1%}, "
+              f"top-{fidelity['k']} overlap {fidelity['topk_overlap']:.1%}, {fidelity['compression']:.1f}x smaller")
@@ -0,0 +1,107 @@
+import numpy as np
+from src.array_utils import normalize_rows, top_k_indices
+
+## Quantized embedding storage: float16, or int8 with one float32 scale per vector (x ~= int8 value * scale).
+## Scores against int8 vectors are computed a block at a time as float32 dot products with the int8 values,
+## multiplied by each vector's scale, so searching a quantized matrix never expands it in full.
+## measure_fidelity reports how often quantized search agrees with float32 search, keeping only a running top-k.
+## (Saved session embeddings are the exception: load_session_embeddings de-quantizes int8 ones to float32.)
+
+STORAGE_DTYPES = ["float32", "float16", "int8"]
+
+
+def quantize(embeddings, dtype="float32"):
+    """
+    Returns (values, scales); scales is None unless dtype is int8
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype != "int8":
+        return embeddings.astype(dtype), None
+    scales = np.abs(embeddings).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    values = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+    return values, scales.astype(np.float32)
+
+
+def dequantize(values, scales=None):
+    values = np.asarray(values, dtype=np.float32)
+    return values if scales is None else values * np.asarray(scales, dtype=np.float32)[:, None]
+
+
+def quantized_scores(queries, values, scales=None, block_size=8192):
+    """
+    [n_queries, n_vectors] float32 dot products of float32 queries with stored (possibly quantized) vectors
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    scores = np.empty((len(queries), len(values)), dtype=np.float32)
+    for start in range(0, len(values), block_size):
+        block = np.asarray(values[start:start + block_size], dtype=np.float32)
+        scores[:, start:start + block_size] = queries @ block.T
+        if scales is not None:
+            scores[:, start:start + block_size] *= scales[start:start + block_size]
+    return scores
+
+
+def quantized_top_k(queries, values, scales=None, k=10, block_size=8192, exclude=None):
+    """
+    Indices and scores of the k best stored vectors per query, best first, merging each block's top-k into a
+    running top-k so no [n_queries, n_vectors] score matrix is built
+    exclude is an optional boolean mask of stored vectors that are never returned
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    k = min(k, len(values) if exclude is None else int(np.count_nonzero(~exclude)))
+    top_indices = np.empty((len(queries), 0), dtype=np.int64)
+    top_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(values), block_size):
+        block_scores = quantized_scores(queries, values[start:start + block_size],
+                                        scales[start:start + block_size] if scales is not None else None, block_size)
+        if exclude is not None:
+            block_scores[:, exclude[start:start + block_size]] = -np.inf
+        block_indices, block_top = top_k_indices(block_scores, k)
+        indices = np.concatenate([top_indices, block_indices + start], axis=1)
+        order, top_scores = top_k_indices(np.concatenate([top_scores, block_top], axis=1), k)
+        top_indices = np.take_along_axis(indices, order, axis=1)
+    return top_indices, top_scores
+
+
+def storage_bytes(values, scales=None):
+    return int(values.nbytes + (scales.nbytes if scales is not None else 0))
+
+
+def measure_fidelity(queries, reference, dtype, k=10):
+    """
+    Top-1 and top-k agreement of search over quantized vectors with float32 search, for the given queries
+    Returns a dict with agreement rates, the largest score error and the storage saving
+    """
+    queries = normalize_rows(queries)
+    reference = np.asarray(reference, dtype=np.float32)
+    values, scales = quantize(reference, dtype)
+    k = min(k, len(reference))
+
+    exact_top, exact_scores = quantized_top_k(queries, reference, k=k)
+    quant_top, _ = quantized_top_k(queries, values, scales, k)
+    # quantized scores of the exact top-k, from just those k vectors per query
+    quant_at_exact = np.einsum("qd,qkd->qk", queries, dequantize(values[exact_top.ravel()],
+                                                                 scales[exact_top.ravel()] if scales is not None else None
+                                                                 ).reshape(*exact_top.shape, -1))
+
+    overlap = [len(set(exact_row) & set(quant_row)) / k for exact_row, quant_row in zip(exact_top, quant_top)]
+    return {
+        'dtype': dtype,
+        'queries': len(queries),
+        'k': k,
+        'top1_agreement': float(np.mean(exact_top[:, 0] == quant_top[:, 0])),
+        'topk_overlap': float(np.mean(overlap)),
+        'max_score_error': float(np.abs(quant_at_exact - exact_scores).max()),
+        'compression': reference.nbytes / storage_bytes(values, scales)
+    }
+
+
+def sample_queries(embeddings, n=1000, noise=0.5, seed=0):
+    """
+    Synthetic queries near the stored vectors (random ones, perturbed), for when no real queries are at hand
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(len(embeddings), size=n)
+    perturbation = normalize_rows(rng.standard_normal((n, embeddings.shape[1])).astype(np.float32))
+    return normalize_rows(np.asarray(embeddings[rows], dtype=np.float32) + noise * perturbation)
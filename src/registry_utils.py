@@ -0,0 +1,293 @@
+from contextlib import contextmanager
+from datetime import datetime
+import fcntl
+import json
+import os
+from src.data_utils import generate_source_key
+
+## Global index of confirmed mappings across all sessions, in sessions/mapping_index.json
+## Keyed by source_key and target vocabulary, so a source concept reviewed once is not reviewed again:
+## new sessions apply known mappings at creation, and every confirmation updates the index and
+## reports collisions with other sessions straight away, instead of at OMOP conversion.
+
+INDEX_FILENAME = "mapping_index.json"
+KEYS_FILENAME = "source_keys.jsonl"
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive advisory lock on path + '.lock', held for the duration of the block (across processes)
+    fcntl locks are Unix-only (Linux, macOS), and only hold between processes sharing a local file system
+    """
+    with open(f"{path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def file_stamp(path):
+    """
+    (inode, mtime, size) of a file, or None if it does not exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def target_vocabulary(target_table):
+    """
+    Identifier of the vocabulary a session maps into, e.g. 'dm+d' or 'RxNorm'
+    """
+    vocabularies = {concept.vocabulary_id for concept in target_table.concepts if concept.concept_id != 0}
+    return "+".join(sorted(vocabularies)) or "None"
+
+
+def index_key(source_key, vocabulary):
+    return f"{source_key}|{vocabulary}"
+
+
+def session_name(session):
+    return f"{session.project_name}_{session.timestamp}"
+
+
+class MappingIndex:
+    def __init__(self, sessions_dir="sessions"):
+        self.path = os.path.join(sessions_dir, INDEX_FILENAME)
+        self.mappings = {}
+        self.stamp = None    # (inode, mtime, size) of the index file last read
+
+    def _read(self):
+        self.stamp = file_stamp(self.path)
+        if self.stamp is not None:
+            with open(self.path, 'r') as f:
+                self.mappings = json.load(f)['mappings']
+        else:
+            self.mappings = {}
+
+    def _write(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'mappings': self.mappings}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with file_lock(self.path):
+            self._read()
+        return self
+
+    def refresh(self):
+        """
+        Reload the index only if the file changed since it was last read; the lock is taken only for the reload
+        The index is always replaced as a whole (a new inode), so an unchanged stamp means unchanged mappings
+        """
+        if file_stamp(self.path) != self.stamp:
+            self.load()
+        return self
+
+    def lookup(self, source_key, vocabulary):
+        return self.mappings.get(index_key(source_key, vocabulary))
+
+    def find_collisions(self, session_id, source_key, target_concept_id):
+        """
+        Confirmed mappings of the same source_key in other sessions that point at a different target
+        (OMOP conversion cannot give one source concept two different targets)
+        """
+        prefix = f"{source_key}|"
+        return [
+            entry for key, entry in self.mappings.items()
+            if key.startswith(prefix) and entry['session'] != session_id
+            and entry['target_concept_id'] != target_concept_id
+        ]
+
+    def record_confirmations(self, session, matches):
+        """
+        Bring the index up to date with these matches from a session, under the index lock
+        Confirmed / rejected matches are added (the first session to confirm a key owns it),
+        matches reset to unconfirmed are removed. Returns collisions with other sessions.
+        """
+        session_id = session_name(session)
+        vocabulary = target_vocabulary(session.target_table)
+        collisions = []
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with file_lock(self.path):
+            self._read()
+            for match in matches:
+                key = index_key(match.source_key, vocabulary)
+                entry = self.mappings.get(key)
+
+                if match.confirmation_status in ("True", "Rejected"):
+                    for other in self.find_collisions(session_id, match.source_key, match.target_concept_id):
+                        collisions.append({
+                            'source_key': match.source_key,
+                            'target_concept_id': match.target_concept_id,
+                            'other_session': other['session'],
+                            'other_target_concept_id': other['target_concept_id'],
+                            'other_target_vocabulary': other['target_vocabulary']
+                        })
+                    if entry is None or entry['session'] == session_id:
+                        self.mappings[key] = {
+                            'source_key': match.source_key,
+                            'target_vocabulary': vocabulary,
+                            'target_concept_id': match.target_concept_id,
+                            'confirmation_status': match.confirmation_status,
+                            'session': session_id,
+                            'first_confirmation_timestamp': (match.first_confirmation_timestamp.isoformat()
+                                                             if match.first_confirmation_timestamp else None),
+                            'last_update_timestamp': (match.last_update_timestamp.isoformat()
+                                                      if match.last_update_timestamp else None)
+                        }
+                elif entry is not None and entry['session'] == session_id:
+                    del self.mappings[key]
+            self._write()
+
+        return collisions
+
+
+def apply_known_mappings(concept_matches, target_table, index):
+    """
+    Pre-confirm matches whose source_key was already confirmed against the same target vocabulary in another session
+    The original confirmation timestamps are kept, so OMOP concept_id ordering is unchanged
+    Returns the number of matches applied
+    """
+    vocabulary = target_vocabulary(target_table)
+    target_ids = {concept.concept_id for concept in target_table.concepts}
+    applied = 0
+
+    for match in concept_matches:
+        entry = index.lookup(match.source_key, vocabulary)
+        if entry is None or entry['target_concept_id'] not in target_ids:
+            continue
+        match.target_concept_id = entry['target_concept_id']
+        match.similarity_score = None
+        match.confirmation_status = entry['confirmation_status']
+        match.first_confirmation_timestamp = (datetime.fromisoformat(entry['first_confirmation_timestamp'])
+                                              if entry['first_confirmation_timestamp'] else None)
+        match.last_update_timestamp = (datetime.fromisoformat(entry['last_update_timestamp'])
+                                       if entry['last_update_timestamp'] else None)
+        applied += 1
+
+    return applied
+
+
+## Source key registry, in sessions/source_keys.jsonl: one JSON line per source concept ever ingested, with its key.
+## A concept keeps the key it was first registered with, so re-ingested concepts of sessions saved with 9 digit keys
+## keep those. A new concept whose hashed key is already taken by a different concept is given the next salted key
+## at ingest, rather than surfacing as a duplicate key at OMOP conversion.
+## The file is append-only and never compacted: keys must stay stable, so entries of deleted sessions are kept,
+## and each process reads it whole once (then only what was appended). Appends are serialised with file_lock
+## (fcntl), so the registry, like the match journal, needs a Unix host.
+
+def concept_text(concept):
+    return (concept.concept_code, concept.concept_name, concept.vocabulary_id)
+
+
+class SourceKeyRegistry:
+    def __init__(self, sessions_dir="sessions"):
+        self.path = os.path.join(sessions_dir, KEYS_FILENAME)
+        self.keys = {}       # (concept_code, concept_name, vocabulary_id) -> source_key
+        self.concepts = {}   # source_key -> (concept_code, concept_name, vocabulary_id) it was first registered for
+        self.offset = 0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _read_new(self):
+        """
+        Read lines appended since the last read (by this or another process)
+        """
+        if not self.exists():
+            return
+        with open(self.path, 'r') as f:
+            f.seek(self.offset)
+            for line in f:
+                entry = json.loads(line)
+                self._add((entry['concept_code'], entry['concept_name'], entry['vocabulary_id']), entry['source_key'])
+            self.offset = f.tell()
+
+    def _add(self, text, source_key):
+        self.keys.setdefault(text, source_key)
+        self.concepts.setdefault(source_key, text)
+
+    def _append(self, entries):
+        with open(self.path, 'a') as f:
+            for text, source_key in entries:
+                f.write(json.dumps({'source_key': source_key, 'concept_code': text[0], 'concept_name': text[1],
+                                    'vocabulary_id': text[2]}) + "\n")
+
+    def load(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with file_lock(self.path):
+            self._read_new()
+        return self
+
+    def refresh(self):
+        """
+        Read new entries only if the file grew since it was last read; the lock is taken only for that read
+        """
+        if self.exists() and os.path.getsize(self.path) != self.offset:
+            self.load()
+        return self
+
+    def key_for(self, concept_code, concept_name, vocabulary_id):
+        return self.keys.get((concept_code, concept_name, vocabulary_id))
+
+    def seed(self, concepts):
+        """
+        Register concepts with the keys they were saved with (e.g. every saved session's sources), once,
+        before the registry is first used; returns pre-existing collisions, as (source_key, [texts])
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with file_lock(self.path):
+            if self.exists():
+                self._read_new()
+                return []
+            entries, collisions = [], {}
+            for concept in concepts:
+                text = concept_text(concept)
+                if text in self.keys:
+                    continue
+                owner = self.concepts.get(concept.source_key)
+                if owner is not None and owner != text:
+                    collisions.setdefault(concept.source_key, [owner]).append(text)
+                self._add(text, concept.source_key)
+                entries.append((text, concept.source_key))
+            self._append(entries)
+            self.offset = os.path.getsize(self.path)
+        return list(collisions.items())
+
+    def resolve(self, source_table):
+        """
+        Give a freshly read source table's concepts their registered keys, registering new concepts
+        Keys are changed in place; returns the collisions resolved, one dict per concept given a salted key
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        resolved = []
+        with file_lock(self.path):
+            self._read_new()
+            entries = []
+            for concept in source_table.concepts:
+                text = concept_text(concept)
+                source_key = self.keys.get(text)
+                if source_key is None:
+                    source_key, salt = concept.source_key, 0
+                    while source_key in self.concepts:
+                        salt += 1
+                        source_key = generate_source_key(*text, salt=salt)
+                    if salt:
+                        resolved.append({'concept_code': text[0], 'concept_name': text[1], 'vocabulary_id': text[2],
+                                         'hashed_key': concept.source_key, 'source_key': source_key,
+                                         'collided_with': self.concepts[concept.source_key]})
+                    self._add(text, source_key)
+                    entries.append((text, source_key))
+                concept.source_key = source_key
+            self._append(entries)
+            # nothing else can have appended while the lock was held
+            self.offset = os.path.getsize(self.path)
+        return resolved
@@ -0,0 +1,142 @@
+import re
+import time
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from src.match_utils import normalize_concept_text
+
+## Two-stage matching: the BioLORD bi-encoder (ModelHandler) retrieves the top-k targets for each source concept,
+## then a re-ranker scores only those k pairs. Closely related drug products (same ingredient, different strength
+## or form) tend to sit close together under mean pooled cosine, which is what the second stage is for.
+## Re-rankers take (source_texts, target_texts, bi_encoder_scores) and return one float32 score per pair.
+
+NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+
+
+def _jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class FeatureReranker:
+    """
+    Blends the bi-encoder score with lexical features it blurs: shared words, and agreement of numbers (strengths)
+    Needs no model, so it is cheap enough to run over every candidate
+    """
+    name = "features"
+
+    def __init__(self, similarity_weight=0.6, word_weight=0.2, number_weight=0.2):
+        self.similarity_weight = similarity_weight
+        self.word_weight = word_weight
+        self.number_weight = number_weight
+
+    def load_model(self):
+        return True, "Feature re-ranker ready"
+
+    def score_pairs(self, source_texts, target_texts, bi_encoder_scores):
+        scores = np.empty(len(source_texts), dtype=np.float32)
+        for i, (source, target) in enumerate(zip(source_texts, target_texts)):
+            source, target = normalize_concept_text(source), normalize_concept_text(target)
+            source_numbers, target_numbers = set(NUMBER_PATTERN.findall(source)), set(NUMBER_PATTERN.findall(target))
+            # a strength on only one side is neither a match nor a mismatch
+            number_agreement = 0.5 if bool(source_numbers) != bool(target_numbers) else _jaccard(source_numbers, target_numbers)
+            scores[i] = (
+                self.similarity_weight * bi_encoder_scores[i]
+                + self.word_weight * _jaccard(set(WORD_PATTERN.findall(source)), set(WORD_PATTERN.findall(target)))
+                + self.number_weight * number_agreement
+            )
+        return scores
+
+
+class CrossEncoderReranker:
+    """
+    Scores each (source, target) pair jointly with a sequence classification model from the Hugging Face hub
+    A single logit is read through a sigmoid, otherwise the probability of the last class is used
+    """
+    name = "cross-encoder"
+
+    def __init__(self, model_path="cross-encoder/ms-marco-MiniLM-L-6-v2", cache_dir="models/cross_encoder"):
+        self.model_path = model_path
+        self.cache_dir = cache_dir
+        self.model = None
+        self.tokenizer = None
+
+    def load_model(self):
+        try:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_path, cache_dir=self.cache_dir)
+            self.model = AutoModelForSequenceClassification.from_pretrained(self.model_path, cache_dir=self.cache_dir)
+            self.model.eval()
+            return True, "Cross-encoder loaded successfully"
+        except Exception as e:
+            return False, f"Failed to load cross-encoder: {e}"
+
+    def score_pairs(self, source_texts, target_texts, bi_encoder_scores=None):
+        features = self.tokenizer(list(source_texts), list(target_texts), padding=True, truncation=True,
+                                  return_tensors="pt")
+        features = {key: value.to(self.model.device) for key, value in features.items()}
+        with torch.no_grad():
+            logits = self.model(**features).logits
+        if logits.shape[-1] == 1:
+            scores = torch.sigmoid(logits[:, 0])
+        else:
+            scores = torch.softmax(logits, dim=-1)[:, -1]
+        return scores.float().cpu().numpy()
+
+
+def rerank_candidates(reranker, source_table, target_table, candidate_ids, candidate_scores,
+                      batch_size=32, time_budget=None):
+    """
+    Re-rank each source row's top-k candidates, a batch of source rows at a time
+    The most ambiguous rows (smallest margin between the bi-encoder's top two candidates) go first, so when the
+    time budget (seconds) runs out, the rows left unscored are the ones the bi-encoder was surest about
+    Returns (rerank scores [n, k] float32, NaN for unscored rows, number of rows scored)
+    """
+    target_names = {concept.concept_id: concept.concept_name for concept in target_table.concepts}
+    source_names = [concept.concept_name for concept in source_table.concepts]
+    rerank_scores = np.full(candidate_ids.shape, np.nan, dtype=np.float32)
+
+    if candidate_scores.shape[1] > 1:
+        order = np.argsort(candidate_scores[:, 0] - candidate_scores[:, 1], kind="stable")
+    else:
+        order = np.arange(len(candidate_ids))
+
+    k = candidate_ids.shape[1]
+    start_time = time.perf_counter()
+    scored = 0
+    for start in range(0, len(order), batch_size):
+        if time_budget is not None and time.perf_counter() - start_time > time_budget:
+            break
+        rows = order[start:start + batch_size]
+        scores = reranker.score_pairs(
+            [source_names[row] for row in rows for _ in range(k)],
+            [target_names[int(concept_id)] for row in rows for concept_id in candidate_ids[row]],
+            candidate_scores[rows].reshape(-1)
+        )
+        rerank_scores[rows] = np.asarray(scores, dtype=np.float32).reshape(len(rows), k)
+        scored += len(rows)
+
+    print(f"[INFO] Re-ranked {scored} of {len(order)} source concepts with {reranker.name} "
+          f"in {time.perf_counter() - start_time:.1f}s")
+    return rerank_scores, scored
+
+
+def apply_reranking(concept_matches, source_table, candidate_ids, candidate_scores, rerank_scores):
+    """
+    Point each unconfirmed, re-ranked match at its best re-ranked candidate, keeping both scores on the match
+    Returns the number of matches whose target changed
+    """
+    source_rows = {concept.source_key: row for row, concept in enumerate(source_table.concepts)}
+    changed = 0
+    for match in concept_matches:
+        row = source_rows[match.source_key]
+        if match.confirmation_status in ("True", "Rejected") or np.isnan(rerank_scores[row, 0]):
+            continue
+        best = int(np.argmax(rerank_scores[row]))
+        if int(candidate_ids[row, best]) != match.target_concept_id:
+            changed += 1
+        match.target_concept_id = int(candidate_ids[row, best])
+        match.similarity_score = float(candidate_scores[row, best])
+        match.rerank_score = float(rerank_scores[row, best])
+    return changed
@@ -0,0 +1,354 @@
+import argparse
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import numpy as np
+from src.data_utils import TargetConceptTable, generate_source_key, read_and_validate_csv
+from src.match_utils import ModelHandler, normalize_concept_text, normalize_rows, top_k_indices
+from src.pack_utils import VocabPack
+from src.registry_utils import MappingIndex, target_vocabulary
+from src.session_utils import source_key_registry
+
+## Local lookup service for ETL pipelines: POST /lookup resolves source strings to ranked target concept_ids.
+## - the model and target embeddings stay resident for the life of the process
+## - queries with a concept_code and vocabulary_id are checked against the confirmed-mapping index first
+## - concurrent requests are micro-batched: texts arriving within batch_window seconds share one forward pass
+## - an LRU cache holds the top-k of recent query texts
+##
+## Request:  {"queries": ["dalteparin sodium injection", {"concept_code": "X1", "concept_name": "...", "vocabulary_id": "medchart"}], "k": 5}
+## Response: {"results": [{"query": ..., "source": "registry" | "cache" | "model", "candidates": [{"concept_id", "concept_name", "score"}]}]}
+
+
+class LRUCache:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+
+class MicroBatcher:
+    """
+    Collects texts from concurrent callers and embeds them together on one worker thread
+    A batch is closed after batch_window seconds or max_batch texts, whichever comes first
+    """
+    def __init__(self, embed_fn, batch_window=0.01, max_batch=256):
+        self.embed_fn = embed_fn
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.batches_run = 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, texts):
+        future = Future()
+        self.requests.put((texts, future))
+        return future
+
+    def _run(self):
+        while True:
+            pending = [self.requests.get()]
+            size = len(pending[0][0])
+            deadline = time.monotonic() + self.batch_window
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=remaining))
+                    size += len(pending[-1][0])
+                except queue.Empty:
+                    break
+
+            texts = [text for request_texts, _ in pending for text in request_texts]
+            try:
+                embeddings = self.embed_fn(texts)
+                self.batches_run += 1
+                start = 0
+                for request_texts, future in pending:
+                    future.set_result(embeddings[start:start + len(request_texts)])
+                    start += len(request_texts)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+
+
+class TargetSearchIndex:
+    """
+    Free-text search over a target table's embeddings, for reviewers looking for the right target by hand
+    Query embeddings are kept in a bounded LRU cache, so repeated and edited-back queries skip the model
+    """
+    def __init__(self, model_handler, target_table, target_embeddings=None, cache_size=512, target_inverse=None):
+        """
+        target_embeddings are one row per target concept, or one per distinct name with target_inverse mapping
+        each concept to its row; distinct names are scored once and the scores fanned out per concept
+        """
+        self.model_handler = model_handler
+        self.target_table = target_table
+        if target_embeddings is None:
+            target_embeddings, target_inverse = model_handler.deduplicated_embeddings(
+                [concept.concept_name for concept in target_table.concepts], "target"
+            )
+        # saved session embeddings are already normalised, and may be memory-mapped float16/float32
+        self.target_embeddings = normalize_rows(np.asarray(target_embeddings, dtype=np.float32))
+        self.target_inverse = target_inverse
+        self.query_cache = LRUCache(cache_size)
+
+    def embed_query(self, query):
+        text = normalize_concept_text(query)
+        embedding = self.query_cache.get(text)
+        if embedding is None:
+            embedding = normalize_rows(np.asarray(self.model_handler.batch_generate_embeddings([text]), dtype=np.float32))[0]
+            self.query_cache.put(text, embedding)
+        return embedding
+
+    def search(self, query, k=10):
+        """
+        Ranked (concept_id, concept_name, score) hits for a free-text query
+        """
+        if not query.strip():
+            return []
+        scores = self.target_embeddings @ self.embed_query(query)
+        if self.target_inverse is not None:
+            scores = scores[self.target_inverse]
+        indices, top_scores = top_k_indices(scores[None, :], min(k, len(scores)))
+        return [
+            (self.target_table.concepts[i].concept_id, self.target_table.concepts[i].concept_name, float(score))
+            for i, score in zip(indices[0], top_scores[0])
+        ]
+
+
+class LookupService:
+    def __init__(self, model_handler, target, sessions_dir="sessions", cache_size=10000, batch_window=0.01,
+                 max_batch=256, max_k=50):
+        """
+        target is a TargetConceptTable (embedded once, here) or a VocabPack (embeddings read from the pack)
+        """
+        self.model_handler = model_handler
+        self.max_k = max_k
+        self.cache = LRUCache(cache_size)
+        self.index = MappingIndex(sessions_dir) if sessions_dir else None
+        self.keys = source_key_registry(sessions_dir) if sessions_dir else None
+
+        if isinstance(target, VocabPack):
+            mismatch = target.check_model(model_handler)
+            if mismatch:
+                raise ValueError(mismatch)
+            self.pack = target
+            self.target_table = target.to_target_table()
+            self.target_ids = np.asarray(target.concept_ids, dtype=np.int64)
+        else:
+            self.pack = None
+            self.target_table = target
+            concepts = [concept for concept in target.concepts if concept.concept_id != 0]
+            # one row per distinct name; query scores are fanned out to every concept with target_inverse
+            unique_embeddings, self.target_inverse = model_handler.deduplicated_embeddings(
+                [c.concept_name for c in concepts], "target"
+            )
+            self.target_embeddings = normalize_rows(np.asarray(unique_embeddings, dtype=np.float32))
+            self.target_ids = np.array([concept.concept_id for concept in concepts], dtype=np.int64)
+
+        self.vocabulary = target_vocabulary(self.target_table)
+        self.target_names = {concept.concept_id: concept.concept_name for concept in self.target_table.concepts}
+        self.batcher = MicroBatcher(self._embed, batch_window, max_batch)
+
+    def _embed(self, texts):
+        return normalize_rows(np.asarray(self.model_handler.batch_generate_embeddings(texts), dtype=np.float32))
+
+    def _search(self, query_embeddings, k):
+        if self.pack is not None:
+            rows, scores = self.pack.search(query_embeddings, k, skip_no_match=True)
+            return self.target_ids[rows], scores
+        scores = (query_embeddings @ self.target_embeddings.T)[:, self.target_inverse]
+        indices, scores = top_k_indices(scores, min(k, len(self.target_ids)))
+        return self.target_ids[indices], scores
+
+    def _candidates(self, ids, scores):
+        return [
+            {'concept_id': int(concept_id), 'concept_name': self.target_names.get(int(concept_id), ""), 'score': round(float(score), 4)}
+            for concept_id, score in zip(ids, scores)
+        ]
+
+    def _registry_result(self, query):
+        if self.index is None or not isinstance(query, dict) or 'concept_code' not in query:
+            return None
+        text = (str(query['concept_code']), str(query['concept_name']), str(query['vocabulary_id']))
+        # registered concepts may have a salted or legacy 9 digit key
+        source_key = self.keys.key_for(*text)
+        if source_key is None:
+            source_key = generate_source_key(*text)
+        entry = self.index.lookup(source_key, self.vocabulary)
+        if entry is None:
+            return None
+        concept_id = entry['target_concept_id']
+        return [{'concept_id': concept_id, 'concept_name': self.target_names.get(concept_id, ""), 'score': 1.0,
+                 'confirmation_status': entry['confirmation_status']}]
+
+    def lookup(self, queries, k=10):
+        """
+        Top-k targets per query: confirmed mappings first, then the cache, then one micro-batched model call
+        """
+        k = max(1, min(int(k), self.max_k))
+        # mappings and keys confirmed since the last request are picked up; unchanged files are not re-read
+        if self.index is not None:
+            self.index.refresh()
+            self.keys.refresh()
+
+        results = [None] * len(queries)
+        to_embed = {}
+        for i, query in enumerate(queries):
+            text = normalize_concept_text(query['concept_name'] if isinstance(query, dict) else str(query))
+            registry = self._registry_result(query)
+            if registry is not None:
+                results[i] = {'query': query, 'source': "registry", 'candidates': registry}
+                continue
+            cached = self.cache.get((text, k))
+            if cached is not None:
+                results[i] = {'query': query, 'source': "cache", 'candidates': cached}
+                continue
+            to_embed.setdefault(text, []).append(i)
+
+        if to_embed:
+            texts = list(to_embed)
+            embeddings = self.batcher.submit(texts).result()
+            ids, scores = self._search(embeddings, k)
+            for row, text in enumerate(texts):
+                candidates = self._candidates(ids[row], scores[row])
+                self.cache.put((text, k), candidates)
+                for i in to_embed[text]:
+                    results[i] = {'query': queries[i], 'source': "model", 'candidates': candidates}
+
+        return results
+
+    def stats(self):
+        return {
+            'targets': len(self.target_ids),
+            'vocabulary': self.vocabulary,
+            'cache_size': len(self.cache.items),
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'model_batches': self.batcher.batches_run
+        }
+
+
+class LookupRequestHandler(BaseHTTPRequestHandler):
+    service = None  # set on the server class by make_server
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, dict(self.server.service.stats(), status="ok"))
+        else:
+            self._send(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/lookup":
+            self._send(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            queries = request['queries']
+            if not isinstance(queries, list):
+                raise ValueError("'queries' must be a list")
+        except Exception as e:
+            self._send(400, {'error': f"Bad request: {e}"})
+            return
+        try:
+            self._send(200, {'results': self.server.service.lookup(queries, request.get('k', 10))})
+        except Exception as e:
+            self._send(500, {'error': f"Lookup failed: {e}"})
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        # unix socket clients have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else "unix"
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def make_server(service, host="127.0.0.1", port=8765, socket_path=None):
+    """
+    HTTP server for a LookupService on host:port, or on a Unix socket if socket_path is given
+    Call serve_forever() on the result, or run it in a thread
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, LookupRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), LookupRequestHandler)
+    server.service = service
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve top-k target concept lookups for ETL pipelines")
+    parser.add_argument("target_path", help="Vocab pack (.vpack), parquet vocabulary pack, or target concepts CSV")
+    parser.add_argument("--backend", default="torch", choices=ModelHandler.backends)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", help="Serve on this Unix socket path instead of host:port")
+    parser.add_argument("--sessions-dir", default="sessions", help="Directory holding mapping_index.json")
+    parser.add_argument("--cache-size", type=int, default=10000)
+    parser.add_argument("--batch-window-ms", type=float, default=10)
+    args = parser.parse_args()
+
+    model_handler = ModelHandler(backend=args.backend)
+    load_success, message = model_handler.load_model()
+    if not load_success:
+        raise SystemExit(message)
+
+    if args.target_path.endswith(".vpack"):
+        target = VocabPack.open(args.target_path)
+    else:
+        if args.target_path.endswith(".parquet"):
+            success, target = TargetConceptTable.from_pack(args.target_path)
+        else:
+            success, target = read_and_validate_csv(args.target_path, TargetConceptTable)
+        if not success:
+            raise SystemExit(target)
+
+    service = LookupService(model_handler, target, args.sessions_dir, args.cache_size, args.batch_window_ms / 1000)
+    server = make_server(service, args.host, args.port, args.socket)
+    print(f"[INFO] Serving lookups for {service.stats()['targets']} {service.vocabulary} concepts on "
+          f"{args.socket or f'http://{args.host}:{args.port}'}")
+    server.serve_forever()
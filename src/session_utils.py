@@ -1,26 +1,66 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from datetime import datetime
+import atexit
 import os
 import json
+import threading
+import time
+import weakref
 import numpy as np
 import pickle
+from src.blob_utils import load_table, store_table
+from src.checkpoint_utils import write_json_atomic
 from src.data_utils import SourceConceptTable, TargetConceptTable, ConceptMatch
+from src.registry_utils import MappingIndex, SourceKeyRegistry, apply_known_mappings, file_lock
+from src.quant_utils import dequantize, measure_fidelity, quantize
+from src.trace_utils import path_bytes, save_run_report, span
 
 ## TO DO
 ## Add docstrings
 
+## Concurrent review: each reviewer's edits are appended, row by row, to the session's match_journal.jsonl
+## under a file lock, with a sequence number. A session copy remembers the last sequence number it has seen
+## (its version); an edit to a row that someone else changed after that version, to a different value,
+## is a conflict and is not written. concept_matches.json plus the journal is the current state,
+## and the journal is folded back into concept_matches.json once it grows past JOURNAL_COMPACT_ROWS.
+## Each row of concept_matches.json keeps the sequence number it last changed at, so a copy older than the
+## file still finds (and conflicts with) the rows changed since its version. Whole-session rewrites take a new
+## sequence number for every row they change.
+
+JOURNAL_COMPACT_ROWS = 1000
+# similarity_score older sessions stored for targets the model did not choose; read back as None
+LEGACY_NO_SCORE = -1.0
+
 @dataclass
 class ProjectSession:
     project_name: str
     timestamp: str
     source_table: SourceConceptTable
     target_table: TargetConceptTable
-    similarity_matrix: np.ndarray
+    # read-only memory map when loaded from disk, None if the session was saved without one
+    similarity_matrix: np.ndarray | None
     concept_matches: list[ConceptMatch]
+    # top-k target concept_ids and scores per source concept, row aligned with source_table.concepts
+    candidate_target_ids: np.ndarray | None = None
+    candidate_scores: np.ndarray | None = None
+    # last match journal sequence number merged into concept_matches
+    version: int = 0
+    # multi-vocabulary sessions: {label: [concept_ids]} and {label: (top-k ids, scores)}, row aligned with sources
+    target_partitions: dict | None = None
+    partition_candidates: dict | None = None
 
     @classmethod
-    def create_and_save_session(cls, project_name, source_table, target_table, similarity_matrix, concept_matches):
+    def create_and_save_session(cls, project_name, source_table, target_table, similarity_matrix, concept_matches,
+                                source_embeddings=None, target_embeddings=None, candidates=None,
+                                sessions_dir="sessions", reuse_mappings=True, similarity_dtype="float32",
+                                target_partitions=None, partition_candidates=None, embedding_dtype="float32",
+                                source_inverse=None, target_inverse=None, model_path=None, backend=None):
         try:
+            # source concepts already confirmed against this vocabulary in another session are not reviewed again
+            reused = 0
+            if reuse_mappings:
+                reused = apply_known_mappings(concept_matches, target_table, MappingIndex(sessions_dir).load())
+
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             session = cls(
                 project_name=project_name,
@@ -28,52 +68,630 @@ class ProjectSession:
                 source_table=source_table,
                 target_table=target_table,
                 similarity_matrix=similarity_matrix,
-                concept_matches=concept_matches
+                concept_matches=concept_matches,
+                candidate_target_ids=candidates[0] if candidates is not None else None,
+                candidate_scores=candidates[1] if candidates is not None else None,
+                target_partitions=target_partitions,
+                partition_candidates=partition_candidates
             )
 
-            session_dir = f"sessions/{project_name}_{timestamp}"
-            os.makedirs(session_dir)
-
-            metadata = {
-                'project_name': session.project_name,
-                'timestamp': session.timestamp,
-                'source_count': len(session.source_table.concepts),
-                'target_count': len(session.target_table.concepts),
-                'similarity_matrix_size': session.similarity_matrix.shape,
-                'matches_count': len(session.concept_matches)
-            }
-
-            with open(f"{session_dir}/metadata.json", 'w') as f:
-                json.dump(metadata, f, indent=4)
-
-            with open(f"{session_dir}/source_concepts.pkl", 'wb') as f:
-                pickle.dump(session.source_table, f)
-
-            with open(f"{session_dir}/target_concepts.pkl", 'wb') as f:
-                pickle.dump(session.target_table, f)
-
-            np.save(f"{session_dir}/similarities.npy", session.similarity_matrix)
-
-            # save concept matches as JSON
-            matches_json = []
-            for match in session.concept_matches:
-                matches_json.append({
-                    "source_key": match.source_key,
-                    "target_concept_id": match.target_concept_id,
-                    "similarity_score": f"{float(match.similarity_score):.3f}",
-                    "confirmation_status": False,
-                    "first_confirmation_timestamp": None,
-                    "last_update_timestamp": None
-                })
-
-            with open(f"{session_dir}/concept_matches.json", 'w') as f:
-                json.dump(matches_json, f, indent=2)
-
+            session_dir = get_session_dir(session, sessions_dir)
+            with span("session_save", items=len(session.concept_matches)) as stage:
+                os.makedirs(session_dir)
+
+                metadata = {
+                    'project_name': session.project_name,
+                    'timestamp': session.timestamp,
+                    'source_count': len(session.source_table.concepts),
+                    'target_count': len(session.target_table.concepts),
+                    'similarity_matrix_size': session.similarity_matrix.shape if session.similarity_matrix is not None else None,
+                    'similarity_dtype': np.dtype(similarity_dtype).name,
+                    'matches_count': len(session.concept_matches),
+                    'reused_mappings': reused,
+                    'embedding_dtype': embedding_dtype,
+                    # model and backend the embeddings were made with, so search on the Mapping page embeds alike
+                    'model_path': model_path,
+                    'backend': backend,
+                    # concept tables are kept once per distinct content in the shared store, see src/blob_utils.py
+                    'source_table_hash': store_table(session.source_table, sessions_dir),
+                    'target_table_hash': store_table(session.target_table, sessions_dir)
+                }
+                # how closely search over the stored embeddings agrees with float32, using the real sources as queries
+                if embedding_dtype != "float32" and source_embeddings is not None and target_embeddings is not None:
+                    metadata['embedding_fidelity'] = measure_fidelity(source_embeddings[:1000], target_embeddings,
+                                                                      embedding_dtype)
+
+                write_json_atomic(f"{session_dir}/metadata.json", metadata, indent=4)
+
+                # candidate-only runs (e.g. hierarchical matching) have no full similarity matrix
+                if session.similarity_matrix is not None:
+                    save_similarity_matrix(session_dir, session.similarity_matrix, similarity_dtype)
+
+                # save concept matches as JSON
+                write_concept_matches(session_dir, session.concept_matches, 0)
+
+                # embeddings and candidates allow incremental re-matching without re-embedding everything
+                save_session_embeddings(session_dir, source_embeddings, target_embeddings, embedding_dtype,
+                                        source_inverse, target_inverse)
+                save_session_candidates(session_dir, session)
+                save_partition_candidates(session_dir, session)
+                stage.record(bytes_written=path_bytes(session_dir))
+
+            # timings of the run that produced this session, shown on the Mapping page
+            save_run_report(f"{session_dir}/run_report.json")
+
+            if reused:
+                return True, f"Session saved successfully in {session_dir} ({reused} mappings reused from earlier sessions)"
             return True, f"Session saved successfully in {session_dir}"
 
         except Exception as e:
             return False, f"Failed to create session: {e}"
 
+_live_writers = weakref.WeakSet()
+
+
+class SessionWriter:
+    """
+    Background writer for one session copy: edited matches are queued, coalesced by source_key, and written
+    together (commit_match_updates, then the mapping index) once `interval` seconds have passed since the first
+    queued edit. Callers never wait on disk; write lag is reported by lag() / status().
+    The writer also merges other reviewers' edits into the session, so the page syncs through it (sync()).
+    Each queued edit keeps the version it was made against, so a sync while it waits cannot hide a conflict.
+    The worker thread stops after `idle_timeout` seconds with nothing queued (e.g. the tab was closed) and the
+    next submit starts it again.
+    """
+    def __init__(self, session, sessions_dir="sessions", interval=1.0, record_index=True, idle_timeout=300):
+        self.session = session
+        self.sessions_dir = sessions_dir
+        self.interval = interval
+        self.record_index = record_index
+        self.idle_timeout = idle_timeout
+
+        self.condition = threading.Condition()
+        self.session_lock = threading.Lock()  # held while the session copy is merged / written
+        self.idle = threading.Event()
+        self.idle.set()
+        self.pending = {}  # source_key -> (edited match, version the edit was made against)
+        self.first_pending_at = None
+        self.flush_requested = False
+        self.closed = False
+
+        # results for the page to pick up
+        self.conflicts = []
+        self.collisions = []
+        self.errors = []
+        self.writes = 0
+        self.rows_written = 0
+        self.last_write_seconds = 0.0
+        self.last_write_lag = 0.0
+
+        self.thread = None
+        self._start()
+        _live_writers.add(self)
+
+    def _start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, matches):
+        """
+        Queue edited matches; a later edit to the same row replaces an earlier one still in the queue,
+        keeping the version of the first (the reviewer has not seen other edits to that row since)
+        """
+        with self.condition:
+            for match in matches:
+                base_version = self.pending.get(match.source_key, (None, self.session.version))[1]
+                self.pending[match.source_key] = (replace(match), base_version)
+            if self.pending and self.first_pending_at is None:
+                self.first_pending_at = time.monotonic()
+            self.idle.clear()
+            if self.thread is None and not self.closed:
+                self._start()
+            self.condition.notify()
+
+    def lag(self):
+        """
+        Seconds the oldest queued edit has been waiting, 0 when everything is written
+        """
+        with self.condition:
+            return time.monotonic() - self.first_pending_at if self.first_pending_at is not None else 0.0
+
+    def status(self):
+        with self.condition:
+            pending = len(self.pending)
+        return {
+            'pending': pending,
+            'lag': self.lag(),
+            'writes': self.writes,
+            'rows_written': self.rows_written,
+            'last_write_seconds': self.last_write_seconds,
+            'last_write_lag': self.last_write_lag
+        }
+
+    def sync(self):
+        """
+        Merge other reviewers' edits into the session, except rows with an edit still queued here
+        """
+        with self.session_lock:
+            with self.condition:
+                queued = set(self.pending)
+            return sync_session(self.session, self.sessions_dir, skip_keys=queued)
+
+    def drain_messages(self):
+        """
+        Conflicts, collisions and errors since the last call
+        """
+        with self.condition:
+            messages = (self.conflicts, self.collisions, self.errors)
+            self.conflicts, self.collisions, self.errors = [], [], []
+        return messages
+
+    def flush(self, timeout=None):
+        """
+        Write everything queued now, and wait for it to be on disk
+        """
+        with self.condition:
+            self.flush_requested = True
+            self.condition.notify()
+        return self.idle.wait(timeout)
+
+    def close(self, timeout=None):
+        with self.condition:
+            self.closed = True
+            thread = self.thread
+            self.condition.notify()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.flush_requested = False
+                    if not self.condition.wait(self.idle_timeout) and not self.pending:
+                        # nothing queued for a while: stop, so a writer whose page is gone can be collected
+                        self.thread = None
+                        return
+                if not self.pending:
+                    return
+                # debounce: keep collecting edits until the oldest has waited `interval` seconds
+                deadline = self.first_pending_at + self.interval
+                while not (self.closed or self.flush_requested) and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                self.flush_requested = False
+            self._write()
+
+    def _write(self):
+        start = time.perf_counter()
+        # the batch is taken under the session lock, so a sync cannot merge over rows on their way to disk
+        with self.session_lock:
+            with self.condition:
+                batch = [match for match, _ in self.pending.values()]
+                base_versions = {key: base_version for key, (_, base_version) in self.pending.items()}
+                lag = time.monotonic() - self.first_pending_at
+                self.pending = {}
+                self.first_pending_at = None
+            success, result = commit_match_updates(self.session, batch, self.sessions_dir, base_versions)
+        collisions = []
+        if success and self.record_index:
+            conflicted = {conflict['source_key'] for conflict in result['conflicts']}
+            try:
+                collisions = MappingIndex(self.sessions_dir).record_confirmations(
+                    self.session, [match for match in batch if match.source_key not in conflicted]
+                )
+            except Exception as e:
+                success, result = False, f"Failed to update mapping index: {e}"
+
+        with self.condition:
+            if success:
+                self.conflicts.extend(result['conflicts'])
+                self.collisions.extend(collisions)
+                self.rows_written += result['written']
+            else:
+                self.errors.append(result)
+            self.writes += 1
+            self.last_write_seconds = time.perf_counter() - start
+            self.last_write_lag = lag
+            if not self.pending:
+                self.idle.set()
+
+
+@atexit.register
+def _flush_live_writers():
+    for writer in list(_live_writers):
+        writer.close(timeout=10)
+
+
+def get_session_dir(session, sessions_dir="sessions"):
+    return f"{sessions_dir}/{session.project_name}_{session.timestamp}"
+
+def matches_to_json(concept_matches):
+    """
+    The JSON form of concept matches, used for every write of concept_matches.json and the match journal
+    """
+    return [
+        {
+            "source_key": match.source_key,
+            "target_concept_id": match.target_concept_id,
+            "similarity_score": (f"{float(match.similarity_score):.3f}" if match.similarity_score is not None else None),
+            "confirmation_status": match.confirmation_status if match.confirmation_status in ("True", "Rejected") else False,
+            "first_confirmation_timestamp": (match.first_confirmation_timestamp.isoformat()
+                                        if match.first_confirmation_timestamp else None),
+            "last_update_timestamp": (match.last_update_timestamp.isoformat()
+                                  if match.last_update_timestamp else None),
+            "rerank_score": (f"{float(match.rerank_score):.3f}" if match.rerank_score is not None else None)
+        }
+        for match in concept_matches
+    ]
+
+def score_from_json(value):
+    """
+    A stored similarity score; older sessions wrote -1.0 where the target was not chosen by the model
+    """
+    if value is None or float(value) == LEGACY_NO_SCORE:
+        return None
+    return float(value)
+
+def match_from_json(match):
+    return ConceptMatch(
+        source_key=match['source_key'],
+        target_concept_id=match['target_concept_id'],
+        similarity_score=score_from_json(match['similarity_score']),
+        confirmation_status=match['confirmation_status'],
+        first_confirmation_timestamp=datetime.fromisoformat(match['first_confirmation_timestamp'])
+            if match['first_confirmation_timestamp'] else None,
+        last_update_timestamp=datetime.fromisoformat(match['last_update_timestamp'])
+            if match['last_update_timestamp'] else None,
+        rerank_score=float(match['rerank_score']) if match.get('rerank_score') is not None else None
+    )
+
+def save_concept_matches(session, sessions_dir="sessions"):
+    """
+    Write all of a session's concept matches to concept_matches.json, folding in the journalled row edits
+    Used for whole-session rewrites (e.g. release updates); reviewers' edits go through commit_match_updates
+    Rows other reviewers committed after this copy's version are merged into the copy first, so they are kept
+    Rows the rewrite changes get a new version, so other reviewers' copies pick them up or conflict with them
+    Returns the number of rows merged
+    """
+    session_dir = get_session_dir(session, sessions_dir)
+    with file_lock(f"{session_dir}/concept_matches.json"):
+        entries = read_match_changes(session_dir, session.version)
+        merged = apply_journal_entries(session.concept_matches, entries)
+        latest = latest_match_version(session_dir)
+        current = current_match_rows(session_dir)
+        row_versions = {}
+        for row in matches_to_json(session.concept_matches):
+            old = current.get(row['source_key'])
+            unchanged = old is not None and {key: old.get(key) for key in row} == row
+            row_versions[row['source_key']] = old['seq'] if unchanged else latest + 1
+        version = max([latest, *row_versions.values()])
+        write_concept_matches(session_dir, session.concept_matches, version, row_versions)
+        session.version = version
+    return merged
+
+def current_match_rows(session_dir):
+    """
+    {source_key: row} of the saved matches with the journal replayed, each row with the version it last changed at
+    """
+    # caller holds the concept_matches lock
+    with open(f"{session_dir}/concept_matches.json", 'r') as f:
+        rows = {row['source_key']: dict(row, seq=row.get('seq', 0)) for row in json.load(f)}
+    for entry in read_match_journal(session_dir):
+        if entry['source_key'] in rows:
+            rows[entry['source_key']] = entry
+    return rows
+
+def compact_match_journal(session_dir):
+    """
+    Fold the journal into concept_matches.json, from what is on disk rather than any one reviewer's copy
+    """
+    # caller holds the concept_matches lock
+    rows = current_match_rows(session_dir)
+    write_concept_matches(session_dir, [match_from_json(row) for row in rows.values()],
+                          latest_match_version(session_dir), {key: row['seq'] for key, row in rows.items()})
+
+def write_concept_matches(session_dir, concept_matches, version, row_versions=None):
+    """
+    Replace concept_matches.json (at `version`, with each row's last-changed version) and clear the journal
+    """
+    # caller holds the concept_matches lock
+    row_versions = row_versions or {}
+    tmp_path = f"{session_dir}/concept_matches.json.tmp"
+    with span("matches_write", items=len(concept_matches)) as stage:
+        rows = [dict(row, seq=row_versions.get(row['source_key'], 0)) for row in matches_to_json(concept_matches)]
+        with open(tmp_path, 'w') as f:
+            json.dump(rows, f, indent=2)
+        stage.record(bytes_written=os.path.getsize(tmp_path))
+    os.replace(tmp_path, f"{session_dir}/concept_matches.json")
+    update_session_metadata(session_dir, matches_version=version)
+    journal_path = f"{session_dir}/match_journal.jsonl"
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+def read_match_journal(session_dir, after_version=0):
+    """
+    Journalled row edits with a sequence number above after_version, oldest first
+    """
+    journal_path = f"{session_dir}/match_journal.jsonl"
+    if not os.path.exists(journal_path):
+        return []
+    with open(journal_path, 'r') as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return [entry for entry in entries if entry['seq'] > after_version]
+
+def read_match_changes(session_dir, after_version=0):
+    """
+    Row changes with a version above after_version, oldest first: journal entries, and the rows of
+    concept_matches.json changed after it when the journal has since been folded away
+    """
+    entries = read_match_journal(session_dir, after_version)
+    with open(f"{session_dir}/metadata.json", 'r') as f:
+        saved_version = json.load(f).get('matches_version', 0)
+    if after_version < saved_version:
+        with open(f"{session_dir}/concept_matches.json", 'r') as f:
+            rows = [row for row in json.load(f) if row.get('seq', 0) > after_version]
+        entries = sorted(rows, key=lambda row: row['seq']) + entries
+    return entries
+
+def latest_match_version(session_dir):
+    entries = read_match_journal(session_dir)
+    if entries:
+        return entries[-1]['seq']
+    with open(f"{session_dir}/metadata.json", 'r') as f:
+        return json.load(f).get('matches_version', 0)
+
+def apply_journal_entries(concept_matches, entries, skip_keys=()):
+    """
+    Replay journal entries onto a list of matches in place, returning the number of rows changed
+    """
+    positions = {match.source_key: i for i, match in enumerate(concept_matches)}
+    applied = 0
+    for entry in entries:
+        if entry['source_key'] in skip_keys or entry['source_key'] not in positions:
+            continue
+        concept_matches[positions[entry['source_key']]] = match_from_json(entry)
+        applied += 1
+    return applied
+
+def sync_session(session, sessions_dir="sessions", skip_keys=()):
+    """
+    Merge other reviewers' row edits made since this copy's version, leaving rows in skip_keys as they are
+    Returns (success, number of rows merged)
+    """
+    try:
+        session_dir = get_session_dir(session, sessions_dir)
+        entries = read_match_changes(session_dir, session.version)
+        merged = apply_journal_entries(session.concept_matches, entries, skip_keys=skip_keys)
+        if entries:
+            session.version = entries[-1]['seq']
+        return True, merged
+
+    except Exception as e:
+        return False, f"Failed to sync session: {e}"
+
+def commit_match_updates(session, matches, sessions_dir="sessions", base_versions=None):
+    """
+    Write edited matches as row-level journal entries, based on the session copy's version
+    - a row that another reviewer changed since that version, to a different target or status, is a conflict:
+      it is not written, and the copy takes the other reviewer's value so it can be looked at again
+    - all other reviewers' edits since that version are merged into the copy
+    base_versions ({source_key: version}) gives the version an edit was made against, where older than the copy's
+    (edits queued by a SessionWriter while the copy was synced)
+    Returns (success, {'written', 'merged', 'conflicts'})
+    """
+    try:
+        session_dir = get_session_dir(session, sessions_dir)
+        journal_path = f"{session_dir}/match_journal.jsonl"
+
+        with span("match_commit", items=len(matches)) as stage:
+            with file_lock(f"{session_dir}/concept_matches.json"):
+                version = latest_match_version(session_dir)
+                base_versions = {match.source_key: (base_versions or {}).get(match.source_key, session.version)
+                                 for match in matches}
+                # latest journal entry per row, back to the oldest version an edit was made against
+                latest = {}
+                for entry in read_match_changes(session_dir, min(base_versions.values(), default=session.version)):
+                    latest[entry['source_key']] = entry
+                newer = {key: entry for key, entry in latest.items() if entry['seq'] > session.version}
+
+                conflicts = []
+                new_entries = []
+                for match in matches:
+                    row = matches_to_json([match])[0]
+                    base_version = base_versions[match.source_key]
+                    theirs = latest.get(match.source_key)
+                    if theirs is not None and theirs['seq'] > base_version and \
+                            (theirs['target_concept_id'], theirs['confirmation_status']) != \
+                            (row['target_concept_id'], row['confirmation_status']):
+                        newer[match.source_key] = theirs
+                        conflicts.append({
+                            'source_key': match.source_key,
+                            'your_target_concept_id': row['target_concept_id'],
+                            'your_confirmation_status': row['confirmation_status'],
+                            'their_target_concept_id': theirs['target_concept_id'],
+                            'their_confirmation_status': theirs['confirmation_status']
+                        })
+                        continue
+                    version += 1
+                    new_entries.append(dict(row, seq=version, base_version=base_version))
+
+                if new_entries:
+                    lines = "".join(json.dumps(entry) + "\n" for entry in new_entries)
+                    with open(journal_path, 'a') as f:
+                        f.write(lines)
+                    stage.record(bytes_written=len(lines.encode()))
+
+                # merge everyone else's rows, including the winning side of each conflict
+                written = {entry['source_key'] for entry in new_entries}
+                merged = apply_journal_entries(session.concept_matches, newer.values(), skip_keys=written)
+                session.version = version
+
+                if len(read_match_journal(session_dir)) > JOURNAL_COMPACT_ROWS:
+                    compact_match_journal(session_dir)
+
+        return True, {'written': len(new_entries), 'merged': merged, 'conflicts': conflicts}
+
+    except Exception as e:
+        return False, f"Failed to save matches: {e}"
+
+def update_session_metadata(session_dir, **fields):
+    """
+    Update fields of metadata.json; it is replaced whole, as session lists and loaders read it without a lock
+    """
+    metadata_path = f"{session_dir}/metadata.json"
+    with file_lock(metadata_path):
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+        metadata.update(fields)
+        write_json_atomic(metadata_path, metadata, indent=4)
+
+def save_session_table(session_dir, side, table, sessions_dir="sessions"):
+    """
+    Point a session's source or target table at a new table in the shared store
+    """
+    update_session_metadata(session_dir, **{f"{side}_table_hash": store_table(table, sessions_dir)})
+    legacy_path = f"{session_dir}/{side}_concepts.pkl"
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+def load_session_table(session_dir, metadata, side, sessions_dir="sessions"):
+    """
+    A session's source or target table from the shared store, or from the session's own pickle for sessions
+    saved before the store; None if neither exists
+    """
+    content_hash = metadata.get(f"{side}_table_hash")
+    if content_hash:
+        return load_table(content_hash, sessions_dir)
+    legacy_path = f"{session_dir}/{side}_concepts.pkl"
+    if not os.path.exists(legacy_path):
+        return None
+    with open(legacy_path, 'rb') as f:
+        return pickle.load(f)
+
+def save_session_embeddings(session_dir, source_embeddings=None, target_embeddings=None, dtype=None,
+                            source_inverse=None, target_inverse=None):
+    """
+    Save L2 normalised source / target embeddings, row aligned with the session's concept tables, or one row per
+    distinct name plus the inverse indices mapping each concept row to its name's embedding
+    dtype is float32, float16 or int8 (with a scale per row); by default the session's embedding_dtype is kept
+    """
+    if dtype is None:
+        with open(f"{session_dir}/metadata.json", 'r') as f:
+            dtype = json.load(f).get('embedding_dtype', "float32")
+    for side, embeddings, inverse in [("source", source_embeddings, source_inverse),
+                                      ("target", target_embeddings, target_inverse)]:
+        if embeddings is None:
+            continue
+        values, scales = quantize(embeddings, dtype)
+        np.save(f"{session_dir}/{side}_embeddings.npy", values)
+        for path, array in [(f"{session_dir}/{side}_embedding_scales.npy", scales),
+                            (f"{session_dir}/{side}_embedding_rows.npy", inverse)]:
+            if array is not None:
+                np.save(path, array)
+            elif os.path.exists(path):
+                os.remove(path)
+
+def load_session_embeddings(session_dir):
+    """
+    Memory-map saved source / target embeddings; either is None for sessions saved without them
+    float16 / float32 embeddings stay memory-mapped. int8 ones are de-quantized to float32 in full, because
+    release and source updates index and multiply arbitrary rows: int8 saves disk space, not memory, once loaded
+    Embeddings saved per distinct name are expanded here to one row per concept, in memory
+    """
+    embeddings = []
+    for side in ["source", "target"]:
+        path = f"{session_dir}/{side}_embeddings.npy"
+        scales_path = f"{session_dir}/{side}_embedding_scales.npy"
+        rows_path = f"{session_dir}/{side}_embedding_rows.npy"
+        if not os.path.exists(path):
+            embeddings.append(None)
+            continue
+        if os.path.exists(scales_path):
+            values = dequantize(np.load(path, mmap_mode="r"), np.load(scales_path))
+        else:
+            values = np.load(path, mmap_mode="r")
+        embeddings.append(values[np.load(rows_path)] if os.path.exists(rows_path) else values)
+    return tuple(embeddings)
+
+def save_similarity_matrix(session_dir, similarity_matrix, dtype="float32", block_rows=4096):
+    """
+    Save a [source, target] similarity matrix as .npy in float16 or float32, a block of rows at a time
+    so a memory-mapped matrix is never copied in full
+    """
+    saved = np.lib.format.open_memmap(f"{session_dir}/similarities.npy", mode="w+",
+                                      dtype=np.dtype(dtype), shape=similarity_matrix.shape)
+    for start in range(0, similarity_matrix.shape[0], block_rows):
+        saved[start:start + block_rows] = similarity_matrix[start:start + block_rows]
+    saved.flush()
+    del saved
+
+def load_similarity_matrix(session_dir):
+    """
+    Memory-map a saved similarity matrix read-only; nothing is read until rows are accessed
+    """
+    path = f"{session_dir}/similarities.npy"
+    return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
+def top_alternatives(session, source_row, n=10):
+    """
+    Best n (target concept_id, score) pairs for one source concept, by its row in source_table.concepts
+    Reads a single row of the similarity matrix, or falls back to the saved top-k candidates
+    """
+    matrix = session.similarity_matrix
+    target_count = len(session.target_table.concepts)
+    if matrix is not None and matrix.shape == (len(session.source_table.concepts), target_count):
+        scores = np.asarray(matrix[source_row], dtype=np.float32)
+        n = min(n, target_count)
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(session.target_table.concepts[i].concept_id, float(scores[i])) for i in top]
+
+    if session.candidate_target_ids is not None and source_row < len(session.candidate_target_ids):
+        return [
+            (int(concept_id), float(score))
+            for concept_id, score in zip(session.candidate_target_ids[source_row][:n], session.candidate_scores[source_row][:n])
+        ]
+
+    return []
+
+def save_session_candidates(session_dir, session):
+    if session.candidate_target_ids is not None:
+        np.savez(f"{session_dir}/candidates.npz",
+                 target_ids=session.candidate_target_ids, scores=session.candidate_scores)
+
+def save_partition_candidates(session_dir, session):
+    """
+    Save a multi-vocabulary session's partitions (partitions.json) and per-partition top-k (partition_candidates.npz)
+    """
+    if session.target_partitions is None:
+        return
+    labels = list(session.target_partitions)
+    with open(f"{session_dir}/partitions.json", 'w') as f:
+        json.dump({'labels': labels, 'partitions': session.target_partitions}, f)
+    if session.partition_candidates is not None:
+        arrays = {}
+        for i, label in enumerate(labels):
+            arrays[f"ids_{i}"], arrays[f"scores_{i}"] = session.partition_candidates[label]
+        np.savez(f"{session_dir}/partition_candidates.npz", **arrays)
+
+def load_partition_candidates(session_dir):
+    """
+    Returns (target_partitions, partition_candidates), both None for single-vocabulary sessions
+    """
+    partitions_path = f"{session_dir}/partitions.json"
+    if not os.path.exists(partitions_path):
+        return None, None
+    with open(partitions_path, 'r') as f:
+        saved = json.load(f)
+    partition_candidates = None
+    candidates_path = f"{session_dir}/partition_candidates.npz"
+    if os.path.exists(candidates_path):
+        with np.load(candidates_path) as arrays:
+            partition_candidates = {
+                label: (arrays[f"ids_{i}"], arrays[f"scores_{i}"]) for i, label in enumerate(saved['labels'])
+            }
+    return saved['partitions'], partition_candidates
+
 def list_saved_sessions(sessions_dir="sessions"):
     try:
         if not os.path.exists(sessions_dir):
@@ -101,76 +719,92 @@ def list_saved_sessions(sessions_dir="sessions"):
     except Exception as e:
         return False, f"Error listing sessions: {e}"
 
+def source_key_registry(sessions_dir="sessions"):
+    """
+    The source key registry, seeded from every saved session's source table the first time it is used
+    """
+    registry = SourceKeyRegistry(sessions_dir)
+    if registry.exists():
+        return registry.load()
+
+    concepts = []
+    success, sessions = list_saved_sessions(sessions_dir)
+    for metadata in sorted(sessions if success else [], key=lambda metadata: metadata['timestamp']):
+        session_dir = f"{sessions_dir}/{metadata['session_name']}"
+        source_table = load_session_table(session_dir, metadata, "source", sessions_dir)
+        if source_table is not None:
+            concepts.extend(source_table.concepts)
+    for source_key, texts in registry.seed(concepts):
+        print(f"[INFO] Saved sessions share source_key {source_key} between different concepts: {texts}")
+    return registry
+
 def load_session(session_name, sessions_dir="sessions"):
     try:
-        full_path = f"{sessions_dir}/{session_name}"
-        if not os.path.exists(full_path):
-            return False, f"Session directory not found: {sessions_dir}"
-
-        # Load metadata
-        metadata_path = f"{full_path}/metadata.json"
-        if not os.path.exists(metadata_path):
-            return False, "Session metadata not found"
-
-        with open(metadata_path, 'r') as f:
-            metadata = json.load(f)
-
-        # Load source concepts
-        source_path = f"{full_path}/source_concepts.pkl"
-        if not os.path.exists(source_path):
-            return False, "Source concepts file not found"
-
-        with open(source_path, 'rb') as f:
-            source_table = pickle.load(f)
-
-        # Load target concepts
-        target_path = f"{full_path}/target_concepts.pkl"
-        if not os.path.exists(target_path):
-            return False, "Target concepts file not found"
-
-        with open(target_path, 'rb') as f:
-            target_table = pickle.load(f)
-
-        # Load similarity matrix
-        #similarity_path = f"{full_path}/similarities.npy"
-        #if not os.path.exists(similarity_path):
-        #    return False, "Similarity matrix file not found"
-        #
-        #similarity_matrix = np.load(similarity_path)
-
-        # To avoid having to load a large similarity matrix in each time,
-        # We will generate a sparse matrix object that is not used in the mapping process.
-        similarity_matrix = np.zeros((42, 42))
-
-        # Load concept matches
-        matches_path = f"{full_path}/concept_matches.json"
-        if not os.path.exists(matches_path):
-            return False, "Concept matches file not found"
-
-        with open(matches_path, 'r') as f:
-            matches_data = json.load(f)
-            concept_matches = []
-            for match in matches_data:
-                concept_matches.append(ConceptMatch(
-                    source_key=match['source_key'],
-                    target_concept_id=match['target_concept_id'],
-                    similarity_score=float(match['similarity_score']),
-                    confirmation_status=match['confirmation_status'],
-                    first_confirmation_timestamp=datetime.fromisoformat(match['first_confirmation_timestamp'])
-                        if match['first_confirmation_timestamp'] else None,
-                    last_update_timestamp=datetime.fromisoformat(match['last_update_timestamp'])
-                        if match['last_update_timestamp'] else None
-                ))
-
-        # Create ProjectSession object
-        session = ProjectSession(
-            project_name=metadata['project_name'],
-            timestamp=metadata['timestamp'],
-            source_table=source_table,
-            target_table=target_table,
-            similarity_matrix=similarity_matrix,
-            concept_matches=concept_matches
-        )
+        with span("session_load") as stage:
+            full_path = f"{sessions_dir}/{session_name}"
+            if not os.path.exists(full_path):
+                return False, f"Session directory not found: {sessions_dir}"
+
+            # Load metadata
+            metadata_path = f"{full_path}/metadata.json"
+            if not os.path.exists(metadata_path):
+                return False, "Session metadata not found"
+
+            with open(metadata_path, 'r') as f:
+                metadata = json.load(f)
+
+            # Load source and target concepts, shared with other sessions on the same tables
+            source_table = load_session_table(full_path, metadata, "source", sessions_dir)
+            if source_table is None:
+                return False, "Source concepts file not found"
+
+            target_table = load_session_table(full_path, metadata, "target", sessions_dir)
+            if target_table is None:
+                return False, "Target concepts file not found"
+
+            # Similarity matrix is memory-mapped, so only rows that are looked at are read from disk
+            similarity_matrix = load_similarity_matrix(full_path)
+
+            # Load concept matches
+            matches_path = f"{full_path}/concept_matches.json"
+            if not os.path.exists(matches_path):
+                return False, "Concept matches file not found"
+
+            with file_lock(matches_path):
+                with open(matches_path, 'r') as f:
+                    concept_matches = [match_from_json(match) for match in json.load(f)]
+
+                # replay row edits journalled by reviewers since the last compaction
+                entries = read_match_journal(full_path)
+                apply_journal_entries(concept_matches, entries)
+                version = latest_match_version(full_path)
+
+            # Load top-k candidates, if saved with the session
+            candidate_target_ids, candidate_scores = None, None
+            candidates_path = f"{full_path}/candidates.npz"
+            if os.path.exists(candidates_path):
+                with np.load(candidates_path) as candidates:
+                    candidate_target_ids = candidates['target_ids']
+                    candidate_scores = candidates['scores']
+
+            # Per-vocabulary partitions, if matched against several target vocabularies
+            target_partitions, partition_candidates = load_partition_candidates(full_path)
+
+            # Create ProjectSession object
+            session = ProjectSession(
+                project_name=metadata['project_name'],
+                timestamp=metadata['timestamp'],
+                source_table=source_table,
+                target_table=target_table,
+                similarity_matrix=similarity_matrix,
+                concept_matches=concept_matches,
+                candidate_target_ids=candidate_target_ids,
+                candidate_scores=candidate_scores,
+                version=version,
+                target_partitions=target_partitions,
+                partition_candidates=partition_candidates
+            )
+            stage.record(items=len(concept_matches))
 
         return True, session
 
@@ -0,0 +1,331 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import deque
+from datetime import datetime
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+
+## Instrumentation spans: each stage of a run (tokenize, inference, similarity, session save, OMOP export...)
+## is wrapped in span(name), which records wall time, items/sec, peak RSS and bytes written.
+## Peak RSS is sampled by one background thread per run while any of its spans is open, not one per span.
+## Spans are appended as JSON lines to the span log (if configured) and kept in memory, grouped by run,
+## so a run report can be saved with each session and shown on the pages.
+## Setting profile_stage (or OMAP_PROFILE_STAGE) runs cProfile around every span of that name.
+
+_current_run = ContextVar("omap_run_id", default=None)
+_current_span = ContextVar("omap_span", default=None)
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, from /proc where available
+    """
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is the lifetime peak, in KB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssPeak:
+    """
+    Peak RSS seen since one block (e.g. a span) opened on an RssSampler
+    """
+    __slots__ = ("peak",)
+
+    def __init__(self, peak):
+        self.peak = peak
+
+
+class RssSampler:
+    """
+    Peak RSS of any number of overlapping blocks, e.g. every span of one run, sampled on a single background
+    thread that only runs while a block is open; also usable as a context manager around one block
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.open_peaks = []
+        self.stopped = None
+
+    def _run(self, stopped):
+        while not stopped.is_set():
+            rss = current_rss()
+            with self.lock:
+                for peak in self.open_peaks:
+                    peak.peak = max(peak.peak, rss)
+            stopped.wait(self.interval)
+
+    def open(self):
+        peak = RssPeak(current_rss())
+        with self.lock:
+            self.open_peaks.append(peak)
+            if self.stopped is None:
+                self.stopped = threading.Event()
+                threading.Thread(target=self._run, args=(self.stopped,), daemon=True).start()
+        return peak
+
+    def close(self, peak):
+        """
+        Stop following a block, returning its peak RSS; the thread stops with the last open block
+        """
+        with self.lock:
+            self.open_peaks.remove(peak)
+            if not self.open_peaks:
+                self.stopped.set()
+                self.stopped = None
+        return max(peak.peak, current_rss())
+
+    def idle(self):
+        with self.lock:
+            return not self.open_peaks
+
+    def __enter__(self):
+        self._block = self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.peak = self.close(self._block)
+
+
+def path_bytes(*paths):
+    """
+    Total size of files, and of every file under directories, that exist
+    """
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+class Span:
+    """
+    One timed stage; record() adds items processed, bytes written or any other detail while it runs
+    """
+    def __init__(self, name, run_id, parent, items=None, **details):
+        self.name = name
+        self.run_id = run_id
+        self.parent = parent
+        self.items = items
+        self.bytes_written = 0
+        self.details = details
+
+    def record(self, items=None, bytes_written=0, **details):
+        if items is not None:
+            self.items = (self.items or 0) + items
+        self.bytes_written += bytes_written
+        self.details.update(details)
+
+
+class Tracer:
+    def __init__(self, log_path=None, profile_stage=None, profile_dir="logs/profiles", max_spans=10000,
+                 sample_interval=0.01):
+        self.log_path = log_path
+        self.profile_stage = profile_stage
+        self.profile_dir = profile_dir
+        self.sample_interval = sample_interval
+        self.spans = deque(maxlen=max_spans)
+        # one RSS sampler per run with open spans, rather than a sampling thread per span
+        self.samplers = {}
+        self.lock = threading.Lock()
+
+    def emit(self, record):
+        with self.lock:
+            self.spans.append(record)
+            if self.log_path:
+                os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+    def _open_sampler(self, run_id):
+        with self.lock:
+            sampler = self.samplers.get(run_id)
+            if sampler is None:
+                sampler = self.samplers[run_id] = RssSampler(self.sample_interval)
+        return sampler, sampler.open()
+
+    def _close_sampler(self, run_id, sampler, peak):
+        peak_rss = sampler.close(peak)
+        with self.lock:
+            if self.samplers.get(run_id) is sampler and sampler.idle():
+                del self.samplers[run_id]
+        return peak_rss
+
+    @contextmanager
+    def span(self, name, items=None, **details):
+        span = Span(name, _current_run.get(), _current_span.get(), items, **details)
+        token = _current_span.set(name)
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        started = datetime.now()
+        start = time.perf_counter()
+        sampler, peak = self._open_sampler(span.run_id)
+        rss_before = peak.peak
+        error = None
+        try:
+            if profiler:
+                profiler.enable()
+            try:
+                yield span
+            finally:
+                if profiler:
+                    profiler.disable()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            seconds = time.perf_counter() - start
+            peak_rss = self._close_sampler(span.run_id, sampler, peak)
+            record = {
+                'run_id': span.run_id,
+                'name': name,
+                'parent': span.parent,
+                'start': started.isoformat(),
+                'seconds': seconds,
+                'items': span.items,
+                'items_per_second': span.items / seconds if span.items and seconds > 0 else None,
+                'peak_rss_bytes': peak_rss,
+                'rss_delta_bytes': peak_rss - rss_before,
+                'bytes_written': span.bytes_written,
+                'thread': threading.current_thread().name,
+                'error': error,
+                **span.details
+            }
+            if profiler:
+                record['profile_path'] = self._save_profile(profiler, name, started)
+            self.emit(record)
+
+    def _save_profile(self, profiler, name, started):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = f"{self.profile_dir}/{name}_{started.strftime('%Y%m%d_%H%M%S_%f')}.prof"
+        profiler.dump_stats(path)
+        print(f"[INFO] Profile of {name} saved to {path}")
+        return path
+
+    def run_spans(self, run_id):
+        with self.lock:
+            return [record for record in self.spans if record['run_id'] == run_id]
+
+    def run_report(self, run_id=None):
+        """
+        Per-stage totals for one run (the current one by default), in the order stages first started
+        """
+        run_id = run_id or _current_run.get()
+        spans = self.run_spans(run_id) if run_id else []
+        stages = {}
+        for record in sorted(spans, key=lambda record: record['start']):
+            stage = stages.setdefault(record['name'], {
+                'name': record['name'], 'parent': record['parent'], 'count': 0, 'seconds': 0.0,
+                'items': None, 'peak_rss_bytes': 0, 'bytes_written': 0, 'errors': 0
+            })
+            stage['count'] += 1
+            stage['seconds'] += record['seconds']
+            if record['items'] is not None:
+                stage['items'] = (stage['items'] or 0) + record['items']
+            stage['peak_rss_bytes'] = max(stage['peak_rss_bytes'], record['peak_rss_bytes'])
+            stage['bytes_written'] += record['bytes_written']
+            stage['errors'] += record['error'] is not None
+        for stage in stages.values():
+            stage['items_per_second'] = stage['items'] / stage['seconds'] if stage['items'] and stage['seconds'] > 0 else None
+
+        return {
+            'run_id': run_id,
+            'created': datetime.now().isoformat(),
+            'total_seconds': sum(stage['seconds'] for stage in stages.values() if stage['parent'] is None),
+            'peak_rss_bytes': max([stage['peak_rss_bytes'] for stage in stages.values()], default=0),
+            'stages': list(stages.values())
+        }
+
+
+_tracer = Tracer(log_path=os.environ.get("OMAP_SPAN_LOG"), profile_stage=os.environ.get("OMAP_PROFILE_STAGE"))
+
+
+def get_tracer():
+    return _tracer
+
+
+def configure_tracing(log_path=None, profile_stage=None, profile_dir=None):
+    """
+    Set where spans are logged and which stage (if any) is profiled; None leaves a setting unchanged
+    """
+    if log_path is not None:
+        _tracer.log_path = log_path
+    if profile_stage is not None:
+        _tracer.profile_stage = profile_stage or None
+    if profile_dir is not None:
+        _tracer.profile_dir = profile_dir
+    return _tracer
+
+
+def span(name, items=None, **details):
+    return _tracer.span(name, items, **details)
+
+
+def start_run(label=None):
+    """
+    Start a new run in the current context (a Streamlit script thread, a CLI); later spans are grouped under it
+    """
+    run_id = f"{label or 'run'}-{uuid.uuid4().hex[:8]}"
+    _current_run.set(run_id)
+    return run_id
+
+
+def set_current_run(run_id):
+    """
+    Carry a run over to another context, e.g. a later Streamlit rerun that saves what the run produced
+    """
+    _current_run.set(run_id)
+
+
+def current_run():
+    return _current_run.get()
+
+
+def run_report(run_id=None):
+    return _tracer.run_report(run_id)
+
+
+def save_run_report(path, run_id=None):
+    report = run_report(run_id)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def load_run_report(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def run_report_rows(report):
+    """
+    One display row per stage of a run report, in readable units
+    """
+    return [
+        {
+            'stage': stage['name'],
+            'calls': stage['count'],
+            'seconds': round(stage['seconds'], 3),
+            'items': stage['items'],
+            'items/s': round(stage['items_per_second'], 1) if stage['items_per_second'] else None,
+            'peak RSS (MB)': round(stage['peak_rss_bytes'] / 2**20, 1),
+            'written (MB)': round(stage['bytes_written'] / 2**20, 2),
+            'errors': stage['errors']
+        }
+        for stage in report['stages']
+    ]
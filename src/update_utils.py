@@ -0,0 +1,287 @@
+from dataclasses import dataclass, replace
+from datetime import datetime
+import hashlib
+import json
+import os
+import numpy as np
+from src.array_utils import normalize_rows, top_k_indices
+from src.data_utils import ConceptMatch, SourceConceptTable
+from src.session_utils import (get_session_dir, load_session_embeddings, save_concept_matches,
+                               save_session_candidates, save_session_embeddings, save_session_table,
+                               source_key_registry, update_session_metadata)
+
+## Incremental session updates: work out what changed, and only embed and re-match that.
+
+
+def name_hash(concept):
+    return hashlib.sha1(concept.concept_name.encode()).hexdigest()
+
+
+@dataclass
+class TargetTableDiff:
+    added: list[int]
+    removed: list[int]
+    changed: list[int]  # same concept_id, different concept_name
+    unchanged: list[int]
+
+
+def diff_target_tables(old_table, new_table):
+    """
+    Compare two releases of a target vocabulary by concept_id and concept_name hash
+    """
+    old_hashes = {concept.concept_id: name_hash(concept) for concept in old_table.concepts}
+    new_hashes = {concept.concept_id: name_hash(concept) for concept in new_table.concepts}
+
+    return TargetTableDiff(
+        added=[concept_id for concept_id in new_hashes if concept_id not in old_hashes],
+        removed=[concept_id for concept_id in old_hashes if concept_id not in new_hashes],
+        changed=[concept_id for concept_id, h in new_hashes.items()
+                 if concept_id in old_hashes and old_hashes[concept_id] != h],
+        unchanged=[concept_id for concept_id, h in new_hashes.items() if old_hashes.get(concept_id) == h]
+    )
+
+
+def embed_concepts(model_handler, concepts, label):
+    """
+    Normalised per-concept embeddings for a list of concepts, embedding each distinct name once
+    """
+    if not concepts:
+        return None
+    unique_embeddings, inverse = model_handler.deduplicated_embeddings([c.concept_name for c in concepts], label)
+    return normalize_rows(unique_embeddings)[inverse]
+
+
+def merge_candidates(kept_ids, kept_scores, new_ids, new_scores, k):
+    """
+    Merge two disjoint sets of per-row candidates into the top-k of their union
+    """
+    ids = np.concatenate([kept_ids, new_ids], axis=1)
+    scores = np.concatenate([kept_scores, new_scores], axis=1)
+    order, top_scores = top_k_indices(scores, k)
+    return np.take_along_axis(ids, order, axis=1), top_scores
+
+
+def rematch_for_release(session, new_target_table, model_handler, replacements=None, k=10, sessions_dir="sessions"):
+    """
+    Move a session onto a new release of its target vocabulary, doing work proportional to the release delta
+    - only added / renamed target concepts are embedded; unchanged concepts reuse the session's saved embeddings
+    - sources are scored against the delta only, unless one of their top-k candidates was removed or renamed
+    - unconfirmed matches move to the new best candidate
+    - confirmed matches whose target was removed are flagged, reset to unconfirmed and pointed at the replacement
+      concept if the release supersedes it (see vocab_utils.load_concept_replacements), otherwise the new best match
+    Returns (success, report)
+    """
+    try:
+        replacements = replacements or {}
+        session_dir = get_session_dir(session, sessions_dir)
+        source_embeddings, old_target_embeddings = load_session_embeddings(session_dir)
+
+        if source_embeddings is None:
+            # sessions saved before embeddings were kept: sources must be embedded once
+            source_embeddings = embed_concepts(model_handler, session.source_table.concepts, "source")
+        source_embeddings = np.asarray(source_embeddings, dtype=np.float32)
+
+        diff = diff_target_tables(session.target_table, new_target_table)
+        unchanged = set(diff.unchanged)
+        if old_target_embeddings is None:
+            unchanged = set()
+
+        # new target embeddings: reuse unchanged rows, embed the rest
+        old_rows = {concept.concept_id: i for i, concept in enumerate(session.target_table.concepts)}
+        to_embed = [i for i, concept in enumerate(new_target_table.concepts) if concept.concept_id not in unchanged]
+        new_target_embeddings = np.empty((len(new_target_table.concepts), source_embeddings.shape[1]), dtype=np.float32)
+        for i, concept in enumerate(new_target_table.concepts):
+            if concept.concept_id in unchanged:
+                new_target_embeddings[i] = old_target_embeddings[old_rows[concept.concept_id]]
+        if to_embed:
+            new_target_embeddings[to_embed] = embed_concepts(
+                model_handler, [new_target_table.concepts[i] for i in to_embed], "target delta"
+            )
+
+        new_target_ids = np.array([concept.concept_id for concept in new_target_table.concepts], dtype=np.int64)
+        k = min(k, len(new_target_ids))
+
+        if session.candidate_target_ids is None or not unchanged:
+            # no usable previous candidates, so every source is scored in full
+            affected = np.ones(len(source_embeddings), dtype=bool)
+            candidate_ids = np.empty((len(source_embeddings), k), dtype=np.int64)
+            candidate_scores = np.empty((len(source_embeddings), k), dtype=np.float32)
+        else:
+            kept_valid = np.isin(session.candidate_target_ids, list(unchanged))
+            affected = ~kept_valid.all(axis=1)
+
+            delta_scores = source_embeddings[~affected] @ new_target_embeddings[to_embed].T
+            delta_ids = np.broadcast_to(new_target_ids[to_embed], delta_scores.shape)
+            candidate_ids = np.empty((len(source_embeddings), k), dtype=np.int64)
+            candidate_scores = np.empty((len(source_embeddings), k), dtype=np.float32)
+            candidate_ids[~affected], candidate_scores[~affected] = merge_candidates(
+                session.candidate_target_ids[~affected], session.candidate_scores[~affected],
+                delta_ids, delta_scores, k
+            )
+
+        # sources that lost a candidate are re-scored against the whole new release
+        if affected.any():
+            indices, scores = top_k_indices(source_embeddings[affected] @ new_target_embeddings.T, k)
+            candidate_ids[affected] = new_target_ids[indices]
+            candidate_scores[affected] = scores
+
+        # update matches
+        source_rows = {concept.source_key: i for i, concept in enumerate(session.source_table.concepts)}
+        new_ids = set(new_target_ids.tolist())
+        flagged = []
+        for match in session.concept_matches:
+            row = source_rows[match.source_key]
+            if match.confirmation_status not in ("True", "Rejected"):
+                match.target_concept_id = int(candidate_ids[row, 0])
+                match.similarity_score = float(candidate_scores[row, 0])
+                match.rerank_score = None
+            # rejected rows are left as reviewed; only confirmed targets that left the release are flagged
+            elif match.confirmation_status == "True" and match.target_concept_id not in new_ids:
+                replacement = replacements.get(match.target_concept_id)
+                superseded = replacement in new_ids
+                flagged.append({
+                    'source_key': match.source_key,
+                    'target_concept_id': match.target_concept_id,
+                    'reason': "superseded" if superseded else "invalid",
+                    'replacement_concept_id': replacement if superseded else None
+                })
+                # back into the review queue; first_confirmation_timestamp is kept for OMOP id ordering
+                match.confirmation_status = "False"
+                match.rerank_score = None
+                if superseded:
+                    match.target_concept_id = replacement
+                    match.similarity_score = None
+                else:
+                    match.target_concept_id = int(candidate_ids[row, 0])
+                    match.similarity_score = float(candidate_scores[row, 0])
+
+        # persist
+        session.target_table = new_target_table
+        session.candidate_target_ids = candidate_ids
+        session.candidate_scores = candidate_scores
+
+        save_session_table(session_dir, "target", new_target_table, sessions_dir)
+        save_session_embeddings(session_dir, source_embeddings, new_target_embeddings)
+        save_session_candidates(session_dir, session)
+        save_concept_matches(session, sessions_dir)
+
+        # the full similarity matrix no longer lines up with the target table
+        drop_similarity_matrix(session, session_dir)
+
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'added': len(diff.added),
+            'removed': len(diff.removed),
+            'changed': len(diff.changed),
+            'unchanged': len(diff.unchanged),
+            'embedded_targets': len(to_embed),
+            'fully_rescored_sources': int(affected.sum()),
+            'flagged': flagged
+        }
+        with open(f"{session_dir}/release_update_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json", 'w') as f:
+            json.dump(report, f, indent=2)
+        update_session_metadata(session_dir, target_count=len(new_target_table.concepts))
+
+        return True, report
+
+    except Exception as e:
+        return False, f"Failed to update session for new release: {e}"
+
+
+def drop_similarity_matrix(session, session_dir):
+    """
+    Remove a saved similarity matrix that no longer lines up with the session's source or target table
+    """
+    similarity_path = f"{session_dir}/similarities.npy"
+    session.similarity_matrix = None
+    if os.path.exists(similarity_path):
+        os.remove(similarity_path)
+    update_session_metadata(session_dir, similarity_matrix_size=None)
+
+
+def update_sources(session, new_source_table, model_handler, k=10, sessions_dir="sessions"):
+    """
+    Apply a re-pulled source extract to a session, keeping all review work
+    - new source_keys are embedded and matched against the session's saved target embeddings
+    - existing source_keys get their concept_count refreshed; confirmation state and timestamps are untouched
+    - source_keys missing from the new extract are kept, as their mappings may already be confirmed
+    Matches are re-sorted by count. Returns (success, report)
+    """
+    try:
+        session_dir = get_session_dir(session, sessions_dir)
+        source_embeddings, target_embeddings = load_session_embeddings(session_dir)
+
+        # concepts already known keep their registered keys, including 9 digit keys of older sessions
+        source_key_registry(sessions_dir).resolve(new_source_table)
+
+        # the loaded table may be shared with other sessions (src/blob_utils.py), so changes go to a copy
+        session.source_table = SourceConceptTable([replace(concept) for concept in session.source_table.concepts])
+        existing = {concept.source_key: concept for concept in session.source_table.concepts}
+        incoming = {concept.source_key: concept for concept in new_source_table.concepts}
+        new_concepts = [concept for key, concept in incoming.items() if key not in existing]
+
+        # refresh counts in place
+        refreshed = 0
+        for key, concept in incoming.items():
+            if key in existing and existing[key].concept_count != concept.concept_count:
+                existing[key].concept_count = concept.concept_count
+                refreshed += 1
+
+        if new_concepts:
+            if target_embeddings is None:
+                # sessions saved before embeddings were kept: targets must be embedded once
+                target_embeddings = embed_concepts(model_handler, session.target_table.concepts, "target")
+            if source_embeddings is None:
+                source_embeddings = embed_concepts(model_handler, session.source_table.concepts, "source")
+            target_embeddings = np.asarray(target_embeddings, dtype=np.float32)
+
+            new_embeddings = embed_concepts(model_handler, new_concepts, "new sources")
+            target_ids = np.array([concept.concept_id for concept in session.target_table.concepts], dtype=np.int64)
+            indices, scores = top_k_indices(new_embeddings @ target_embeddings.T, k)
+            new_candidate_ids = target_ids[indices]
+
+            for row, concept in enumerate(new_concepts):
+                session.concept_matches.append(ConceptMatch(
+                    source_key=concept.source_key,
+                    target_concept_id=int(new_candidate_ids[row, 0]),
+                    similarity_score=float(scores[row, 0]),
+                    confirmation_status="False",
+                    first_confirmation_timestamp=None,
+                    last_update_timestamp=None
+                ))
+
+            # arrays stay row aligned with source_table.concepts, so new rows are appended
+            session.source_table.concepts.extend(new_concepts)
+            source_embeddings = np.vstack([np.asarray(source_embeddings, dtype=np.float32), new_embeddings])
+            if session.candidate_target_ids is not None:
+                width = min(session.candidate_target_ids.shape[1], new_candidate_ids.shape[1])
+                session.candidate_target_ids = np.vstack([session.candidate_target_ids[:, :width], new_candidate_ids[:, :width]])
+                session.candidate_scores = np.vstack([session.candidate_scores[:, :width], scores[:, :width]])
+
+        counts = {concept.source_key: concept.concept_count for concept in session.source_table.concepts}
+        session.concept_matches.sort(key=lambda match: counts[match.source_key], reverse=True)
+
+        # persist
+        save_session_table(session_dir, "source", session.source_table, sessions_dir)
+        if new_concepts:
+            save_session_embeddings(session_dir, source_embeddings, target_embeddings)
+            save_session_candidates(session_dir, session)
+            # the full similarity matrix has no rows for the new sources; Top N falls back to the candidates
+            drop_similarity_matrix(session, session_dir)
+        save_concept_matches(session, sessions_dir)
+
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'new_sources': len(new_concepts),
+            'refreshed_counts': refreshed,
+            'missing_from_extract': len([key for key in existing if key not in incoming])
+        }
+        with open(f"{session_dir}/source_update_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json", 'w') as f:
+            json.dump(report, f, indent=2)
+        update_session_metadata(session_dir, source_count=len(session.source_table.concepts),
+                                matches_count=len(session.concept_matches))
+
+        return True, report
+
+    except Exception as e:
+        return False, f"Failed to update session sources: {e}"
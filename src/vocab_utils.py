@@ -0,0 +1,197 @@
+import argparse
+import hashlib
+import json
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+## Build filtered target vocabulary packs straight from an Athena CONCEPT.csv download,
+## instead of running concepts/target/omop_vocab.sql against a database.
+## The file is streamed in blocks, only the needed columns are parsed, and each block is filtered
+## before anything is kept, so memory stays flat regardless of the size of CONCEPT.csv.
+
+PACK_COLUMNS = [
+    'concept_id', 'concept_name', 'domain_id', 'vocabulary_id', 'concept_class_id',
+    'standard_concept', 'concept_code', 'valid_end_date', 'invalid_reason'
+]
+
+
+def pack_filters(vocabulary_ids=None, concept_class_ids=None, standard_concepts=None):
+    """
+    Normalised filter spec, so that equivalent filters give the same cached pack
+    """
+    return {
+        'vocabulary_id': sorted(vocabulary_ids) if vocabulary_ids else None,
+        'concept_class_id': sorted(concept_class_ids) if concept_class_ids else None,
+        'standard_concept': sorted(standard_concepts) if standard_concepts else None
+    }
+
+
+def stream_athena_concepts(concept_path, filters, block_size=64 << 20):
+    """
+    Yield filtered record batches from an Athena CONCEPT.csv (tab separated, unquoted)
+    """
+    reader = pacsv.open_csv(
+        concept_path,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        # Athena exports are unquoted, and concept names can contain quote characters
+        parse_options=pacsv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=PACK_COLUMNS,
+            column_types={column: pa.int64() if column == 'concept_id' else pa.string() for column in PACK_COLUMNS}
+        )
+    )
+
+    for batch in reader:
+        mask = None
+        for column, values in filters.items():
+            if values is None:
+                continue
+            column_mask = pc.is_in(batch.column(column), value_set=pa.array(values, type=pa.string()))
+            mask = column_mask if mask is None else pc.and_(mask, column_mask)
+        yield batch if mask is None else batch.filter(mask)
+
+
+def stream_concept_relationships(relationship_path, relationship_ids, block_size=64 << 20):
+    """
+    Yield (concept_id_1, concept_id_2, relationship_id) record batches from an Athena CONCEPT_RELATIONSHIP.csv,
+    keeping only valid rows with the given relationship_ids
+    """
+    reader = pacsv.open_csv(
+        relationship_path,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        parse_options=pacsv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=['concept_id_1', 'concept_id_2', 'relationship_id', 'invalid_reason'],
+            column_types={
+                'concept_id_1': pa.int64(), 'concept_id_2': pa.int64(),
+                'relationship_id': pa.string(), 'invalid_reason': pa.string()
+            }
+        )
+    )
+
+    for batch in reader:
+        mask = pc.and_(
+            pc.is_in(batch.column('relationship_id'), value_set=pa.array(relationship_ids, type=pa.string())),
+            pc.equal(batch.column('invalid_reason'), "")
+        )
+        yield batch.filter(mask).select(['concept_id_1', 'concept_id_2', 'relationship_id'])
+
+
+def stream_concept_ancestors(ancestor_path, max_levels=None, block_size=64 << 20):
+    """
+    Yield (ancestor_concept_id, descendant_concept_id) record batches from an Athena CONCEPT_ANCESTOR.csv,
+    dropping self rows and, if max_levels is given, descendants further than that many levels down
+    """
+    reader = pacsv.open_csv(
+        ancestor_path,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        parse_options=pacsv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=['ancestor_concept_id', 'descendant_concept_id', 'min_levels_of_separation'],
+            column_types={column: pa.int64() for column in
+                          ['ancestor_concept_id', 'descendant_concept_id', 'min_levels_of_separation']}
+        )
+    )
+
+    for batch in reader:
+        levels = batch.column('min_levels_of_separation')
+        mask = pc.greater(levels, 0)
+        if max_levels is not None:
+            mask = pc.and_(mask, pc.less_equal(levels, max_levels))
+        yield batch.filter(mask).select(['ancestor_concept_id', 'descendant_concept_id'])
+
+
+def load_concept_replacements(relationship_path):
+    """
+    Map each deprecated concept_id to the concept_id that replaced it ('Concept replaced by')
+    """
+    replacements = {}
+    for batch in stream_concept_relationships(relationship_path, ['Concept replaced by']):
+        replacements.update(zip(batch.column('concept_id_1').to_pylist(), batch.column('concept_id_2').to_pylist()))
+    return replacements
+
+
+def build_vocabulary_pack(concept_path, pack_path, vocabulary_ids=None, concept_class_ids=None, standard_concepts=None):
+    """
+    Stream CONCEPT.csv through the filters into a columnar (parquet) vocabulary pack
+    Returns the number of concepts written
+    """
+    filters = pack_filters(vocabulary_ids, concept_class_ids, standard_concepts)
+    os.makedirs(os.path.dirname(pack_path) or ".", exist_ok=True)
+    tmp_path = f"{pack_path}.tmp"
+
+    row_count = 0
+    writer = None
+    try:
+        for batch in stream_athena_concepts(concept_path, filters):
+            if writer is None:
+                schema = batch.schema.with_metadata({'omap_filters': json.dumps(filters)})
+                writer = pq.ParquetWriter(tmp_path, schema)
+            if batch.num_rows:
+                writer.write_batch(batch)
+                row_count += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        raise ValueError(f"No rows read from {concept_path}")
+
+    os.replace(tmp_path, pack_path)
+    return row_count
+
+
+def load_or_build_vocabulary_pack(concept_path, pack_dir="concepts/packs", name=None,
+                                  vocabulary_ids=None, concept_class_ids=None, standard_concepts=None):
+    """
+    Return the path of a cached pack for this CONCEPT.csv and filter set, building it only if missing
+    The cache key covers the filters and the source file's size and modification time
+    """
+    filters = pack_filters(vocabulary_ids, concept_class_ids, standard_concepts)
+    stat = os.stat(concept_path)
+    key_data = json.dumps({
+        'filters': filters,
+        'source': os.path.abspath(concept_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns
+    }, sort_keys=True)
+    pack_key = hashlib.sha256(key_data.encode()).hexdigest()[:12]
+
+    if name is None:
+        name = "_".join(filters['vocabulary_id'] or ["all"])
+    pack_path = os.path.join(pack_dir, f"{name}_{pack_key}.parquet")
+
+    if os.path.exists(pack_path):
+        print(f"[INFO] Using cached vocabulary pack {pack_path}")
+    else:
+        row_count = build_vocabulary_pack(concept_path, pack_path, vocabulary_ids, concept_class_ids, standard_concepts)
+        print(f"[INFO] Built vocabulary pack {pack_path} with {row_count} concepts")
+
+    return pack_path
+
+
+def list_vocabulary_packs(pack_dir="concepts/packs"):
+    if not os.path.exists(pack_dir):
+        return []
+    return sorted(f for f in os.listdir(pack_dir) if f.endswith(".parquet"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a filtered target vocabulary pack from an Athena CONCEPT.csv")
+    parser.add_argument("concept_path", help="Path to Athena CONCEPT.csv")
+    parser.add_argument("--vocabulary", nargs="+", help="vocabulary_id values to keep, e.g. RxNorm dm+d")
+    parser.add_argument("--concept-class", nargs="+", help="concept_class_id values to keep, e.g. 'Clinical Drug'")
+    parser.add_argument("--standard", nargs="+", help="standard_concept values to keep, e.g. S")
+    parser.add_argument("--name", help="Pack name prefix")
+    parser.add_argument("--pack-dir", default="concepts/packs")
+    args = parser.parse_args()
+
+    load_or_build_vocabulary_pack(
+        args.concept_path, args.pack_dir, args.name,
+        vocabulary_ids=args.vocabulary,
+        concept_class_ids=args.concept_class,
+        standard_concepts=args.standard
+    )
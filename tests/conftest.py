@@ -0,0 +1,45 @@
+import pytest
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import BertConfig, BertModel, PreTrainedTokenizerFast
+from src.match_utils import ModelHandler
+
+TINY_VOCAB = (
+    "paracetamol ibuprofen ondansetron dalteparin sodium injection tablet capsule oral "
+    "solution mg ml 500 250 10 wbc rbc plt haemoglobin count blood no matching concept"
+).split()
+
+
+def build_tiny_model():
+    """A randomly initialised one-layer BERT and word-level tokenizer, so no download is needed."""
+    torch.manual_seed(0)
+    vocab = {"[PAD]": 0, "[UNK]": 1}
+    for word in TINY_VOCAB:
+        vocab[word] = len(vocab)
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]", unk_token="[UNK]")
+    model = BertModel(BertConfig(
+        vocab_size=len(vocab), hidden_size=16, num_hidden_layers=1,
+        num_attention_heads=2, intermediate_size=32
+    )).eval()
+    return tokenizer, model
+
+
+@pytest.fixture
+def tiny_model_handler():
+    """A ModelHandler already holding the tiny model."""
+    handler = ModelHandler()
+    handler.tokenizer, handler.model = build_tiny_model()
+    return handler
+
+
+@pytest.fixture
+def tiny_model_path(tmp_path):
+    """The tiny model saved to disk, so it can be loaded through ModelHandler.load_model."""
+    tokenizer, model = build_tiny_model()
+    model_path = tmp_path / "tiny-bert"
+    tokenizer.save_pretrained(model_path)
+    model.save_pretrained(model_path)
+    return str(model_path)
@@ -0,0 +1,20 @@
+import json
+from benchmarks.run_benchmarks import BENCHMARKS, compare_results, main, run_suite
+
+# TEST 1: Every benchmark runs on a tiny synthetic job and reports its timings as JSON
+def test_benchmark_suite_runs(tmp_path):
+    output = tmp_path / "bench.json"
+    report = main(["--sources", "40", "--targets", "60", "--repeat", "1", "--dim", "8", "--output", str(output)])
+
+    assert set(report['results']) == set(BENCHMARKS)
+    assert all('error' not in result for result in report['results'].values()), report['results']
+    assert json.loads(output.read_text())['results']['omop_conversion']['items'] == 40
+
+# TEST 2: Similarity benchmarks score fewer source rows when the dense block would exceed the byte cap
+def test_matrix_rows_are_capped():
+    report = run_suite(40, 60, repeat=1, only=["similarity", "top_k"], dim=8, max_matrix_bytes=10 * 61 * 4)
+    assert report['matrix_rows'] == 10
+    assert report['results']['top_k']['items'] == 10
+
+    ratios = compare_results(report, report)
+    assert ratios == {'similarity': 1.0, 'top_k': 1.0}
@@ -0,0 +1,69 @@
+import json
+import os
+import pickle
+import numpy as np
+from src.blob_utils import BLOB_DIRNAME, clear_cache, table_hash
+from src.data_utils import ConceptMatch, SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable
+from src.session_utils import ProjectSession, list_saved_sessions, load_session, save_session_table
+
+
+def source_table(keys):
+    return SourceConceptTable([
+        SourceConcept(source_key=key, concept_code=str(key), concept_name=f"source {key}", vocabulary_id="medchart", concept_count=1)
+        for key in keys
+    ])
+
+
+def target_table(ids):
+    return TargetConceptTable([
+        TargetConcept(concept_id=concept_id, concept_code=str(concept_id), concept_name=f"target {concept_id}", vocabulary_id="dm+d")
+        for concept_id in ids
+    ])
+
+
+def save(project_name, sources, targets, sessions_dir):
+    matches = [ConceptMatch(source_key=concept.source_key, target_concept_id=0, similarity_score=0.5,
+                            confirmation_status="False", first_confirmation_timestamp=None, last_update_timestamp=None)
+               for concept in sources.concepts]
+    ProjectSession.create_and_save_session(project_name, sources, targets, np.zeros((len(sources.concepts), len(targets.concepts))),
+                                           matches, sessions_dir=sessions_dir, reuse_mappings=False)
+    _, sessions = list_saved_sessions(sessions_dir)
+    return next(info['session_name'] for info in sessions if info['project_name'] == project_name)
+
+# TEST 1: Sessions on the same target table store it once, and loading them shares a single in-memory copy
+def test_shared_target_table(tmp_path):
+    sessions_dir = str(tmp_path)
+    names = [save("ward_a", source_table([1, 2]), target_table([0, 5, 6]), sessions_dir),
+             save("ward_b", source_table([3]), target_table([0, 5, 6]), sessions_dir),
+             save("ward_c", source_table([4]), target_table([0, 7]), sessions_dir)]
+
+    # three source tables and two distinct target tables
+    assert len(os.listdir(tmp_path / BLOB_DIRNAME)) == 5
+    assert not any(name.endswith("_concepts.pkl") for name in os.listdir(tmp_path / names[0]))
+
+    clear_cache()
+    a, b, c = [load_session(name, sessions_dir)[1] for name in names]
+    assert a.target_table is b.target_table and a.target_table is not c.target_table
+    assert [concept.concept_id for concept in b.target_table.concepts] == [0, 5, 6]
+    assert table_hash(a.source_table) != table_hash(b.source_table)
+
+# TEST 2: Sessions saved before the store keep loading from their own pickles until a table is rewritten
+def test_legacy_session_tables(tmp_path):
+    sessions_dir = str(tmp_path)
+    name = save("legacy", source_table([1, 2]), target_table([0, 5]), sessions_dir)
+    session_dir = tmp_path / name
+
+    # turn the session back into the old layout
+    metadata = json.loads((session_dir / "metadata.json").read_text())
+    for side, table in [("source", source_table([1, 2])), ("target", target_table([0, 5]))]:
+        del metadata[f"{side}_table_hash"]
+        with open(session_dir / f"{side}_concepts.pkl", 'wb') as f:
+            pickle.dump(table, f)
+    (session_dir / "metadata.json").write_text(json.dumps(metadata))
+
+    success, session = load_session(name, sessions_dir)
+    assert success and [concept.source_key for concept in session.source_table.concepts] == [1, 2]
+
+    save_session_table(str(session_dir), "target", target_table([0, 5, 9]), sessions_dir)
+    assert not (session_dir / "target_concepts.pkl").exists() and (session_dir / "source_concepts.pkl").exists()
+    assert [concept.concept_id for concept in load_session(name, sessions_dir)[1].target_table.concepts] == [0, 5, 9]
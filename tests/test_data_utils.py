@@ -1,5 +1,8 @@
+import hashlib
+import pandas as pd
 import pytest
-from src.data_utils import filter_for_unconfirmed_mappings, sort_concepts
+from src.data_utils import (LEGACY_KEY_SPACE, SourceConceptTable, filter_for_unconfirmed_mappings, generate_source_key,
+                            generate_source_keys, sort_concepts)
 from src.session_utils import ConceptMatch
 
 @pytest.fixture
@@ -38,4 +41,29 @@ def test_sort_concepts_alphabetical(sample_mappings, sample_source_lookup):
 def test_sort_concepts_highest_confidence(sample_mappings, sample_source_lookup):
     sorted_mappings = sort_concepts(sample_mappings, sample_source_lookup, sort_option="Highest Confidence")
     sorted_scores = [m.similarity_score for m in sorted_mappings]
-    assert sorted_scores == sorted(sorted_scores, reverse=True)  # Should be sorted highest to lowest
\ No newline at end of file
+    assert sorted_scores == sorted(sorted_scores, reverse=True)  # Should be sorted highest to lowest
+
+# TEST 4: Batch source keys equal the single-concept keys, and reduce to the 9 digit keys of earlier versions
+def test_source_keys():
+    df = pd.DataFrame({'source_concept_code': ["X1", 2], 'source_concept_name': ["clexane", "wbc"],
+                       'source_vocabulary_id': ["medchart", "labs"], 'source_concept_count': [3, 1.0]})
+    success, table = SourceConceptTable.from_dataframe(df)
+    assert success
+    keys = [concept.source_key for concept in table.concepts]
+    assert keys == generate_source_keys(["X1", "2"], ["clexane", "wbc"], ["medchart", "labs"]).tolist()
+    assert keys == [generate_source_key("X1", "clexane", "medchart"), generate_source_key("2", "wbc", "labs")]
+    assert all(10**9 <= key < 2**63 for key in keys)
+
+    old_key = int.from_bytes(hashlib.sha256(b"X1_clexane_medchart").digest()[:8], 'big') % 1000000000
+    assert keys[0] % LEGACY_KEY_SPACE == old_key
+    assert generate_source_key("X1", "clexane", "medchart", salt=1) != keys[0]
+
+    success, message = SourceConceptTable.from_dataframe(df.assign(source_concept_count=["3", "many"]))
+    assert not success and "Row 1" in message
+
+# TEST 5: Matches without a model score sort last by confidence, either way
+def test_sort_concepts_without_score(sample_mappings, sample_source_lookup):
+    sample_mappings[1].similarity_score = None
+    for option in ["Highest Confidence", "Lowest Confidence"]:
+        sorted_mappings = sort_concepts(sample_mappings, sample_source_lookup, sort_option=option)
+        assert sorted_mappings[-1].source_key == 2
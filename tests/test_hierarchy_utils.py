@@ -0,0 +1,65 @@
+import numpy as np
+from src.data_utils import SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable
+from src.hierarchy_utils import hierarchical_candidates, load_children, matches_from_candidates
+from src.match_utils import top_k_candidates
+
+# coarse: 1 paracetamol, 2 ondansetron, 3 dalteparin; fine: their products
+TARGETS = TargetConceptTable([
+    TargetConcept(concept_id=concept_id, concept_code=str(concept_id), concept_name=name, vocabulary_id="dm+d")
+    for concept_id, name in [
+        (1, "paracetamol"), (2, "ondansetron"), (3, "dalteparin sodium"),
+        (11, "paracetamol 500 mg tablet"), (12, "paracetamol 250 mg capsule"),
+        (21, "ondansetron 10 mg tablet"), (22, "ondansetron oral solution"),
+        (31, "dalteparin sodium injection")
+    ]
+])
+SOURCES = SourceConceptTable([
+    SourceConcept(source_key=key, concept_code=str(key), concept_name=name, vocabulary_id="medchart", concept_count=count)
+    for key, name, count in [(101, "paracetamol tablet", 5), (102, "dalteparin sodium injection", 9)]
+])
+
+
+def write_ancestors(tmp_path):
+    rows = [(1, 1, 0), (1, 11, 1), (1, 12, 1), (2, 21, 1), (2, 22, 1), (3, 31, 1), (3, 99, 1)]  # 99 is not a target
+    path = tmp_path / "CONCEPT_ANCESTOR.csv"
+    path.write_text("ancestor_concept_id\tdescendant_concept_id\tmin_levels_of_separation\tmax_levels_of_separation\n"
+                    + "".join(f"{a}\t{d}\t{level}\t{level}\n" for a, d, level in rows))
+    return str(path)
+
+# TEST 1: Parent -> child links load from CONCEPT_ANCESTOR or CONCEPT_RELATIONSHIP, restricted to the target table
+def test_load_children(tmp_path):
+    children = load_children(TARGETS, ancestor_path=write_ancestors(tmp_path))
+    assert {parent: child.tolist() for parent, child in children.items()} == {1: [11, 12], 2: [21, 22], 3: [31]}
+
+    path = tmp_path / "CONCEPT_RELATIONSHIP.csv"
+    path.write_text("concept_id_1\tconcept_id_2\trelationship_id\tvalid_start_date\tvalid_end_date\tinvalid_reason\n"
+                    "1\t11\tSubsumes\t20200101\t20991231\t\n"
+                    "11\t1\tIs a\t20200101\t20991231\t\n"
+                    "2\t21\tSubsumes\t20200101\t20991231\tD\n")
+    children = load_children(TARGETS, relationship_path=str(path))
+    assert {parent: child.tolist() for parent, child in children.items()} == {1: [11]}
+
+# TEST 2: Each source only searches its top coarse concepts' subtrees, and a full coarse search equals flat matching
+def test_hierarchical_candidates(tiny_model_handler, tmp_path):
+    children = load_children(TARGETS, ancestor_path=write_ancestors(tmp_path))
+
+    candidate_ids, candidate_scores, _, stats = hierarchical_candidates(
+        tiny_model_handler, SOURCES, TARGETS, children, coarse_k=1, k=3
+    )
+    subtrees = [{1, 11, 12}, {2, 21, 22}, {3, 31}]
+    for row in candidate_ids:
+        searched = set(row[row != 0].tolist())
+        assert any(searched <= subtree for subtree in subtrees)
+    assert stats['mean_search_space'] < stats['flat_search_space']
+
+    candidate_ids, candidate_scores, _, _ = hierarchical_candidates(
+        tiny_model_handler, SOURCES, TARGETS, children, coarse_k=3, k=3
+    )
+    _, similarities = tiny_model_handler.get_concept_similarities(SOURCES, TARGETS)
+    flat_ids, flat_scores = top_k_candidates(similarities, TARGETS, k=3)
+    assert np.array_equal(candidate_ids, flat_ids)
+    assert np.allclose(candidate_scores, flat_scores, atol=1e-5)
+
+    matches = matches_from_candidates(SOURCES, candidate_ids, candidate_scores)
+    assert [m.source_key for m in matches] == [102, 101]
+    assert matches[1].target_concept_id == candidate_ids[0, 0]
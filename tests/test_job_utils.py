@@ -0,0 +1,123 @@
+import os
+import threading
+import numpy as np
+from src.data_utils import SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable
+from src.job_utils import MATCH_JOB_KINDS, JobRunner, auto_match_job, hierarchical_job, multi_vocab_job
+from src.match_utils import ModelHandler
+
+SOURCES = SourceConceptTable([SourceConcept(key, str(key), name, "medchart", 1)
+                              for key, name in [(1, "paracetamol tablet"), (2, "ondansetron")]])
+TARGETS = TargetConceptTable([TargetConcept(concept_id, str(concept_id), name, "dm+d")
+                              for concept_id, name in [(0, "no matching concept"), (5, "paracetamol 500 mg tablet"),
+                                                       (6, "ondansetron 10 mg tablet")]])
+
+
+def blocking_job(context, release, steps=3):
+    for step in range(steps):
+        release.wait(10)
+        context.progress(step + 1, steps, "work")
+    return {'scores': np.arange(steps, dtype=np.float32), 'label': "done"}
+
+# TEST 1: A job's progress and result are persisted, and a new runner (e.g. after a restart) can read them back
+def test_job_result_and_reattach(tmp_path):
+    runner = JobRunner(str(tmp_path), save_interval=0)
+    release = threading.Event()
+    release.set()
+    job_id = runner.submit("test", blocking_job, release, label="three steps")
+    job = runner.wait(job_id, timeout=10)
+    assert (job.status, job.done, job.total, job.stage) == ("succeeded", 3, 3, "work")
+
+    reattached = JobRunner(str(tmp_path))
+    assert reattached.get(job_id).status == "succeeded"
+    result = reattached.load_result(job_id)
+    assert result['label'] == "done" and isinstance(result['scores'], np.memmap)
+    assert [job.job_id for job in reattached.list_jobs("test")] == [job_id]
+
+# TEST 2: Only max_concurrent jobs run at once; queued and running jobs can be cancelled, and unfinished jobs
+# left by a previous process are marked interrupted
+def test_queue_and_cancellation(tmp_path):
+    runner = JobRunner(str(tmp_path), max_concurrent=1, save_interval=0)
+    release = threading.Event()
+    first = runner.submit("test", blocking_job, release)
+    second = runner.submit("test", blocking_job, release)
+    assert runner.get(second).status == "queued"
+
+    assert runner.cancel(second) and runner.get(second).status == "cancelled"
+    assert runner.get(first).status in ("queued", "running")
+    runner.cancel(first)
+    release.set()
+    assert runner.wait(first, timeout=10).status == "cancelled"
+
+    stuck = runner.get(first)
+    stuck.status = "running"
+    runner.save_job(stuck)
+    assert JobRunner(str(tmp_path)).get(first).status == "interrupted"
+
+# TEST 3: The auto-match job produces what the Auto-Match page needs to save a session
+def test_auto_match_job(tiny_model_path, tmp_path):
+    runner = JobRunner(str(tmp_path / "jobs"))
+    job_id = runner.submit("auto-match", auto_match_job, SOURCES, TARGETS, checkpoint_dir=None,
+                           model_path=tiny_model_path, cache_dir=str(tmp_path / "cache"))
+    job = runner.wait(job_id, timeout=60)
+    assert job.status == "succeeded", job.error
+    assert job.stage == "embedding" and job.done == job.total
+
+    result = runner.load_result(job_id)
+    assert result['similarities'].shape == (2, 3)
+    assert len(result['concept_matches']) == 2
+    assert result['candidate_ids'].shape == (2, 3)
+    # the Mapping page's target search embeds queries with the same model and backend
+    assert (result['model_path'], result['backend']) == (tiny_model_path, "torch")
+
+    # once saved as a session the result is deleted, and the job can no longer be loaded
+    assert runner.discard_result(job_id)
+    assert os.listdir(runner.job_dir(job_id)) == ["job.json"]
+    assert JobRunner(str(tmp_path / "jobs")).get(job_id).result_discarded
+    assert not runner.discard_result(job_id)
+
+# TEST 4: Cancelling a running auto-match job stops it at the next batch, through the model's own error handling
+def test_auto_match_cancellation(tiny_model_path, tmp_path, monkeypatch):
+    runner = JobRunner(str(tmp_path / "jobs"), save_interval=0)
+    submitted = threading.Event()
+    job_ids = []
+    load_model = ModelHandler.load_model
+
+    def load_then_cancel(handler):
+        loaded = load_model(handler)
+        submitted.wait(10)
+        runner.cancel(job_ids[0])
+        return loaded
+
+    monkeypatch.setattr(ModelHandler, "load_model", load_then_cancel)
+    job_ids.append(runner.submit("auto-match", auto_match_job, SOURCES, TARGETS, checkpoint_dir=None,
+                                 model_path=tiny_model_path, cache_dir=str(tmp_path / "cache")))
+    submitted.set()
+    job = runner.wait(job_ids[0], timeout=60)
+    assert (job.status, job.error, job.stage) == ("cancelled", None, "embedding")
+
+# TEST 5: Multi-vocabulary and hierarchical runs are jobs too, with the keys the Auto-Match page loads
+def test_multi_vocab_and_hierarchical_jobs(tiny_model_path, tmp_path):
+    runner = JobRunner(str(tmp_path / "jobs"))
+    vtms = TargetConceptTable([TargetConcept(0, "0", "no matching concept", "dm+d"),
+                               TargetConcept(7, "7", "paracetamol", "dm+d")])
+    ancestors = tmp_path / "CONCEPT_ANCESTOR.csv"
+    ancestors.write_text("ancestor_concept_id\tdescendant_concept_id\tmin_levels_of_separation\tmax_levels_of_separation\n"
+                         "5\t6\t1\t1\n")
+    options = dict(checkpoint_dir=None, model_path=tiny_model_path, cache_dir=str(tmp_path / "cache"))
+    multi_id = runner.submit("multi-vocab-match", multi_vocab_job, SOURCES, {'vmp': TARGETS, 'vtm': vtms}, **options)
+    hierarchy_id = runner.submit("hierarchical-match", hierarchical_job, SOURCES, TARGETS,
+                                 ancestor_path=str(ancestors), coarse_k=1, **options)
+    for job_id in (multi_id, hierarchy_id):
+        job = runner.wait(job_id, timeout=60)
+        assert job.status == "succeeded", job.error
+
+    multi = runner.load_result(multi_id)
+    assert multi['partitions'] == {'vmp': [5, 6], 'vtm': [7]}
+    assert set(multi['partition_candidates']) == {'vmp', 'vtm'}
+    assert len(multi['concept_matches']) == 2 and multi['similarities'] is None
+    assert [concept.concept_id for concept in multi['target_table'].concepts] == [0, 5, 6, 7]
+
+    hierarchical = runner.load_result(hierarchy_id)
+    assert 'partitions' not in hierarchical and hierarchical['similarities'] is None
+    assert hierarchical['candidate_ids'].shape[0] == 2 and len(hierarchical['notes']) == 1
+    assert [job.job_id for job in runner.list_jobs(MATCH_JOB_KINDS)] == [hierarchy_id, multi_id]
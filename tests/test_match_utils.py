@@ -0,0 +1,185 @@
+import os
+import numpy as np
+import pytest
+from types import SimpleNamespace
+from src.checkpoint_utils import KEEP_RUNS, RunCheckpoint, list_runs, prune_runs
+from src.data_utils import SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable
+from src.match_utils import (ModelHandler, build_length_buckets, compare_backends, deduplicate_texts,
+                             normalize_concept_text, padding_efficiency)
+from src.session_utils import ProjectSession, list_saved_sessions, load_session_embeddings
+
+
+class CountingModelHandler(ModelHandler):
+    """ModelHandler with a deterministic character-count 'model' that records what it embeds."""
+
+    def __init__(self):
+        super().__init__()
+        self.model = SimpleNamespace(device="cpu")
+        self.embedded = []
+
+    def batch_generate_embeddings(self, texts, max_batch_tokens=8192):
+        self.embedded.extend(texts)
+        return np.array([[text.count(c) + 1.0 for c in "aeiou "] for text in texts], dtype=np.float32)
+
+
+def make_tables(source_names, target_names):
+    source_table = SourceConceptTable([
+        SourceConcept(source_key=i, concept_code=str(i), concept_name=name, vocabulary_id="test", concept_count=1)
+        for i, name in enumerate(source_names)
+    ])
+    target_table = TargetConceptTable([
+        TargetConcept(concept_id=i, concept_code=str(i), concept_name=name, vocabulary_id="test")
+        for i, name in enumerate(target_names)
+    ])
+    return source_table, target_table
+
+# TEST 1: Normalisation folds case and whitespace
+def test_normalize_concept_text():
+    assert normalize_concept_text("  Paracetamol   500mg Tablet ") == "paracetamol 500mg tablet"
+
+# TEST 2: Duplicate names map to one unique string, and the index array restores input order
+def test_deduplicate_texts():
+    texts = ["WBC", "wbc ", "RBC", "Wbc", "PLT", "RBC"]
+    unique_texts, inverse = deduplicate_texts(texts)
+    assert unique_texts == ["wbc", "rbc", "plt"]
+    assert [unique_texts[i] for i in inverse] == [normalize_concept_text(t) for t in texts]
+
+# TEST 3: Similarities are computed once per unique name and fanned back out to every row
+def test_get_concept_similarities_embeds_unique_names_once(tmp_path):
+    source_table, target_table = make_tables(
+        ["Paracetamol", "paracetamol", "Ondansetron", "PARACETAMOL "],
+        ["paracetamol", "ondansetron", "Ondansetron"],
+    )
+    handler = CountingModelHandler()
+    success, similarities = handler.get_concept_similarities(source_table, target_table)
+
+    assert success
+    assert similarities.shape == (4, 3)
+    assert len(handler.embedded) == 4  # two unique source names, two unique target names
+    assert handler.dedup_stats["source"]["dedup_ratio"] == 2.0
+    np.testing.assert_allclose(similarities[0], similarities[1])
+    np.testing.assert_allclose(similarities[0], similarities[3])
+    np.testing.assert_allclose(similarities[:, 1], similarities[:, 2])
+
+    # embeddings are kept per unique name, and expanded to one row per concept only when a session is loaded
+    assert handler.embeddings['source'].shape == (2, 6) and handler.embeddings['target'].shape == (2, 6)
+    ProjectSession.create_and_save_session(
+        "dedup", source_table, target_table, similarities,
+        handler.generate_initial_matches(source_table, target_table, similarities),
+        source_embeddings=handler.embeddings['source'], target_embeddings=handler.embeddings['target'],
+        source_inverse=handler.embeddings['source_inverse'], target_inverse=handler.embeddings['target_inverse'],
+        sessions_dir=str(tmp_path), reuse_mappings=False
+    )
+    _, sessions = list_saved_sessions(str(tmp_path))
+    loaded_sources, loaded_targets = load_session_embeddings(f"{tmp_path}/{sessions[0]['session_name']}")
+    np.testing.assert_allclose(loaded_sources @ loaded_targets.T, similarities, atol=1e-6)
+
+# TEST 4: Length buckets cover every index once and respect the padded token budget
+def test_build_length_buckets_respects_token_budget():
+    lengths = [3, 40, 5, 12, 3, 38, 7, 1, 25]
+    batches = build_length_buckets(lengths, max_batch_tokens=48)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    assert all(max(lengths[i] for i in batch) * len(batch) <= 48 for batch in batches)
+    assert padding_efficiency(lengths, batches) > padding_efficiency(lengths, [list(range(len(lengths)))])
+
+# TEST 5: Bucketed, padded batches give the same embeddings, in input order, as one text at a time
+def test_batch_generate_embeddings_matches_single_text(tiny_model_handler):
+    texts = ["wbc", "paracetamol 500 mg oral tablet", "rbc count", "dalteparin sodium injection 10 mg ml", "plt"]
+    batched = tiny_model_handler.batch_generate_embeddings(texts, max_batch_tokens=8)
+    single = np.array([tiny_model_handler.generate_embedding(text) for text in texts])
+
+    np.testing.assert_allclose(batched, single, rtol=1e-4, atol=1e-5)
+    assert tiny_model_handler.padding_stats["batches"] > 1
+
+# TEST 6: Optimised CPU backends are cached on disk and agree with the full precision model
+@pytest.mark.parametrize("backend", ["int8", "onnx"])
+def test_inference_backends_match_reference(tiny_model_path, tmp_path, backend):
+    if backend == "onnx":
+        pytest.importorskip("onnxruntime")
+    reference = ModelHandler(model_path=tiny_model_path, cache_dir=str(tmp_path / "cache"))
+    candidate = ModelHandler(model_path=tiny_model_path, cache_dir=str(tmp_path / "cache"), backend=backend)
+    assert reference.load_model()[0]
+    assert candidate.load_model()[0]
+    assert os.path.exists(candidate.backend_cache_path())
+
+    report = compare_backends(
+        reference, candidate,
+        ["paracetamol 500 mg tablet", "wbc", "dalteparin sodium injection"],
+        ["paracetamol", "wbc count", "dalteparin sodium", "ondansetron"]
+    )
+    assert report["mean_cosine_agreement"] > 0.95
+    assert report["top1_agreement"] == 1.0
+    assert report["candidate_texts_per_sec"] > 0
+
+# TEST 7: An interrupted checkpointed embedding run resumes at the first unfinished shard
+def test_checkpointed_embeddings_resume_after_crash(tmp_path):
+    texts = ["paracetamol", "ibuprofen", "ondansetron", "dalteparin", "wbc"]
+
+    class CrashingModelHandler(CountingModelHandler):
+        def batch_generate_embeddings(self, texts, max_batch_tokens=8192):
+            if len(self.embedded) >= 4:
+                raise RuntimeError("process restarted")
+            return super().batch_generate_embeddings(texts, max_batch_tokens)
+
+    crashing = CrashingModelHandler()
+    crashing.checkpoint_dir = str(tmp_path)
+    with pytest.raises(RuntimeError):
+        crashing.checkpointed_embeddings(texts, shard_size=2)
+
+    resumed = CountingModelHandler()
+    resumed.checkpoint_dir = str(tmp_path)
+    embeddings = resumed.checkpointed_embeddings(texts, shard_size=2)
+
+    assert resumed.embedded == ["wbc"]  # only the last shard is embedded again
+    np.testing.assert_allclose(embeddings, CountingModelHandler().batch_generate_embeddings(texts))
+
+# TEST 8: Checkpointed matching gives the same similarities as the in-memory path
+def test_checkpointed_similarities_match_in_memory(tmp_path):
+    source_table, target_table = make_tables(
+        ["Paracetamol", "ondansetron", "wbc count", "paracetamol"],
+        ["paracetamol", "ondansetron", "white blood cell count"],
+    )
+    _, expected = CountingModelHandler().get_concept_similarities(source_table, target_table)
+
+    handler = CountingModelHandler()
+    handler.checkpoint_dir = str(tmp_path)
+    success, similarities = handler.get_concept_similarities(source_table, target_table)
+
+    assert success
+    np.testing.assert_allclose(similarities, expected, rtol=1e-6)
+
+# TEST 9: Only the most recent checkpoint runs are kept, and a handler discards its own runs once they are consumed
+def test_checkpoint_retention(tmp_path):
+    for names in [["paracetamol"], ["ibuprofen"], ["ondansetron"]]:
+        handler = CountingModelHandler()
+        handler.checkpoint_dir = str(tmp_path)
+        assert handler.get_concept_similarities(*make_tables(names, ["paracetamol", "wbc"]))[0]
+    assert len(list_runs(str(tmp_path), "similarities")) == KEEP_RUNS
+
+    runs = list(handler.checkpoint_runs)
+    similarities = np.load(f"{runs[-1]}/similarities.npy", mmap_mode="r")
+    handler.discard_checkpoints()
+    assert len(list_runs(str(tmp_path), "similarities")) == KEEP_RUNS - 1
+    assert not any(os.path.exists(run_dir) for run_dir in runs)
+    assert similarities.shape == (1, 2)  # still readable while memory-mapped
+
+# TEST 10: Runs still in use are never pruned: those held by a handler mid-run, and unfinished runs of another
+# process until they go stale
+def test_checkpoint_runs_in_use_are_kept(tmp_path):
+    handler = CountingModelHandler()
+    handler.checkpoint_dir = str(tmp_path)
+    # e.g. a multi-vocabulary run: one source embedding run, then one run per target vocabulary
+    for target_names in [["paracetamol"], ["wbc"], ["ibuprofen"], ["dalteparin sodium"]]:
+        assert handler.get_concept_similarities(*make_tables(["ondansetron"], target_names))[0]
+    assert len(list_runs(str(tmp_path), "embeddings")) == 5
+    assert len(list_runs(str(tmp_path), "similarities")) == 4
+
+    unfinished = RunCheckpoint.for_run(str(tmp_path), "similarities", {'inputs': "elsewhere"})
+    unfinished.release()
+    del handler
+    assert len(prune_runs(str(tmp_path), "similarities")) == 3
+    assert unfinished.run_dir in list_runs(str(tmp_path), "similarities")
+
+    os.utime(unfinished.path("manifest.json"), (0, 0))
+    assert unfinished.run_dir in prune_runs(str(tmp_path), "similarities", keep=0)
+    assert list_runs(str(tmp_path), "similarities") == []
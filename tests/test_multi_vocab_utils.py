@@ -0,0 +1,93 @@
+import numpy as np
+from src.data_utils import SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable
+from src.match_utils import top_k_candidates
+from src.multi_vocab_utils import combine_target_tables, match_multiple_vocabularies, partition_alternatives
+from src.pack_utils import VocabPack, build_vocab_pack
+from src.session_utils import ProjectSession, list_saved_sessions, load_session
+from src.hierarchy_utils import matches_from_candidates
+
+NO_MATCH = TargetConcept(concept_id=0, concept_code="No matching concept", concept_name="No matching concept", vocabulary_id="None")
+SOURCES = SourceConceptTable([
+    SourceConcept(source_key=key, concept_code=str(key), concept_name=name, vocabulary_id="medchart", concept_count=1)
+    for key, name in [(101, "paracetamol tablet"), (102, "ondansetron oral solution"), (103, "wbc count")]
+])
+
+
+def make_table(rows, vocabulary_id):
+    return TargetConceptTable([NO_MATCH] + [
+        TargetConcept(concept_id=concept_id, concept_code=str(concept_id), concept_name=name, vocabulary_id=vocabulary_id)
+        for concept_id, name in rows
+    ])
+
+
+VTM = make_table([(1, "paracetamol"), (2, "ondansetron")], "dm+d")
+VMP = make_table([(11, "paracetamol 500 mg tablet"), (21, "ondansetron oral solution"), (2, "ondansetron")], "dm+d")
+RXNORM = make_table([(31, "paracetamol 250 mg oral capsule"), (32, "wbc count blood")], "RxNorm")
+
+
+class CountingHandler:
+    """Wraps a ModelHandler, counting the texts embedded per label."""
+    def __init__(self, handler):
+        self.handler = handler
+        self.model_path = handler.model_path
+        self.backend = handler.backend
+        self.counts = {}
+
+    def deduplicated_embeddings(self, texts, label):
+        self.counts[label] = self.counts.get(label, 0) + len(texts)
+        return self.handler.deduplicated_embeddings(texts, label)
+
+# TEST 1: Sources are embedded once, each vocabulary keeps its own top-k, and the overall top-k equals flat matching
+def test_match_multiple_vocabularies(tiny_model_handler, tmp_path):
+    handler = CountingHandler(tiny_model_handler)
+    success, result = match_multiple_vocabularies(handler, SOURCES, {'vtm': VTM, 'vmp': VMP, 'rxnorm': RXNORM}, k=3)
+    assert success, result
+    assert handler.counts['source'] == len(SOURCES.concepts)
+
+    combined = result['target_table']
+    assert combined.concepts[0].concept_id == 0
+    assert sorted(c.concept_id for c in combined.concepts) == [0, 1, 2, 11, 21, 31, 32]
+    assert result['partitions']['vmp'] == [11, 21, 2]
+
+    for label, table in [('vtm', VTM), ('rxnorm', RXNORM)]:
+        ids, _ = result['partition_candidates'][label]
+        assert set(ids.ravel()) <= {c.concept_id for c in table.concepts if c.concept_id != 0}
+
+    # concept 2 is in two partitions but is a single overall candidate
+    without_no_match = TargetConceptTable(combined.concepts[1:])
+    _, similarities = tiny_model_handler.get_concept_similarities(SOURCES, without_no_match)
+    flat_ids, flat_scores = top_k_candidates(similarities, without_no_match, k=3)
+    assert np.array_equal(result['candidates'][0], flat_ids)
+    assert np.allclose(result['candidates'][1], flat_scores, atol=1e-5)
+
+    # a vocab pack partition is searched through its stored embeddings, never offering its 'No matching concept' row
+    pack_path = str(tmp_path / "rxnorm.vpack")
+    build_vocab_pack(RXNORM, tiny_model_handler, pack_path, dtype="float32")
+    success, packed = match_multiple_vocabularies(handler, SOURCES, {'vtm': VTM, 'rxnorm': VocabPack.open(pack_path)}, k=2)
+    assert success, packed
+    assert np.array_equal(packed['partition_candidates']['rxnorm'][0], result['partition_candidates']['rxnorm'][0][:, :2])
+
+    # a pack embedded with another backend is refused, as its scores don't compare with the sources'
+    handler.backend = "onnx"
+    success, message = match_multiple_vocabularies(handler, SOURCES, {'rxnorm': VocabPack.open(pack_path)}, k=2)
+    assert not success and "onnx" in message
+
+# TEST 2: Partitions and per-vocabulary candidates are saved with the session
+def test_multi_vocabulary_session_round_trip(tiny_model_handler, tmp_path):
+    _, result = match_multiple_vocabularies(tiny_model_handler, SOURCES, {'vtm': VTM, 'rxnorm': RXNORM}, k=2)
+    matches = matches_from_candidates(SOURCES, *result['candidates'])
+    success, message = ProjectSession.create_and_save_session(
+        "multi", SOURCES, result['target_table'], None, matches, candidates=result['candidates'],
+        sessions_dir=str(tmp_path), target_partitions=result['partitions'],
+        partition_candidates=result['partition_candidates']
+    )
+    assert success, message
+    _, sessions = list_saved_sessions(str(tmp_path))
+    _, session = load_session(sessions[0]['session_name'], str(tmp_path))
+
+    assert session.similarity_matrix is None
+    assert session.target_partitions == result['partitions']
+    alternatives = partition_alternatives(session, 2, 'rxnorm')
+    ids, scores = result['partition_candidates']['rxnorm']
+    assert alternatives == [(int(i), float(s)) for i, s in zip(ids[2], scores[2])]
+    assert combine_target_tables({'vtm': VTM})[1] == {'vtm': [1, 2]}
@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+from datetime import datetime
+import numpy as np
+from src.data_utils import ConceptMatch, SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable
+from src.omop_utils import assign_concept_ids, generate_concept_table, generate_relationship_table, load_session_exports
+from src.session_utils import ProjectSession, list_saved_sessions, load_session
+
+NO_MATCH = TargetConcept(concept_id=0, concept_code="No matching concept", concept_name="No matching concept", vocabulary_id="None")
+TARGETS = TargetConceptTable([NO_MATCH] + [
+    TargetConcept(concept_id=concept_id, concept_code=str(concept_id), concept_name=f"target {concept_id}", vocabulary_id="dm+d")
+    for concept_id in [1, 2, 3]
+])
+
+
+def create_reviewed_session(name, keys, target_ids, sessions_dir):
+    """A saved session whose every row is confirmed, or rejected where the target is 0."""
+    source_table = SourceConceptTable([
+        SourceConcept(source_key=key, concept_code=str(key), concept_name=f"source {key}", vocabulary_id="medchart", concept_count=1)
+        for key in keys
+    ])
+    matches = [
+        ConceptMatch(source_key=key, target_concept_id=target_id, similarity_score=0.5,
+                     confirmation_status="Rejected" if target_id == 0 else "True",
+                     first_confirmation_timestamp=datetime.now(), last_update_timestamp=datetime.now())
+        for key, target_id in zip(keys, target_ids)
+    ]
+    success, message = ProjectSession.create_and_save_session(
+        name, source_table, TARGETS, np.zeros((len(keys), 4)), matches, sessions_dir=sessions_dir, reuse_mappings=False
+    )
+    assert success, message
+
+# TEST 1: Sessions loaded over a process pool convert to the same IDs and rows as loading them one by one
+def test_parallel_conversion_matches_serial(tmp_path):
+    sessions_dir = str(tmp_path)
+    for name, keys, target_ids in [("ward_a", [11, 12, 13], [2, 0, 3]), ("ward_b", [21, 11], [1, 2]),
+                                   ("ward_c", [31, 32], [3, 1])]:
+        create_reviewed_session(name, keys, target_ids, sessions_dir)
+
+    _, listed = list_saved_sessions(sessions_dir)
+    names = [info['session_name'] for info in listed]
+    serial = [load_session(name, sessions_dir)[1] for name in names]
+    exports = [export for success, export in load_session_exports(names, sessions_dir, workers=2)]
+    assert [export.project_name for export in exports] == [session.project_name for session in serial]
+    assert all(export.fully_mapped for export in exports)
+
+    expected_ids = assign_concept_ids(serial)
+    assert assign_concept_ids(exports) == expected_ids
+    assert generate_concept_table(exports, expected_ids) == generate_concept_table(serial, expected_ids)
+    assert generate_relationship_table(exports, expected_ids) == generate_relationship_table(serial, expected_ids)
+
+# TEST 2: Conversion workers preload only what loading a session needs, not the model libraries
+def test_worker_preload_does_not_import_torch():
+    code = "import sys, src.omop_utils; sys.exit('torch' in sys.modules or 'transformers' in sys.modules)"
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert subprocess.run([sys.executable, "-c", code], cwd=repo_root).returncode == 0
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from sklearn.metrics.pairwise import cosine_similarity
+from src.data_utils import TargetConcept, TargetConceptTable
+from src.match_utils import normalize_concept_text
+from src.pack_utils import VocabPack, build_vocab_pack
+
+
+@pytest.fixture
+def target_table():
+    names = ["No matching concept", "paracetamol 500 mg tablet", "ibuprofen 250 mg capsule",
+             "ondansetron oral solution", "wbc count", "Paracetamol 500 mg Tablet"]
+    return TargetConceptTable([
+        TargetConcept(concept_id=concept_id, concept_code=f"code-{concept_id}", concept_name=name, vocabulary_id="dm+d")
+        for concept_id, name in zip([0, 305, 17, 42, 9, 11], names)
+    ])
+
+# TEST 1: A pack round-trips the target table and its content hash through a memory-mapped file
+@pytest.mark.parametrize("dtype", ["float16", "float32", "int8"])
+def test_vocab_pack_round_trip(tiny_model_handler, target_table, tmp_path, dtype):
+    pack_path = str(tmp_path / "targets.vpack")
+    metadata = build_vocab_pack(target_table, tiny_model_handler, pack_path, dtype)
+    pack = VocabPack.open(pack_path)
+
+    assert pack.to_target_table().concepts == target_table.concepts
+    assert pack.content_hash == metadata["content_hash"]
+    assert pack.embeddings.dtype == np.dtype(dtype)
+    assert isinstance(pack.embeddings.base, np.memmap)
+    assert list(pack.rows_for_ids([42, 305, 12345])) == [3, 1, -1]
+    assert VocabPack.open(pack_path) is pack
+
+# TEST 2: Pack search ranks targets the same way as brute-force cosine similarity on fresh embeddings
+def test_vocab_pack_search_matches_cosine(tiny_model_handler, target_table, tmp_path):
+    pack_path = str(tmp_path / "targets.vpack")
+    build_vocab_pack(target_table, tiny_model_handler, pack_path, "float32")
+    pack = VocabPack.open(pack_path)
+
+    queries = tiny_model_handler.batch_generate_embeddings(["paracetamol tablet", "wbc"])
+    targets = tiny_model_handler.batch_generate_embeddings(
+        [normalize_concept_text(c.concept_name) for c in target_table.concepts]
+    )
+    expected = cosine_similarity(queries, targets)
+
+    rows, scores = pack.search(queries, k=3)
+    np.testing.assert_allclose(scores, np.sort(expected, axis=1)[:, ::-1][:, :3], rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(pack.similarities(queries), expected, rtol=1e-4, atol=1e-5)
+
+    # distinct queries are scored once and fanned out to their rows, a block of queries at a time
+    inverse = np.array([1, 0, 1, 1, 0])
+    np.testing.assert_allclose(pack.similarities(queries, inverse=inverse, query_block_size=1), expected[inverse],
+                               rtol=1e-4, atol=1e-5)
+
+    # the blockwise search never offers the 'No matching concept' row when asked not to
+    rows, scores = pack.search(queries, k=5, skip_no_match=True)
+    assert rows.shape == (2, 5) and 0 not in rows
+    np.testing.assert_allclose(scores, np.sort(expected[:, 1:], axis=1)[:, ::-1], rtol=1e-4, atol=1e-5)
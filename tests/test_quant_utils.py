@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+from benchmarks.synthetic import random_embeddings
+from src.data_utils import ConceptMatch, SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable
+from src.array_utils import top_k_indices
+from src.quant_utils import measure_fidelity, quantize, quantized_scores, quantized_top_k, sample_queries
+from src.session_utils import ProjectSession, load_session_embeddings, save_session_embeddings
+
+
+# TEST 1: float16 and int8 storage keep search close to float32 while halving / quartering its size, and the
+# blockwise top-k equals the top-k of the full score matrix
+@pytest.mark.parametrize("dtype, compression", [("float16", 2.0), ("int8", 3.5)])
+def test_quantized_search_fidelity(dtype, compression):
+    targets = random_embeddings(2000, 64, seed=1)
+    fidelity = measure_fidelity(sample_queries(targets, 200), targets, dtype)
+
+    assert fidelity['compression'] >= compression
+    assert fidelity['top1_agreement'] >= 0.95 and fidelity['topk_overlap'] >= 0.9
+    assert fidelity['max_score_error'] < 0.05
+
+    values, scales = quantize(targets, dtype)
+    np.testing.assert_allclose(quantized_scores(targets[:5], values, scales, block_size=300),
+                               targets[:5] @ targets.T, atol=0.05)
+    indices, scores = quantized_top_k(targets[:5], values, scales, k=10, block_size=300)
+    expected_indices, expected_scores = top_k_indices(quantized_scores(targets[:5], values, scales), 10)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+
+# TEST 2: A session saved with int8 embeddings records its fidelity and loads them back as float32
+def test_int8_session_embeddings(tmp_path):
+    sources = SourceConceptTable([SourceConcept(i, str(i), f"source {i}", "medchart", 1) for i in range(1, 21)])
+    targets = TargetConceptTable([TargetConcept(i, str(i), f"target {i}", "dm+d") for i in range(50)])
+    source_embeddings, target_embeddings = random_embeddings(20, 32, seed=2), random_embeddings(50, 32, seed=3)
+    matches = [ConceptMatch(source_key=i, target_concept_id=0, similarity_score=0.0, confirmation_status="False",
+                            first_confirmation_timestamp=None, last_update_timestamp=None) for i in range(1, 21)]
+
+    success, _ = ProjectSession.create_and_save_session(
+        "quantized", sources, targets, source_embeddings @ target_embeddings.T, matches,
+        source_embeddings=source_embeddings, target_embeddings=target_embeddings, sessions_dir=str(tmp_path),
+        reuse_mappings=False, embedding_dtype="int8"
+    )
+    assert success
+    session_dir = str(next(tmp_path.glob("quantized_*")))
+    with open(f"{session_dir}/metadata.json", 'r') as f:
+        metadata = json.load(f)
+    assert metadata['embedding_dtype'] == "int8" and metadata['embedding_fidelity']['queries'] == 20
+    assert np.load(f"{session_dir}/target_embeddings.npy").dtype == np.int8
+
+    loaded_sources, loaded_targets = load_session_embeddings(session_dir)
+    assert loaded_targets.dtype == np.float32
+    np.testing.assert_allclose(loaded_targets, target_embeddings, atol=0.01)
+    np.testing.assert_allclose(loaded_sources, source_embeddings, atol=0.01)
+
+    # later updates keep the session's storage type
+    save_session_embeddings(session_dir, target_embeddings=target_embeddings[:10])
+    assert np.load(f"{session_dir}/target_embeddings.npy").dtype == np.int8
+
+# TEST 3: Sessions and quantized storage load without torch, which only matching itself needs
+def test_storage_does_not_import_torch():
+    code = "import sys, src.session_utils, src.quant_utils; sys.exit('torch' in sys.modules)"
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    assert subprocess.run([sys.executable, "-c", code], cwd=repo_root).returncode == 0
@@ -0,0 +1,97 @@
+from datetime import datetime
+import numpy as np
+import pytest
+from src.data_utils import ConceptMatch, SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable
+from src.omop_utils import assign_concept_ids, generate_concept_table, generate_relationship_table
+from src.registry_utils import MappingIndex, target_vocabulary
+from src.session_utils import ProjectSession, list_saved_sessions, load_session, save_concept_matches
+
+NO_MATCH = TargetConcept(concept_id=0, concept_code="No matching concept", concept_name="No matching concept", vocabulary_id="None")
+TARGETS = TargetConceptTable([NO_MATCH] + [
+    TargetConcept(concept_id=concept_id, concept_code=str(concept_id), concept_name=f"target {concept_id}", vocabulary_id="dm+d")
+    for concept_id in [1, 2, 3]
+])
+
+
+def make_source_table(keys):
+    return SourceConceptTable([
+        SourceConcept(source_key=key, concept_code=str(key), concept_name=f"source {key}", vocabulary_id="medchart", concept_count=1)
+        for key in keys
+    ])
+
+
+def create_session(name, keys, sessions_dir, target_ids=None):
+    target_ids = target_ids or [1] * len(keys)
+    matches = [
+        ConceptMatch(source_key=key, target_concept_id=target_id, similarity_score=0.5, confirmation_status="False",
+                     first_confirmation_timestamp=None, last_update_timestamp=None)
+        for key, target_id in zip(keys, target_ids)
+    ]
+    success, message = ProjectSession.create_and_save_session(
+        name, make_source_table(keys), TARGETS, np.zeros((len(keys), 4)), matches, sessions_dir=sessions_dir
+    )
+    assert success, message
+    _, sessions = list_saved_sessions(sessions_dir)
+    _, session = load_session(next(s['session_name'] for s in sessions if s['project_name'] == name), sessions_dir)
+    return session
+
+
+def confirm(session, source_key, target_concept_id, sessions_dir):
+    match = next(m for m in session.concept_matches if m.source_key == source_key)
+    match.target_concept_id = target_concept_id
+    match.confirmation_status = "Rejected" if target_concept_id == 0 else "True"
+    match.first_confirmation_timestamp = match.first_confirmation_timestamp or datetime.now()
+    match.last_update_timestamp = datetime.now()
+    save_concept_matches(session, sessions_dir)
+    return MappingIndex(sessions_dir).record_confirmations(session, [match])
+
+# TEST 1: Confirmations are indexed by source_key and target vocabulary, and unconfirming removes them
+def test_record_confirmations(tmp_path):
+    sessions_dir = str(tmp_path)
+    session = create_session("first", [11, 12], sessions_dir)
+
+    assert confirm(session, 11, 2, sessions_dir) == []
+    assert confirm(session, 12, 0, sessions_dir) == []
+    index = MappingIndex(sessions_dir).load()
+    assert target_vocabulary(TARGETS) == "dm+d"
+    assert index.lookup(11, "dm+d")['target_concept_id'] == 2
+    assert index.lookup(12, "dm+d")['confirmation_status'] == "Rejected"
+
+    session.concept_matches[0].confirmation_status = "False"
+    MappingIndex(sessions_dir).record_confirmations(session, session.concept_matches[:1])
+    assert MappingIndex(sessions_dir).load().lookup(11, "dm+d") is None
+
+# TEST 2: New sessions reuse confirmed mappings, keeping their timestamps, and OMOP conversion accepts the agreeing duplicate
+def test_new_session_reuses_mappings(tmp_path):
+    sessions_dir = str(tmp_path)
+    first = create_session("first", [11, 12], sessions_dir)
+    confirm(first, 11, 2, sessions_dir)
+    original = next(m for m in first.concept_matches if m.source_key == 11)
+
+    second = create_session("second", [11, 13], sessions_dir)
+    reused = next(m for m in second.concept_matches if m.source_key == 11)
+    assert (reused.target_concept_id, reused.confirmation_status) == (2, "True")
+    assert reused.first_confirmation_timestamp == original.first_confirmation_timestamp
+    assert reused.similarity_score is None
+    assert next(m for m in second.concept_matches if m.source_key == 13).confirmation_status is False
+
+    source_key_to_id = assign_concept_ids([first, second])
+    assert list(source_key_to_id) == [11]
+    assert len(generate_concept_table([first, second], source_key_to_id)) == 1
+    assert len(generate_relationship_table([first, second], source_key_to_id)) == 2
+
+# TEST 3: Confirming a different target for a source_key owned by another session is flagged straight away
+def test_collision_flagged_on_confirmation(tmp_path):
+    sessions_dir = str(tmp_path)
+    first = create_session("first", [11], sessions_dir)
+    second = create_session("second", [11], sessions_dir, target_ids=[3])
+    confirm(first, 11, 2, sessions_dir)
+
+    # second was created before the first confirmation, so nothing was reused
+    collisions = confirm(second, 11, 3, sessions_dir)
+    assert len(collisions) == 1
+    assert collisions[0]['other_target_concept_id'] == 2
+    assert MappingIndex(sessions_dir).load().lookup(11, "dm+d")['session'].startswith("first")
+
+    with pytest.raises(ValueError):
+        assign_concept_ids([first, second])
@@ -0,0 +1,73 @@
+import time
+import numpy as np
+from src.data_utils import ConceptMatch, SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable, sort_concepts
+from src.rerank_utils import CrossEncoderReranker, FeatureReranker, apply_reranking, rerank_candidates
+
+SOURCES = SourceConceptTable([
+    SourceConcept(source_key=11, concept_code="11", concept_name="paracetamol 500 mg tablet", vocabulary_id="medchart", concept_count=1),
+    SourceConcept(source_key=12, concept_code="12", concept_name="ondansetron 4 mg", vocabulary_id="medchart", concept_count=1)
+])
+TARGETS = TargetConceptTable([
+    TargetConcept(concept_id=concept_id, concept_code=str(concept_id), concept_name=name, vocabulary_id="dm+d")
+    for concept_id, name in [(1, "paracetamol 250 mg tablet"), (2, "paracetamol 500 mg tablet"),
+                             (3, "ondansetron 4 mg tablet"), (4, "ondansetron 8 mg tablet")]
+])
+CANDIDATE_IDS = np.array([[1, 2], [4, 3]])
+CANDIDATE_SCORES = np.array([[0.90, 0.88], [0.95, 0.70]], dtype=np.float32)
+
+
+def make_matches():
+    return [
+        ConceptMatch(source_key=key, target_concept_id=int(CANDIDATE_IDS[row, 0]), similarity_score=float(CANDIDATE_SCORES[row, 0]),
+                     confirmation_status="False", first_confirmation_timestamp=None, last_update_timestamp=None)
+        for row, key in enumerate([11, 12])
+    ]
+
+
+class SlowReranker:
+    """Records which source texts it was asked about, one batch at a time."""
+    name = "slow"
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batches = []
+
+    def score_pairs(self, source_texts, target_texts, bi_encoder_scores):
+        self.batches.append(source_texts[0])
+        time.sleep(self.delay)
+        return np.asarray(bi_encoder_scores, dtype=np.float32)
+
+# TEST 1: The feature re-ranker separates products that differ only by strength, and both scores are kept
+def test_feature_reranking_changes_top_match():
+    rerank_scores, scored = rerank_candidates(FeatureReranker(), SOURCES, TARGETS, CANDIDATE_IDS, CANDIDATE_SCORES)
+    assert scored == 2 and not np.isnan(rerank_scores).any()
+
+    matches = make_matches()
+    matches[1].confirmation_status = "True"  # confirmed matches are left alone
+    assert apply_reranking(matches, SOURCES, CANDIDATE_IDS, CANDIDATE_SCORES, rerank_scores) == 1
+    assert (matches[0].target_concept_id, matches[0].similarity_score) == (2, np.float32(0.88))
+    assert matches[0].rerank_score == rerank_scores[0].max()
+    assert (matches[1].target_concept_id, matches[1].rerank_score) == (4, None)
+
+    # un-reranked matches sort last
+    assert [m.source_key for m in sort_concepts(matches, {}, "Highest Re-rank Score")] == [11, 12]
+
+# TEST 2: Ambiguous rows are re-ranked first, and the time budget leaves the rest unscored
+def test_rerank_budget_prioritises_ambiguous_rows():
+    reranker = SlowReranker()
+    rerank_candidates(reranker, SOURCES, TARGETS, CANDIDATE_IDS, CANDIDATE_SCORES, batch_size=1)
+    assert reranker.batches == ["paracetamol 500 mg tablet", "ondansetron 4 mg"]
+
+    rerank_scores, scored = rerank_candidates(SlowReranker(delay=0.05), SOURCES, TARGETS, CANDIDATE_IDS, CANDIDATE_SCORES,
+                                              batch_size=1, time_budget=0.01)
+    assert scored == 1
+    assert not np.isnan(rerank_scores[0]).any() and np.isnan(rerank_scores[1]).all()
+
+# TEST 3: A cross-encoder scores each pair into [0, 1]
+def test_cross_encoder_scores(tiny_model_path):
+    reranker = CrossEncoderReranker(tiny_model_path, cache_dir=None)
+    success, message = reranker.load_model()
+    assert success, message
+    scores = reranker.score_pairs(["paracetamol tablet", "ondansetron"], ["paracetamol tablet", "rbc count"])
+    assert scores.shape == (2,) and scores.dtype == np.float32
+    assert ((scores >= 0) & (scores <= 1)).all()
@@ -0,0 +1,29 @@
+import pytest
+from benchmarks.scale_harness import STAGES, check_budgets, main
+
+# TEST 1: A small job runs every stage end to end, recording time, peak RSS and what was written
+@pytest.mark.parametrize("checkpoint", [False, True])
+def test_pipeline_runs_end_to_end(tmp_path, checkpoint):
+    argv = ["--sources", "30", "--targets", "50", "--work-dir", str(tmp_path / "run"), "--keep",
+            "--max-peak-rss-mb", "100000", "--output", str(tmp_path / "run.json")]
+    report = main(argv + (["--checkpoint"] if checkpoint else []))
+
+    assert report['error'] is None and report['violations'] == []
+    assert list(report['stages']) == STAGES
+    assert report['stages']['bulk_confirm']['confirmed'] == 30
+    assert report['stages']['export_omop']['relationship_rows'] == 60
+    assert all(stage['peak_rss_bytes'] > 0 for stage in report['stages'].values())
+    assert report['artifact_bytes']['omop'] > 0 and report['artifact_bytes']['sessions'] > 0
+    assert ('checkpoints' in report['artifacts']) == checkpoint
+    # checkpoint runs are deleted once the session is saved
+    assert (report['stages']['save_session']['discarded_checkpoint_bytes'] > 0) == checkpoint
+    assert report['artifact_bytes'].get('checkpoints', 0) == 0
+
+# TEST 2: Exceeding a memory or stage time budget, or a failed stage, fails the run
+def test_budgets_fail_the_run(tmp_path):
+    with pytest.raises(SystemExit):
+        main(["--sources", "10", "--targets", "10", "--max-peak-rss-mb", "1"])
+
+    report = {'peak_rss_bytes': 2**30, 'total_seconds': 5.0, 'stages': {'match': {'seconds': 2.0}},
+              'error': "MemoryError: ", 'failed_stage': "embed_and_score"}
+    assert len(check_budgets(report, max_peak_rss_mb=2048, max_total_seconds=10, stage_seconds={'match': 1})) == 2
@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import json
+import socket
+import threading
+import numpy as np
+import pytest
+from src.data_utils import ConceptMatch, SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable, generate_source_key
+from src.match_utils import normalize_concept_text
+from src.registry_utils import MappingIndex
+from src.service_utils import LRUCache, LookupService, TargetSearchIndex, make_server
+from src.session_utils import ProjectSession, list_saved_sessions, load_session
+
+TARGETS = TargetConceptTable([
+    TargetConcept(concept_id=concept_id, concept_code=str(concept_id), concept_name=name, vocabulary_id="dm+d")
+    for concept_id, name in [(0, "No matching concept"), (1, "paracetamol 500 mg tablet"), (2, "ibuprofen capsule"),
+                             (3, "ondansetron oral solution"), (4, "dalteparin sodium injection")]
+])
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def post(connection, body):
+    connection.request("POST", "/lookup", json.dumps(body), {"Content-Type": "application/json"})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+@pytest.fixture
+def running_server(tiny_model_handler, tmp_path):
+    """A LookupService served over HTTP on a free localhost port."""
+    service = LookupService(tiny_model_handler, TARGETS, sessions_dir=str(tmp_path), batch_window=0.05)
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield service, server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+# TEST 1: Concurrent requests are answered correctly, share micro-batches, and repeats come from the cache
+def test_lookup_over_http(tiny_model_handler, running_server):
+    service, port = running_server
+    texts = ["paracetamol 500 mg tablet", "ondansetron oral solution", "ibuprofen capsule", "dalteparin sodium injection"]
+
+    def request(text):
+        return post(http.client.HTTPConnection("127.0.0.1", port), {'queries': [text], 'k': 2})
+
+    with ThreadPoolExecutor(len(texts)) as pool:
+        responses = list(pool.map(request, texts))
+
+    embeddings = tiny_model_handler.batch_generate_embeddings([normalize_concept_text(t) for t in texts])
+    target_embeddings = tiny_model_handler.batch_generate_embeddings([normalize_concept_text(c.concept_name) for c in TARGETS.concepts[1:]])
+    expected = np.argmax((embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True))
+                         @ (target_embeddings / np.linalg.norm(target_embeddings, axis=1, keepdims=True)).T, axis=1) + 1
+    for (status, body), concept_id in zip(responses, expected):
+        assert status == 200
+        assert body['results'][0]['source'] == "model"
+        assert body['results'][0]['candidates'][0]['concept_id'] == concept_id
+    assert service.batcher.batches_run < len(texts)
+
+    status, body = request(texts[0])
+    assert body['results'][0]['source'] == "cache"
+    assert body['results'][0]['candidates'] == responses[0][1]['results'][0]['candidates']
+
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    assert post(connection, {'queries': "not a list"})[0] == 400
+    connection.request("GET", "/health")
+    assert json.loads(connection.getresponse().read())['cache_hits'] == 1
+
+# TEST 2: Queries with a source concept's code and vocabulary are answered from the confirmed-mapping index first
+def test_registry_first(tiny_model_handler, tmp_path):
+    source = SourceConcept(source_key=generate_source_key("X1", "clexane", "medchart"), concept_code="X1",
+                           concept_name="clexane", vocabulary_id="medchart", concept_count=1)
+    match = ConceptMatch(source_key=source.source_key, target_concept_id=4, similarity_score=-1.0, confirmation_status="True",
+                         first_confirmation_timestamp=None, last_update_timestamp=None)
+    ProjectSession.create_and_save_session("registry", SourceConceptTable([source]), TARGETS, np.zeros((1, 5)), [match],
+                                           sessions_dir=str(tmp_path), reuse_mappings=False)
+    _, sessions = list_saved_sessions(str(tmp_path))
+    _, session = load_session(sessions[0]['session_name'], str(tmp_path))
+    MappingIndex(str(tmp_path)).record_confirmations(session, session.concept_matches)
+
+    service = LookupService(tiny_model_handler, TARGETS, sessions_dir=str(tmp_path))
+    results = service.lookup([{'concept_code': "X1", 'concept_name': "clexane", 'vocabulary_id': "medchart"}, "clexane"], k=3)
+    assert results[0]['source'] == "registry"
+    assert results[0]['candidates'] == [{'concept_id': 4, 'concept_name': "dalteparin sodium injection", 'score': 1.0,
+                                         'confirmation_status': "True"}]
+    assert results[1]['source'] == "model" and len(results[1]['candidates']) == 3
+
+# TEST 3: The service also answers over a Unix socket
+def test_unix_socket(tiny_model_handler, tmp_path):
+    socket_path = str(tmp_path / "lookup.sock")
+    server = make_server(LookupService(tiny_model_handler, TARGETS, sessions_dir=None), socket_path=socket_path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        status, body = post(UnixHTTPConnection(socket_path), {'queries': ["ibuprofen capsule"], 'k': 1})
+        assert status == 200 and len(body['results'][0]['candidates']) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# TEST 4: The LRU cache evicts the least recently used entry
+def test_lru_cache():
+    cache = LRUCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None and cache.get("a") == 1 and cache.get("c") == 3
+
+# TEST 5: Free-text target search ranks the exact concept first, reuses saved embeddings, and caches query embeddings
+def test_target_search_index(tiny_model_handler):
+    calls = []
+    embed = tiny_model_handler.batch_generate_embeddings
+    tiny_model_handler.batch_generate_embeddings = lambda texts: calls.append(list(texts)) or embed(texts)
+
+    index = TargetSearchIndex(tiny_model_handler, TARGETS, cache_size=2)
+    calls.clear()
+    hits = index.search("Ondansetron  oral solution", k=3)
+    assert hits[0][:2] == (3, "ondansetron oral solution")
+    assert hits[0][2] == pytest.approx(1.0, abs=1e-5)
+    assert [score for _, _, score in hits] == sorted((score for _, _, score in hits), reverse=True)
+
+    index.search("ondansetron oral solution")
+    assert calls == [["ondansetron oral solution"]]
+    assert index.search("   ") == []
+
+    saved = TargetSearchIndex(tiny_model_handler, TARGETS, target_embeddings=index.target_embeddings.astype(np.float16),
+                              target_inverse=index.target_inverse)
+    assert saved.search("ibuprofen capsule", k=1)[0][0] == 2
+
+# TEST 6: The mapping index is re-read, under its lock, only when the file has changed since the last request
+def test_index_reloaded_on_change(tiny_model_handler, tmp_path, monkeypatch):
+    source = SourceConcept(source_key=generate_source_key("X1", "clexane", "medchart"), concept_code="X1",
+                           concept_name="clexane", vocabulary_id="medchart", concept_count=1)
+    match = ConceptMatch(source_key=source.source_key, target_concept_id=4, similarity_score=None, confirmation_status="True",
+                         first_confirmation_timestamp=None, last_update_timestamp=None)
+    ProjectSession.create_and_save_session("reload", SourceConceptTable([source]), TARGETS, np.zeros((1, 5)), [match],
+                                           sessions_dir=str(tmp_path), reuse_mappings=False)
+    _, sessions = list_saved_sessions(str(tmp_path))
+    _, session = load_session(sessions[0]['session_name'], str(tmp_path))
+
+    service = LookupService(tiny_model_handler, TARGETS, sessions_dir=str(tmp_path))
+    query = {'concept_code': "X1", 'concept_name': "clexane", 'vocabulary_id': "medchart"}
+    assert service.lookup([query])[0]['source'] == "model"
+
+    reads = []
+    read = MappingIndex._read
+    monkeypatch.setattr(MappingIndex, "_read", lambda index: reads.append(index) or read(index))
+    service.lookup([query])
+    assert reads == []
+
+    MappingIndex(str(tmp_path)).record_confirmations(session, session.concept_matches)
+    reads.clear()
+    assert service.lookup([query])[0]['source'] == "registry"
+    service.lookup([query])
+    assert len(reads) == 1
@@ -0,0 +1,269 @@
+from datetime import datetime
+import json
+import time
+import numpy as np
+import pandas as pd
+import pytest
+import src.session_utils as session_utils
+from src.data_utils import (ConceptMatch, SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable,
+                            generate_source_key)
+from src.registry_utils import SourceKeyRegistry
+from src.session_utils import (ProjectSession, SessionWriter, commit_match_updates, list_saved_sessions, load_session,
+                               matches_to_json, save_concept_matches, source_key_registry, sync_session,
+                               top_alternatives)
+
+TARGETS = TargetConceptTable([
+    TargetConcept(concept_id=concept_id, concept_code=str(concept_id), concept_name=f"target {concept_id}", vocabulary_id="dm+d")
+    for concept_id in [0, 1, 2, 3]
+])
+
+
+@pytest.fixture
+def open_copies(tmp_path):
+    """Returns a function that loads another reviewer's copy of one saved session."""
+    keys = [11, 12, 13]
+    source_table = SourceConceptTable([
+        SourceConcept(source_key=key, concept_code=str(key), concept_name=f"source {key}", vocabulary_id="medchart", concept_count=1)
+        for key in keys
+    ])
+    matches = [
+        ConceptMatch(source_key=key, target_concept_id=1, similarity_score=0.5, confirmation_status="False",
+                     first_confirmation_timestamp=None, last_update_timestamp=None)
+        for key in keys
+    ]
+    ProjectSession.create_and_save_session("review", source_table, TARGETS, np.zeros((3, 4)), matches,
+                                           sessions_dir=str(tmp_path), reuse_mappings=False)
+    _, sessions = list_saved_sessions(str(tmp_path))
+    return lambda: load_session(sessions[0]['session_name'], str(tmp_path))[1]
+
+
+def edit(session, source_key, target_concept_id):
+    match = next(m for m in session.concept_matches if m.source_key == source_key)
+    match.target_concept_id = target_concept_id
+    match.confirmation_status = "True"
+    match.first_confirmation_timestamp = match.first_confirmation_timestamp or datetime.now()
+    match.last_update_timestamp = datetime.now()
+    return match
+
+
+def targets(session):
+    return {m.source_key: (m.target_concept_id, m.confirmation_status) for m in session.concept_matches}
+
+# TEST 1: Two reviewers editing different rows both keep their work, and each sees the other's edits
+def test_concurrent_edits_merge(open_copies, tmp_path):
+    alice, bob = open_copies(), open_copies()
+
+    _, result = commit_match_updates(alice, [edit(alice, 11, 2)], str(tmp_path))
+    assert (result['written'], result['conflicts']) == (1, [])
+    _, result = commit_match_updates(bob, [edit(bob, 12, 3)], str(tmp_path))
+    assert (result['written'], result['merged']) == (1, 1)
+    assert sync_session(alice, str(tmp_path)) == (True, 1)
+
+    expected = {11: (2, "True"), 12: (3, "True"), 13: (1, False)}
+    assert targets(alice) == targets(bob) == targets(open_copies()) == expected
+    assert alice.version == bob.version == 2
+
+# TEST 2: An edit to a row another reviewer changed since the copy was loaded is a conflict and is not written
+def test_conflicting_edit_is_detected(open_copies, tmp_path):
+    alice, bob = open_copies(), open_copies()
+    commit_match_updates(alice, [edit(alice, 11, 2)], str(tmp_path))
+
+    # the same value is not a conflict
+    _, result = commit_match_updates(bob, [edit(bob, 11, 2), edit(bob, 13, 3)], str(tmp_path))
+    assert result['conflicts'] == [] and result['written'] == 2
+
+    alice_copy = open_copies()
+    commit_match_updates(bob, [edit(bob, 12, 3)], str(tmp_path))
+    _, result = commit_match_updates(alice_copy, [edit(alice_copy, 12, 0)], str(tmp_path))
+    assert result['written'] == 0
+    assert [(c['source_key'], c['their_target_concept_id']) for c in result['conflicts']] == [(12, 3)]
+    assert targets(alice_copy)[12] == (3, "True")
+
+    # once the other reviewer's version has been seen, confirming again overrides it
+    _, result = commit_match_updates(alice_copy, [edit(alice_copy, 12, 0)], str(tmp_path))
+    assert result['conflicts'] == [] and targets(open_copies())[12] == (0, "True")
+
+# TEST 3: The journal is folded back into concept_matches.json without losing rows or versions
+def test_journal_compaction(open_copies, tmp_path, monkeypatch):
+    monkeypatch.setattr(session_utils, "JOURNAL_COMPACT_ROWS", 2)
+    alice = open_copies()
+    for key, target_id in [(11, 2), (12, 2), (13, 3)]:
+        commit_match_updates(alice, [edit(alice, key, target_id)], str(tmp_path))
+
+    reloaded = open_copies()
+    assert not (tmp_path / f"{reloaded.project_name}_{reloaded.timestamp}" / "match_journal.jsonl").exists()
+    assert targets(reloaded) == targets(alice)
+    assert reloaded.version == alice.version == 3
+
+# TEST 4: Similarity matrices load memory-mapped, and a row's alternatives match a full-matrix ranking
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_similarity_matrix_alternatives(tmp_path, dtype):
+    rng = np.random.default_rng(0)
+    similarities = rng.uniform(0, 1, size=(3, 4)).astype(np.float32)
+    source_table = SourceConceptTable([
+        SourceConcept(source_key=key, concept_code=str(key), concept_name=f"source {key}", vocabulary_id="medchart", concept_count=1)
+        for key in [11, 12, 13]
+    ])
+    matches = [
+        ConceptMatch(source_key=key, target_concept_id=1, similarity_score=0.5, confirmation_status="False",
+                     first_confirmation_timestamp=None, last_update_timestamp=None)
+        for key in [11, 12, 13]
+    ]
+    ProjectSession.create_and_save_session("lazy", source_table, TARGETS, similarities, matches, sessions_dir=str(tmp_path),
+                                           reuse_mappings=False, similarity_dtype=dtype)
+    _, sessions = list_saved_sessions(str(tmp_path))
+    _, session = load_session(sessions[0]['session_name'], str(tmp_path))
+
+    assert isinstance(session.similarity_matrix, np.memmap)
+    assert session.similarity_matrix.dtype == np.dtype(dtype)
+    alternatives = top_alternatives(session, 1, n=3)
+    expected = np.argsort(-similarities[1].astype(dtype))[:3]
+    assert [concept_id for concept_id, _ in alternatives] == [TARGETS.concepts[i].concept_id for i in expected]
+    assert alternatives[0][1] == pytest.approx(similarities[1].max(), abs=1e-3)
+
+    # without a matching matrix, the saved candidates are used
+    session.similarity_matrix = None
+    session.candidate_target_ids = np.array([[3, 2], [2, 1], [1, 0]])
+    session.candidate_scores = np.array([[0.9, 0.8], [0.7, 0.6], [0.5, 0.4]], dtype=np.float32)
+    assert [concept_id for concept_id, _ in top_alternatives(session, 1)] == [2, 1]
+
+# TEST 5: The background writer coalesces rapid edits into one write, on a timer or on flush, and reports conflicts
+def test_session_writer_coalesces_edits(open_copies, tmp_path):
+    alice, bob = open_copies(), open_copies()
+    writer = SessionWriter(alice, str(tmp_path), interval=60, record_index=False)
+    writer.submit([edit(alice, 11, 2)])
+    writer.submit([edit(alice, 11, 3), edit(alice, 12, 2)])
+    assert writer.status()['pending'] == 2 and writer.status()['writes'] == 0
+    assert writer.lag() > 0
+
+    assert writer.flush(timeout=10)
+    status = writer.status()
+    assert (status['pending'], status['writes'], status['rows_written']) == (0, 1, 2)
+    assert targets(open_copies())[11] == (3, "True")
+
+    # bob's copy is now behind, so his edit to row 12 is a conflict; it is written on the timer
+    bob_writer = SessionWriter(bob, str(tmp_path), interval=0.05, record_index=False)
+    bob_writer.submit([edit(bob, 12, 0), edit(bob, 13, 3)])
+    deadline = time.monotonic() + 10
+    while bob_writer.status()['writes'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    conflicts, _, errors = bob_writer.drain_messages()
+    assert errors == [] and [c['source_key'] for c in conflicts] == [12]
+
+    writer.sync()
+    assert targets(alice) == {11: (3, "True"), 12: (2, "True"), 13: (3, "True")}
+    writer.close()
+    bob_writer.close()
+    assert not writer.thread.is_alive()
+
+# TEST 6: Whole-session rewrites and journal compaction keep rows other reviewers committed after a copy was loaded
+def test_rewrites_keep_newer_edits(open_copies, tmp_path, monkeypatch):
+    reviewer, admin = open_copies(), open_copies()
+    commit_match_updates(reviewer, [edit(reviewer, 11, 2)], str(tmp_path))
+
+    # e.g. a source update on a copy loaded before the reviewer's edit
+    admin.concept_matches[2].similarity_score = 0.9
+    assert save_concept_matches(admin, str(tmp_path)) == 1
+    reloaded = open_copies()
+    assert targets(reloaded)[11] == (2, "True")
+    assert reloaded.concept_matches[2].similarity_score == pytest.approx(0.9)
+
+    # compaction is built from disk, not from the committing copy's uncommitted rows
+    monkeypatch.setattr(session_utils, "JOURNAL_COMPACT_ROWS", 1)
+    stale = open_copies()
+    stale.concept_matches[0].target_concept_id = 3
+    commit_match_updates(reviewer, [edit(reviewer, 12, 2)], str(tmp_path))
+    commit_match_updates(stale, [edit(stale, 13, 0)], str(tmp_path))
+    assert targets(open_copies()) == {11: (2, "True"), 12: (2, "True"), 13: (0, "True")}
+
+# TEST 7: New sessions and later rewrites write concept matches in the same format, rerank scores included
+def test_match_json_format(tmp_path):
+    source_table = SourceConceptTable([
+        SourceConcept(source_key=11, concept_code="11", concept_name="source 11", vocabulary_id="medchart", concept_count=1)
+    ])
+    match = ConceptMatch(source_key=11, target_concept_id=1, similarity_score=0.12345, confirmation_status="False",
+                         first_confirmation_timestamp=None, last_update_timestamp=None, rerank_score=0.98765)
+    ProjectSession.create_and_save_session("format", source_table, TARGETS, None, [match],
+                                           sessions_dir=str(tmp_path), reuse_mappings=False)
+    _, sessions = list_saved_sessions(str(tmp_path))
+    matches_path = tmp_path / sessions[0]['session_name'] / "concept_matches.json"
+    created = json.loads(matches_path.read_text())
+    assert created == [dict(row, seq=0) for row in matches_to_json([match])]
+    assert (created[0]['similarity_score'], created[0]['rerank_score']) == ("0.123", "0.988")
+
+    _, session = load_session(sessions[0]['session_name'], str(tmp_path))
+    save_concept_matches(session, str(tmp_path))
+    assert json.loads(matches_path.read_text()) == created
+
+# TEST 8: An edit still queued when the page syncs keeps its version, so another reviewer's change to the row is a conflict
+def test_queued_edit_conflicts_after_sync(open_copies, tmp_path):
+    alice, bob = open_copies(), open_copies()
+    writer = SessionWriter(alice, str(tmp_path), interval=60, record_index=False, idle_timeout=0.05)
+    writer.submit([edit(alice, 12, 2)])
+    commit_match_updates(bob, [edit(bob, 12, 3), edit(bob, 13, 3)], str(tmp_path))
+
+    assert writer.sync() == (True, 1)
+    assert targets(alice)[12] == (2, "True") and alice.version == 2
+    assert writer.flush(timeout=10)
+    conflicts, _, errors = writer.drain_messages()
+    assert errors == [] and [c['source_key'] for c in conflicts] == [12]
+    assert targets(alice) == targets(open_copies()) == {11: (1, False), 12: (3, "True"), 13: (3, "True")}
+
+    # with nothing queued the worker stops, and the next edit starts it again
+    deadline = time.monotonic() + 10
+    while writer.thread is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writer.thread is None
+    writer.submit([edit(alice, 11, 2)])
+    assert writer.flush(timeout=10)
+    assert targets(open_copies())[11] == (2, "True")
+    writer.close()
+
+# TEST 9: Rows changed by a whole-session rewrite or folded into concept_matches.json reach older copies:
+# a sync picks them up, and an edit made against the older version is a conflict
+def test_rewrite_reaches_older_copies(open_copies, tmp_path, monkeypatch):
+    reviewer, admin, stale = open_copies(), open_copies(), open_copies()
+    commit_match_updates(reviewer, [edit(reviewer, 12, 2)], str(tmp_path))
+
+    # e.g. a release update moving an unconfirmed row to a new target
+    admin.concept_matches[0].target_concept_id = 3
+    save_concept_matches(admin, str(tmp_path))
+    assert admin.version == 2
+    assert sync_session(reviewer, str(tmp_path)) == (True, 1) and reviewer.version == 2
+    assert targets(reviewer)[11] == (3, False)
+
+    _, result = commit_match_updates(stale, [edit(stale, 11, 2), edit(stale, 13, 2)], str(tmp_path))
+    assert [c['source_key'] for c in result['conflicts']] == [11] and result['written'] == 1
+    assert targets(stale) == targets(open_copies()) == {11: (3, False), 12: (2, "True"), 13: (2, "True")}
+
+    # compaction keeps each row's version, so a copy from before it still sees the rows changed since
+    monkeypatch.setattr(session_utils, "JOURNAL_COMPACT_ROWS", 0)
+    older = open_copies()
+    commit_match_updates(reviewer, [edit(reviewer, 12, 3)], str(tmp_path))
+    assert not (tmp_path / f"{reviewer.project_name}_{reviewer.timestamp}" / "match_journal.jsonl").exists()
+    _, result = commit_match_updates(older, [edit(older, 12, 1)], str(tmp_path))
+    assert [c['source_key'] for c in result['conflicts']] == [12]
+
+# TEST 10: Re-ingested concepts keep the keys of saved sessions, and a key collision is resolved at ingest
+def test_source_key_registry(open_copies, tmp_path):
+    open_copies()
+    sessions_dir = str(tmp_path)
+    success, table = SourceConceptTable.from_dataframe(pd.DataFrame({
+        'source_concept_code': ["11", "14"], 'source_concept_name': ["source 11", "source 14"],
+        'source_vocabulary_id': ["medchart", "medchart"], 'source_concept_count': [1, 1]
+    }))
+    assert success
+    assert source_key_registry(sessions_dir).resolve(table) == []
+    assert [concept.source_key for concept in table.concepts] == [11, generate_source_key("14", "source 14", "medchart")]
+
+    # a different concept that hashes to a key already registered gets the next salted key
+    clash = SourceConceptTable([SourceConcept(source_key=12, concept_code="12", concept_name="another concept",
+                                              vocabulary_id="medchart", concept_count=1)])
+    resolved = source_key_registry(sessions_dir).resolve(clash)
+    assert resolved[0]['collided_with'] == ("12", "source 12", "medchart")
+    assert clash.concepts[0].source_key == generate_source_key("12", "another concept", "medchart", salt=1)
+
+    # other processes see the registered keys
+    registry = SourceKeyRegistry(sessions_dir).load()
+    assert registry.key_for("12", "another concept", "medchart") == clash.concepts[0].source_key
+    assert registry.key_for("12", "source 12", "medchart") == 12
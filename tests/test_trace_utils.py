@@ -0,0 +1,56 @@
+import json
+import pytest
+from src.data_utils import SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable
+from src.session_utils import ProjectSession, get_session_dir, list_saved_sessions, load_session
+from src.trace_utils import Tracer, load_run_report, start_run
+
+
+def stage(report, name):
+    return next(stage for stage in report['stages'] if stage['name'] == name)
+
+# TEST 1: Spans record time, throughput, bytes written and nesting, are logged as JSON lines, and can be profiled
+def test_spans_and_run_report(tmp_path):
+    tracer = Tracer(log_path=str(tmp_path / "spans.jsonl"), profile_stage="inner", profile_dir=str(tmp_path / "profiles"))
+    run_id = start_run("test")
+
+    with tracer.span("outer", items=100) as outer:
+        with tracer.span("inner") as inner:
+            inner.record(items=10, bytes_written=2048)
+            # nested spans of a run share one RSS sampler
+            assert list(tracer.samplers) == [run_id] and len(tracer.samplers[run_id].open_peaks) == 2
+        outer.record(bytes_written=1)
+    assert tracer.samplers == {}
+    with pytest.raises(ValueError):
+        with tracer.span("inner"):
+            raise ValueError("boom")
+
+    records = [json.loads(line) for line in (tmp_path / "spans.jsonl").read_text().splitlines()]
+    assert [record['name'] for record in records] == ["inner", "outer", "inner"]
+    assert records[0]['parent'] == "outer" and records[0]['run_id'] == run_id
+    assert records[1]['items_per_second'] > 0 and records[1]['peak_rss_bytes'] > 0
+    assert records[2]['error'] == "ValueError: boom"
+    assert all(record['profile_path'].endswith(".prof") for record in records if record['name'] == "inner")
+
+    report = tracer.run_report(run_id)
+    assert (stage(report, "inner")['count'], stage(report, "inner")['bytes_written'], stage(report, "inner")['errors']) == (2, 2048, 1)
+    assert report['total_seconds'] == stage(report, "outer")['seconds']
+
+# TEST 2: A matching run's report, from model inference to session write, is saved with the session
+def test_run_report_saved_with_session(tiny_model_handler, tmp_path):
+    sources = SourceConceptTable([SourceConcept(1, "1", "paracetamol tablet", "medchart", 3)])
+    targets = TargetConceptTable([TargetConcept(concept_id, str(concept_id), name, "dm+d")
+                                  for concept_id, name in [(0, "no matching concept"), (5, "paracetamol 500 mg tablet")]])
+    start_run("auto-match")
+    _, similarities = tiny_model_handler.get_concept_similarities(sources, targets)
+    matches = tiny_model_handler.generate_initial_matches(sources, targets, similarities)
+    ProjectSession.create_and_save_session("traced", sources, targets, similarities, matches,
+                                           sessions_dir=str(tmp_path), reuse_mappings=False)
+
+    _, sessions = list_saved_sessions(str(tmp_path))
+    _, session = load_session(sessions[0]['session_name'], str(tmp_path))
+    report = load_run_report(f"{get_session_dir(session, str(tmp_path))}/run_report.json")
+    names = [stage['name'] for stage in report['stages']]
+    assert {"embed_source", "tokenize", "inference", "similarity", "initial_matches", "session_save"} <= set(names)
+    assert stage(report, "inference")['parent'] in ("embed_source", "embed_target")
+    assert stage(report, "inference")['items'] == 3  # one source name, two target names
+    assert stage(report, "session_save")['bytes_written'] > 0
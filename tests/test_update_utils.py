@@ -0,0 +1,117 @@
+from datetime import datetime
+import numpy as np
+import pytest
+from src.data_utils import SourceConcept, SourceConceptTable, TargetConcept, TargetConceptTable
+from src.match_utils import top_k_candidates
+from src.session_utils import ProjectSession, list_saved_sessions, load_session, save_concept_matches
+from src.update_utils import diff_target_tables, rematch_for_release, update_sources
+
+NO_MATCH = TargetConcept(concept_id=0, concept_code="No matching concept", concept_name="No matching concept", vocabulary_id="None")
+
+
+def make_target_table(rows):
+    return TargetConceptTable([NO_MATCH] + [
+        TargetConcept(concept_id=concept_id, concept_code=str(concept_id), concept_name=name, vocabulary_id="dm+d")
+        for concept_id, name in rows
+    ])
+
+
+@pytest.fixture
+def saved_session(tiny_model_handler, tmp_path):
+    """A session matched against an 'old' target release, saved with embeddings and top-3 candidates."""
+    source_table = SourceConceptTable([
+        SourceConcept(source_key=key, concept_code=str(key), concept_name=name, vocabulary_id="medchart", concept_count=count)
+        for key, name, count in [(11, "paracetamol tablet", 30), (12, "ondansetron", 20), (13, "wbc count", 10)]
+    ])
+    old_targets = make_target_table([(1, "paracetamol 500 mg tablet"), (2, "ibuprofen capsule"),
+                                     (3, "ondansetron oral solution"), (4, "rbc count")])
+
+    _, similarities = tiny_model_handler.get_concept_similarities(source_table, old_targets)
+    matches = tiny_model_handler.generate_initial_matches(source_table, old_targets, similarities)
+    ProjectSession.create_and_save_session(
+        "release", source_table, old_targets, similarities, matches,
+        source_embeddings=tiny_model_handler.embeddings['source'],
+        target_embeddings=tiny_model_handler.embeddings['target'],
+        source_inverse=tiny_model_handler.embeddings['source_inverse'],
+        target_inverse=tiny_model_handler.embeddings['target_inverse'],
+        candidates=top_k_candidates(similarities, old_targets, k=3),
+        sessions_dir=str(tmp_path)
+    )
+    _, sessions = list_saved_sessions(str(tmp_path))
+    _, session = load_session(sessions[0]['session_name'], str(tmp_path))
+    return session
+
+# TEST 1: Release diff by concept_id and name hash
+def test_diff_target_tables():
+    old = make_target_table([(1, "a"), (2, "b"), (3, "c")])
+    new = make_target_table([(1, "a"), (3, "c renamed"), (4, "d")])
+    diff = diff_target_tables(old, new)
+    assert (diff.added, diff.removed, diff.changed) == ([4], [2], [3])
+    assert sorted(diff.unchanged) == [0, 1]
+
+# TEST 2: Only the release delta is embedded, candidates equal a full re-match, and superseded confirmations are flagged
+def test_rematch_for_release(tiny_model_handler, saved_session, tmp_path):
+    confirmed = next(m for m in saved_session.concept_matches if m.source_key == 12)
+    confirmed.target_concept_id = 3
+    confirmed.confirmation_status = "True"
+    # a rejected row is left as the reviewer marked it, whatever its target
+    rejected = next(m for m in saved_session.concept_matches if m.source_key == 13)
+    rejected.target_concept_id = 3
+    rejected.confirmation_status = "Rejected"
+    save_concept_matches(saved_session, str(tmp_path))
+
+    new_targets = make_target_table([(1, "paracetamol 500 mg tablet"), (2, "ibuprofen 250 mg capsule"),
+                                     (4, "rbc count"), (5, "ondansetron 10 mg tablet"), (6, "wbc count blood")])
+
+    embedded = []
+    original = tiny_model_handler.batch_generate_embeddings
+    tiny_model_handler.batch_generate_embeddings = lambda texts, **kw: embedded.extend(texts) or original(texts, **kw)
+
+    success, report = rematch_for_release(saved_session, new_targets, tiny_model_handler,
+                                          replacements={3: 5}, k=3, sessions_dir=str(tmp_path))
+    assert success, report
+    assert sorted(embedded) == ["ibuprofen 250 mg capsule", "ondansetron 10 mg tablet", "wbc count blood"]
+    assert report["flagged"] == [{"source_key": 12, "target_concept_id": 3, "reason": "superseded", "replacement_concept_id": 5}]
+    assert confirmed.target_concept_id == 5 and confirmed.confirmation_status == "False"
+    assert confirmed.similarity_score is None
+    assert (rejected.target_concept_id, rejected.confirmation_status) == (3, "Rejected")
+
+    tiny_model_handler.batch_generate_embeddings = original
+    _, full_similarities = tiny_model_handler.get_concept_similarities(saved_session.source_table, new_targets)
+    _, expected_scores = top_k_candidates(full_similarities, new_targets, k=3)
+    np.testing.assert_allclose(saved_session.candidate_scores, expected_scores, rtol=1e-4, atol=1e-5)
+
+    _, reloaded = load_session(f"{saved_session.project_name}_{saved_session.timestamp}", str(tmp_path))
+    assert [c.concept_id for c in reloaded.target_table.concepts] == [0, 1, 2, 4, 5, 6]
+    np.testing.assert_array_equal(reloaded.candidate_target_ids, saved_session.candidate_target_ids)
+    assert next(m for m in reloaded.concept_matches if m.source_key == 12).similarity_score is None
+
+# TEST 3: A re-pulled extract only embeds new keys, refreshes counts and keeps confirmations
+def test_update_sources_keeps_confirmations(tiny_model_handler, saved_session, tmp_path):
+    confirmed = next(m for m in saved_session.concept_matches if m.source_key == 13)
+    confirmed.confirmation_status = "True"
+    confirmed.first_confirmation_timestamp = confirmed.last_update_timestamp = datetime(2025, 1, 28, 10, 0)
+    save_concept_matches(saved_session, str(tmp_path))
+
+    new_extract = SourceConceptTable([
+        SourceConcept(source_key=key, concept_code=str(key), concept_name=name, vocabulary_id="medchart", concept_count=count)
+        for key, name, count in [(11, "paracetamol tablet", 31), (13, "wbc count", 500), (14, "ibuprofen capsule", 40)]
+    ])
+
+    embedded = []
+    original = tiny_model_handler.batch_generate_embeddings
+    tiny_model_handler.batch_generate_embeddings = lambda texts, **kw: embedded.extend(texts) or original(texts, **kw)
+
+    success, report = update_sources(saved_session, new_extract, tiny_model_handler, k=3, sessions_dir=str(tmp_path))
+    assert success, report
+    assert embedded == ["ibuprofen capsule"]
+    assert (report["new_sources"], report["refreshed_counts"], report["missing_from_extract"]) == (1, 2, 1)
+
+    _, reloaded = load_session(f"{saved_session.project_name}_{saved_session.timestamp}", str(tmp_path))
+    assert [m.source_key for m in reloaded.concept_matches] == [13, 14, 11, 12]
+    wbc = reloaded.concept_matches[0]
+    assert wbc.confirmation_status == "True"
+    assert wbc.first_confirmation_timestamp == datetime(2025, 1, 28, 10, 0)
+    assert reloaded.candidate_target_ids.shape == (4, 3)
+    # the saved 3 source x 5 target matrix has no row for the new source, so it is dropped
+    assert reloaded.similarity_matrix is None
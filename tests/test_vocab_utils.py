@@ -0,0 +1,42 @@
+import os
+from src.data_utils import TargetConceptTable
+from src.vocab_utils import load_or_build_vocabulary_pack
+
+ATHENA_HEADER = "concept_id\tconcept_name\tdomain_id\tvocabulary_id\tconcept_class_id\tstandard_concept\tconcept_code\tvalid_start_date\tvalid_end_date\tinvalid_reason"
+ATHENA_ROWS = [
+    "40229458\tbenzocaine 0.18 MG/MG Oral Gel\tDrug\tRxNorm\tClinical Drug\tS\t1042838\t20110101\t20991231\t",
+    "1125315\tacetaminophen\tDrug\tRxNorm\tIngredient\tS\t161\t19700101\t20991231\t",
+    "40229459\tbenzocaine \"extra\" 0.18 MG/MG Oral Ointment\tDrug\tRxNorm\tClinical Drug\tS\t1042847\t20110101\t20991231\t",
+    "40000001\told drug 5 MG Oral Tablet\tDrug\tRxNorm\tClinical Drug\t\t999\t20000101\t20100101\tU",
+    "21310788\tGeneric Peptamen Junior powder\tDrug\tdm+d\tVMP\tS\t10051011000001108\t20200101\t20991231\t",
+]
+
+
+def write_athena_concepts(tmp_path):
+    concept_path = tmp_path / "CONCEPT.csv"
+    concept_path.write_text("\n".join([ATHENA_HEADER] + ATHENA_ROWS) + "\n")
+    return str(concept_path)
+
+# TEST 1: Pack keeps only rows matching every filter, and TargetConceptTable loads it with the no-match row
+def test_build_and_load_filtered_pack(tmp_path):
+    concept_path = write_athena_concepts(tmp_path)
+    pack_path = load_or_build_vocabulary_pack(
+        concept_path, str(tmp_path / "packs"), name="rxnorm_clinical_drug",
+        vocabulary_ids=["RxNorm"], concept_class_ids=["Clinical Drug"], standard_concepts=["S"]
+    )
+
+    success, table = TargetConceptTable.from_pack(pack_path)
+    assert success
+    assert [c.concept_id for c in table.concepts] == [0, 40229458, 40229459]
+    assert table.concepts[2].concept_name == 'benzocaine "extra" 0.18 MG/MG Oral Ointment'
+    assert table.concepts[1].concept_code == "1042838"
+
+# TEST 2: The same file and filters reuse the cached pack
+def test_vocabulary_pack_is_cached(tmp_path):
+    concept_path = write_athena_concepts(tmp_path)
+    first = load_or_build_vocabulary_pack(concept_path, str(tmp_path / "packs"), vocabulary_ids=["dm+d"])
+    modified = os.path.getmtime(first)
+    second = load_or_build_vocabulary_pack(concept_path, str(tmp_path / "packs"), vocabulary_ids=["dm+d"])
+
+    assert first == second
+    assert os.path.getmtime(second) == modified